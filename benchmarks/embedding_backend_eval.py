@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.embedding_batching_benchmark import load_chunks
+from utils.embedding_batching import DEFAULT_BATCH_TOKENS, BucketedEmbedding
+from utils.onnx_embedding import ONNX_CACHE_DIR, OnnxEmbedding
+
+
+###################################
+#
+# Fidelity Against the PyTorch Model
+#
+###################################
+
+
+def embed(embed_model, texts: list, queries: list):
+    """
+    Returns the text embeddings, the query embeddings and the texts embedded per second.
+    """
+    start = time.perf_counter()
+    text_embeddings = np.asarray(embed_model.get_text_embedding_batch(texts), dtype=np.float32)
+    seconds = time.perf_counter() - start
+    query_embeddings = np.asarray([embed_model.get_query_embedding(query) for query in queries], dtype=np.float32)
+    return text_embeddings, query_embeddings, len(texts) / seconds
+
+
+def top_k(query_embeddings, text_embeddings, k: int):
+    scores = query_embeddings @ text_embeddings.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def recall(expected, results):
+    return float(np.mean([len(set(row) & set(expected_row)) / len(expected_row) for row, expected_row in zip(results, expected)]))
+
+
+def compare(name: str, reference: tuple, candidate: tuple, k: int, load_seconds: float):
+    """
+    Prints the cosine drift of a backend against the PyTorch embeddings, its recall@k against PyTorch search,
+    searching its own embeddings and an index built by PyTorch, and its throughput.
+    """
+    text_reference, query_reference, reference_rate = reference
+    texts, queries, rate = candidate
+    # Both are normalized, the dot product is the cosine similarity
+    cosine = np.sum(text_reference * texts, axis=1)
+    expected = top_k(query_reference, text_reference, k)
+    own_index = recall(expected, top_k(queries, texts, k))
+    torch_index = recall(expected, top_k(queries, text_reference, k))
+    print(f"| {name} | {cosine.mean():.5f} | {np.percentile(cosine, 1):.5f} | {cosine.min():.5f} | {own_index:.3f} | {torch_index:.3f} "
+          f"| {rate:,.1f} | {rate / reference_rate:.2f}x | {load_seconds:.1f} |", flush=True)
+
+
+###################################
+#
+# Command Line
+#
+###################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cosine drift, retrieval agreement and throughput of the ONNX embedding backends against PyTorch, on CPU.")
+    parser.add_argument("--data-dir", default="Latex_Test_Docs", help="The files chunked and embedded.")
+    parser.add_argument("--model", default="BAAI/bge-large-en-v1.5", help="The Hugging Face embedding model.")
+    parser.add_argument("--backend", nargs="+", default=["onnx", "onnx-int8"], choices=["onnx", "onnx-int8"])
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--chunk-overlap", type=int, default=200)
+    parser.add_argument("--batch-tokens", type=int, default=DEFAULT_BATCH_TOKENS)
+    parser.add_argument("--threads", type=int, default=0, help="CPU threads of every backend, 0 for one per core.")
+    parser.add_argument("--queries", type=int, default=100, help="Chunks whose first sentence is used as a query.")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--cache-dir", default=ONNX_CACHE_DIR, help="Where the ONNX exports are cached.")
+    args = parser.parse_args()
+
+    import torch
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    texts = load_chunks(args.data_dir, args.chunk_size, args.chunk_overlap)
+    rng = np.random.default_rng(0)
+    queries = [texts[i].split(".")[0][:300] for i in rng.choice(len(texts), size=min(args.queries, len(texts)), replace=False)]
+    print(f"model={args.model} chunks={len(texts):,} queries={len(queries)} threads={args.threads or os.cpu_count()} top_k={args.top_k}")
+
+    start = time.perf_counter()
+    reference_model = BucketedEmbedding(HuggingFaceEmbedding(model_name=args.model, device="cpu"), batch_tokens=args.batch_tokens)
+    load_seconds = time.perf_counter() - start
+    reference = embed(reference_model, texts, queries)
+
+    print(f"| backend | mean cosine | p1 cosine | min cosine | recall@{args.top_k} | recall@{args.top_k} on torch index | chunks/s | speed-up | load (s) |")
+    print("|---|---|---|---|---|---|---|---|---|")
+    compare("torch", reference, reference, args.top_k, load_seconds)
+    for backend in args.backend:
+        # The first run includes the export, later runs load it from the cache
+        start = time.perf_counter()
+        backend_model = BucketedEmbedding(OnnxEmbedding(args.model, quantize=backend == "onnx-int8", threads=args.threads, cache_dir=args.cache_dir),
+                                          batch_tokens=args.batch_tokens)
+        load_seconds = time.perf_counter() - start
+        compare(backend, reference, embed(backend_model, texts, queries), args.top_k, load_seconds)
+
+
+if __name__ == "__main__":
+    main()
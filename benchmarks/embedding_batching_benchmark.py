@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llama_index.core import SimpleDirectoryReader
+from llama_index.core.schema import MetadataMode
+
+from utils.embedding_batching import DEFAULT_MAX_BATCH_SIZE, BucketedEmbedding, padded_tokens, plan_batches, token_lengths
+from utils.incremental_index import split_documents
+
+
+###################################
+#
+# Load the Benchmark Chunks
+#
+###################################
+
+
+def load_chunks(data_dir: str, chunk_size: int, chunk_overlap: int):
+    """
+    Returns the text of the chunks of every file in a directory, in document order and as they are embedded
+    during ingestion (with their embedded metadata).
+    """
+    documents = SimpleDirectoryReader(input_dir=data_dir, recursive=True).load_data()
+    nodes = split_documents(documents, chunk_size, chunk_overlap)
+    return [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+
+
+###################################
+#
+# Fixed Versus Bucketed Batches
+#
+###################################
+
+
+def embed_timed(embed_model, texts: list):
+    """
+    Returns the embeddings of the texts, through the llama-index batching of the model, and the time taken in seconds.
+    """
+    start = time.perf_counter()
+    embeddings = embed_model.get_text_embedding_batch(texts)
+    return np.asarray(embeddings, dtype=np.float32), time.perf_counter() - start
+
+
+def max_difference(reference, embeddings):
+    # Bucketing changes the padding of each text, the embeddings only differ by float rounding
+    return float(np.abs(reference - embeddings).max())
+
+
+def run(embed_model, texts: list, batch_sizes, batch_tokens_list, max_batch_size: int):
+    """
+    Prints the padding and throughput of fixed-size batches in document order and of length-bucketed batches.
+    """
+    lengths = token_lengths(embed_model, texts)
+    print(f"chunks={len(texts):,} tokens={sum(lengths):,} shortest={min(lengths)} longest={max(lengths)} mean={np.mean(lengths):.0f}")
+    print("| batching | setting | batches | padding | seconds | chunks/s | speed-up | max diff |")
+    print("|---|---|---|---|---|---|---|---|")
+
+    # Warm up the model, the first call loads weights and kernels
+    embed_model.get_text_embedding_batch(texts[:8])
+
+    reference, baseline = None, None
+    for batch_size in batch_sizes:
+        embed_model.embed_batch_size = batch_size
+        batches = [list(range(start, min(start + batch_size, len(texts)))) for start in range(0, len(texts), batch_size)]
+        padding = 1 - sum(lengths) / padded_tokens(lengths, batches)
+        embeddings, seconds = embed_timed(embed_model, texts)
+        if reference is None:
+            reference, baseline = embeddings, seconds
+        print(f"| fixed, document order | {batch_size} texts | {len(batches):,} | {padding:.1%} | {seconds:.2f} | {len(texts) / seconds:,.1f} "
+              f"| {baseline / seconds:.2f}x | {max_difference(reference, embeddings):.1e} |", flush=True)
+
+    for batch_tokens in batch_tokens_list:
+        bucketed = BucketedEmbedding(embed_model, batch_tokens=batch_tokens, max_batch_size=max_batch_size)
+        batches = plan_batches(lengths, batch_tokens, max_batch_size)
+        padding = 1 - sum(lengths) / padded_tokens(lengths, batches)
+        embeddings, seconds = embed_timed(bucketed, texts)
+        print(f"| bucketed by length | {batch_tokens:,} tokens | {len(batches):,} | {padding:.1%} | {seconds:.2f} | {len(texts) / seconds:,.1f} "
+              f"| {baseline / seconds:.2f}x | {max_difference(reference, embeddings):.1e} |", flush=True)
+
+
+###################################
+#
+# Command Line
+#
+###################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding throughput of fixed-size batches against length-bucketed batches sized to a token budget.")
+    parser.add_argument("--data-dir", default="Latex_Test_Docs", help="The files chunked and embedded.")
+    parser.add_argument("--model", default="BAAI/bge-large-en-v1.5", help="The Hugging Face embedding model.")
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--chunk-overlap", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[10, 64], help="Fixed batch sizes, 10 is the llama-index default. The first is the baseline.")
+    parser.add_argument("--batch-tokens", type=int, nargs="+", default=[4096, 16384, 65536], help="Token budgets of the bucketed batches.")
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=0, help="CPU threads used by torch, 0 for its default.")
+    parser.add_argument("--device", default=None, help="cpu or cuda, detected by default.")
+    args = parser.parse_args()
+
+    import torch
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"model={args.model} device={device} threads={torch.get_num_threads()}")
+
+    texts = load_chunks(args.data_dir, args.chunk_size, args.chunk_overlap)
+    embed_model = HuggingFaceEmbedding(model_name=args.model, device=device)
+    run(embed_model, texts, args.batch_size, args.batch_tokens, args.max_batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from utils.memmap_vector_store import MemmapVectorStore
+
+BUILD_BLOCK = 100_000
+
+
+###################################
+#
+# Build Store
+#
+###################################
+
+
+def clustered_block(rng, centers, count: int, spread: float):
+    """
+    Returns `count` embeddings drawn around random topic centers, closer to real chunk embeddings
+    than uniform noise, which has no cluster structure for IVF to exploit.
+    """
+    topics = rng.integers(0, centers.shape[0], count)
+    return centers[topics] + spread * rng.standard_normal((count, centers.shape[1]), dtype=np.float32)
+
+
+def build_synthetic_store(size: int, dim: int, topics: int, spread: float, persist_dir: str, seed: int):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dim), dtype=np.float32) / np.sqrt(dim)
+    store = MemmapVectorStore()
+    persist_path = os.path.join(persist_dir, "default__vector_store.json")
+    for start in range(0, size, BUILD_BLOCK):
+        count = min(BUILD_BLOCK, size - start)
+        store.add_embeddings([f"node-{i}" for i in range(start, start + count)], clustered_block(rng, centers, count, spread / np.sqrt(dim)))
+        store.persist(persist_path)
+    return MemmapVectorStore.from_persist_path(persist_path)
+
+
+def sample_queries(store, count: int, noise: float, seed: int):
+    """
+    Returns query embeddings made of stored embeddings plus noise, so every query has close neighbours.
+    """
+    rng = np.random.default_rng(seed + 1)
+    _, matrix = store.embedding_matrix()
+    rows = np.sort(rng.choice(matrix.shape[0], count, replace=False))
+    queries = np.asarray(matrix[rows], dtype=np.float32)
+    return queries + noise / np.sqrt(matrix.shape[1]) * rng.standard_normal(queries.shape, dtype=np.float32)
+
+
+###################################
+#
+# Recall Versus Latency
+#
+###################################
+
+
+def search(store, queries, top_k: int, nprobe=None):
+    """
+    Returns the result ids of every query and the median and p95 latency in milliseconds.
+    """
+    results, latencies = [], []
+    for query_embedding in queries:
+        query = VectorStoreQuery(query_embedding=query_embedding.tolist(), similarity_top_k=top_k)
+        start = time.perf_counter()
+        result = store.query(query, nprobe=nprobe)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(result.ids)
+    return results, float(np.median(latencies)), float(np.percentile(latencies, 95))
+
+
+def recall(exact_results, approximate_results):
+    """
+    Returns the mean fraction of the exact top-k ids found by the approximate search.
+    """
+    return float(np.mean([len(set(exact) & set(approximate)) / max(len(exact), 1) for exact, approximate in zip(exact_results, approximate_results)]))
+
+
+def report(store, queries, top_k: int, nprobes):
+    exact_results, exact_median, exact_p95 = search(store, queries, top_k)
+    print(f"| exact | - | 1.000 | {exact_median:.2f} | {exact_p95:.2f} | 1.0x |")
+    for nprobe in nprobes:
+        if nprobe >= store.ivf.n_lists:
+            break
+        results, median, p95 = search(store, queries, top_k, nprobe)
+        print(f"| ivf | {nprobe} | {recall(exact_results, results):.3f} | {median:.2f} | {p95:.2f} | {exact_median / median:.1f}x |", flush=True)
+
+
+###################################
+#
+# Command Line
+#
+###################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k and latency of IVF search against exact search, for a range of nprobe values.")
+    parser.add_argument("--persist-dir", help="Benchmark the index persisted in this directory (e.g. vector_db) instead of synthetic embeddings.")
+    parser.add_argument("--size", type=int, default=200_000, help="Number of synthetic chunks.")
+    parser.add_argument("--dim", type=int, default=1024, help="Dimension of the synthetic embeddings.")
+    parser.add_argument("--topics", type=int, default=2000, help="Number of topic centers the synthetic embeddings are drawn around.")
+    parser.add_argument("--spread", type=float, default=1.0, help="Spread of the synthetic embeddings around their topic, relative to the topic norm.")
+    parser.add_argument("--noise", type=float, default=0.5, help="Noise added to stored embeddings to make the queries.")
+    parser.add_argument("--lists", type=int, default=0, help="Number of IVF lists, 0 for sqrt(chunks).")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64, 128])
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.persist_dir:
+            store = MemmapVectorStore.from_persist_dir(args.persist_dir)
+        else:
+            store = build_synthetic_store(args.size, args.dim, args.topics, args.spread, tmp_dir, args.seed)
+        queries = sample_queries(store, min(args.queries, store.size), args.noise, args.seed)
+
+        # The IVF index is built in memory only, the persisted store is left untouched
+        start = time.perf_counter()
+        store.build_ivf(n_lists=args.lists)
+        build_seconds = time.perf_counter() - start
+
+        print(f"chunks={store.size:,} dim={store.dim} lists={store.ivf.n_lists:,} top_k={args.top_k} queries={len(queries)} build={build_seconds:.1f}s")
+        print(f"| search | nprobe | recall@{args.top_k} | p50 (ms) | p95 (ms) | speed-up |")
+        print("|---|---|---|---|---|---|")
+        report(store, queries, args.top_k, args.nprobe)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from benchmarks.ivf_benchmark import build_synthetic_store, recall, sample_queries
+from utils.memmap_vector_store import MemmapVectorStore
+
+
+###################################
+#
+# Quantized Versus Float32 Search
+#
+###################################
+
+
+def search(store, queries, top_k: int, **query_kwargs):
+    """
+    Returns the result ids of every query and the median and p95 latency in milliseconds.
+    """
+    results, latencies = [], []
+    for query_embedding in queries:
+        query = VectorStoreQuery(query_embedding=query_embedding.tolist(), similarity_top_k=top_k)
+        start = time.perf_counter()
+        result = store.query(query, **query_kwargs)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(result.ids)
+    return results, float(np.median(latencies)), float(np.percentile(latencies, 95))
+
+
+def file_size(persist_path: str, extension: str):
+    directory = os.path.dirname(persist_path)
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.endswith(extension))
+
+
+def evaluate(persist_path: str, queries, top_k: int, rerank_factors):
+    """
+    Prints recall@k and latency of int8 search, without and with float32 re-ranking, against float32 search.
+    The store at `persist_path` is quantized in a copy, the original files are not modified.
+    """
+    exact_store = MemmapVectorStore.from_persist_path(persist_path)
+    exact_results, exact_median, exact_p95 = search(exact_store, queries, top_k)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        quantized_path = os.path.join(tmp_dir, "default__vector_store.json")
+        quantized_store = MemmapVectorStore.from_persist_path(persist_path)
+        quantized_store.quantize()
+        quantized_store.persist(quantized_path)
+        quantized_store = MemmapVectorStore.from_persist_path(quantized_path)
+
+        float_bytes, int8_bytes = file_size(quantized_path, ".f32"), file_size(quantized_path, ".i8")
+        print(f"chunks={exact_store.size:,} dim={exact_store.dim} top_k={top_k} queries={len(queries)}")
+        print(f"float32 matrix: {float_bytes / 2**20:,.1f} MB, int8 matrix: {int8_bytes / 2**20:,.1f} MB ({float_bytes / max(int8_bytes, 1):.1f}x smaller)")
+        print(f"| search | rerank factor | recall@{top_k} | p50 (ms) | p95 (ms) | speed-up |")
+        print("|---|---|---|---|---|---|")
+        print(f"| float32 | - | 1.000 | {exact_median:.2f} | {exact_p95:.2f} | 1.0x |")
+        for rerank_factor in rerank_factors:
+            results, median, p95 = search(quantized_store, queries, top_k, rerank_factor=rerank_factor)
+            label = "int8" if rerank_factor == 0 else "int8 + float32 re-rank"
+            print(f"| {label} | {rerank_factor} | {recall(exact_results, results):.3f} | {median:.2f} | {p95:.2f} | {exact_median / median:.1f}x |", flush=True)
+
+
+###################################
+#
+# Command Line
+#
+###################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall loss, size and latency of int8 quantized embeddings against float32 search.")
+    parser.add_argument("--persist-dir", help="Evaluate the index persisted in this directory (e.g. vector_db) instead of synthetic embeddings.")
+    parser.add_argument("--size", type=int, default=200_000, help="Number of synthetic chunks.")
+    parser.add_argument("--dim", type=int, default=1024, help="Dimension of the synthetic embeddings.")
+    parser.add_argument("--topics", type=int, default=2000, help="Number of topic centers the synthetic embeddings are drawn around.")
+    parser.add_argument("--spread", type=float, default=1.0, help="Spread of the synthetic embeddings around their topic.")
+    parser.add_argument("--noise", type=float, default=0.5, help="Noise added to stored embeddings to make the queries.")
+    parser.add_argument("--rerank-factor", type=int, nargs="+", default=[0, 1, 2, 4, 8], help="Shortlist sizes as multiples of top k, 0 disables re-ranking.")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.persist_dir:
+            persist_path = os.path.join(args.persist_dir, "default__vector_store.json")
+            store = MemmapVectorStore.from_persist_path(persist_path)
+        else:
+            store = build_synthetic_store(args.size, args.dim, args.topics, args.spread, tmp_dir, args.seed)
+            persist_path = os.path.join(tmp_dir, "default__vector_store.json")
+        queries = sample_queries(store, min(args.queries, store.size), args.noise, args.seed)
+        evaluate(persist_path, queries, args.top_k, args.rerank_factor)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import os
+import gc
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.vector_stores.types import MetadataFilter, MetadataFilters, VectorStoreQuery
+
+from utils.memmap_vector_store import MemmapVectorStore
+
+# Chunks are generated and persisted in blocks so 1M x 1024 float32 (4 GB) never has to sit in memory twice
+BUILD_BLOCK = 100_000
+FILE_COUNT = 50
+
+
+###################################
+#
+# Build Stores
+#
+###################################
+
+
+def random_block(rng, count: int, dim: int):
+    return rng.standard_normal((count, dim), dtype=np.float32)
+
+
+def build_memmap_store(size: int, dim: int, persist_dir: str, seed: int):
+    """
+    Builds a MemmapVectorStore of `size` random chunks, persisting block by block, and reloads it from disk.
+    """
+    rng = np.random.default_rng(seed)
+    persist_path = os.path.join(persist_dir, "default__vector_store.json")
+    store = MemmapVectorStore()
+    for start in range(0, size, BUILD_BLOCK):
+        count = min(BUILD_BLOCK, size - start)
+        store.add_embeddings(
+            [f"node-{i}" for i in range(start, start + count)],
+            random_block(rng, count, dim),
+            [f"doc-{i % FILE_COUNT}" for i in range(start, start + count)],
+            [{"file_name": f"file-{i % FILE_COUNT}.pdf"} for i in range(start, start + count)],
+        )
+        store.persist(persist_path)
+    return MemmapVectorStore.from_persist_path(persist_path)
+
+
+def build_simple_store(size: int, dim: int, seed: int):
+    """
+    Builds the default llama-index SimpleVectorStore with the same random chunks as build_memmap_store.
+    """
+    rng = np.random.default_rng(seed)
+    store = SimpleVectorStore()
+    for start in range(0, size, BUILD_BLOCK):
+        count = min(BUILD_BLOCK, size - start)
+        block = random_block(rng, count, dim)
+        for offset in range(count):
+            node_id = f"node-{start + offset}"
+            store.data.embedding_dict[node_id] = block[offset].tolist()
+            store.data.text_id_to_ref_doc_id[node_id] = f"doc-{(start + offset) % FILE_COUNT}"
+            store.data.metadata_dict[node_id] = {"file_name": f"file-{(start + offset) % FILE_COUNT}.pdf"}
+    return store
+
+
+###################################
+#
+# Time Queries
+#
+###################################
+
+
+def time_queries(store, queries, top_k: int, filters=None):
+    """
+    Returns the median and p95 latency in milliseconds of querying the store with every query embedding.
+    """
+    latencies = []
+    for query_embedding in queries:
+        query = VectorStoreQuery(query_embedding=query_embedding.tolist(), similarity_top_k=top_k, filters=filters)
+        start = time.perf_counter()
+        store.query(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return float(np.median(latencies)), float(np.percentile(latencies, 95))
+
+
+def run(sizes, dim: int, top_k: int, queries: int, baseline_max: int, seed: int):
+    rng = np.random.default_rng(seed + 1)
+    query_embeddings = random_block(rng, queries, dim)
+    file_filter = MetadataFilters(filters=[MetadataFilter(key="file_name", value="file-7.pdf")])
+
+    rows = []
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as persist_dir:
+            start = time.perf_counter()
+            store = build_memmap_store(size, dim, persist_dir, seed)
+            build_seconds = time.perf_counter() - start
+            # The first filtered query builds the metadata column, it is not part of the steady state
+            store.query(VectorStoreQuery(query_embedding=query_embeddings[0].tolist(), similarity_top_k=top_k, filters=file_filter))
+            rows.append(("memmap", size, build_seconds, *time_queries(store, query_embeddings, top_k), *time_queries(store, query_embeddings, top_k, file_filter)))
+            print(format_row(rows[-1]), flush=True)
+            del store
+            gc.collect()
+
+        if size <= baseline_max:
+            start = time.perf_counter()
+            store = build_simple_store(size, dim, seed)
+            build_seconds = time.perf_counter() - start
+            # The baseline is slow enough at scale that a few queries give a stable median
+            baseline_queries = query_embeddings[: max(3, queries // 10)] if size > 10_000 else query_embeddings
+            rows.append(("simple", size, build_seconds, *time_queries(store, baseline_queries, top_k), *time_queries(store, baseline_queries, top_k, file_filter)))
+            print(format_row(rows[-1]), flush=True)
+            del store
+            gc.collect()
+        else:
+            print(f"| simple | {size:,} | skipped, above --baseline-max {baseline_max:,} | | | | |", flush=True)
+    return rows
+
+
+def format_row(row):
+    store, size, build_seconds, median, p95, filtered_median, filtered_p95 = row
+    return f"| {store} | {size:,} | {build_seconds:.1f} | {median:.2f} | {p95:.2f} | {filtered_median:.2f} | {filtered_p95:.2f} |"
+
+
+###################################
+#
+# Command Line
+#
+###################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query latency of MemmapVectorStore against the default SimpleVectorStore.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="Numbers of chunks to benchmark.")
+    parser.add_argument("--dim", type=int, default=1024, help="Embedding dimension (1024 for bge-large).")
+    parser.add_argument("--top-k", type=int, default=5, help="similarity_top_k of every query.")
+    parser.add_argument("--queries", type=int, default=50, help="Number of timed queries per store and size.")
+    parser.add_argument("--baseline-max", type=int, default=100_000, help="Largest size the SimpleVectorStore baseline is run at, it keeps embeddings as Python lists.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"dim={args.dim} top_k={args.top_k} queries={args.queries}")
+    print("| store | chunks | build (s) | query p50 (ms) | query p95 (ms) | filtered p50 (ms) | filtered p95 (ms) |")
+    print("|---|---|---|---|---|---|---|")
+    run(args.sizes, args.dim, args.top_k, args.queries, args.baseline_max, args.seed)
+
+
+if __name__ == "__main__":
+    main()
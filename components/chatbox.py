@@ -36,29 +36,51 @@ def format_response_latex(response):
     if remaining_text:
         st.write(remaining_text)
 
-def call_fastapi_backend(user_input,top_k):
+def get_api_endpoint(stream=False):
     """
-    Calls the FastAPI backend with the user query and returns the response.
-    """
-    
-    # Read API endpoint from config.json
+    Reads the FastAPI endpoint from config.json.
 
+    Args:
+        stream (bool): Return the server-sent events endpoint instead of the JSON one.
+    """
     config_path = os.path.join(os.getcwd(), 'config', 'config.json')
     try: 
         with open(config_path) as config_file:
             config = json.load(config_file)
             # Extract FastAPI endpoint from config file ,Default is http://127.0.0.1:8000 
             API_endpoint = config.get("FastAPI_endpoint", "http://127.0.0.1:8000/api/math-query")
+            if stream:
+                API_endpoint = config.get("FastAPI_stream_endpoint", API_endpoint + "/stream")
+            return API_endpoint
             
     except Exception as e:
         st.error(f"Error reading config file: {e}")
         return None
+
+def call_fastapi_backend(user_input,top_k,response_mode="compact",stream=False,nprobe=None,collection=None,filters=None):
+    """
+    Calls the FastAPI backend with the user query and returns the response.
+    With stream=True the response body is left open to be read as server-sent events.
+    nprobe is the number of IVF lists searched, None lets the API use its configured default.
+    collection is the list of collections searched, None searches the default collection.
+    filters restricts retrieval by file name, file type and page range, None searches every chunk.
+    """
+    
+    # Read API endpoint from config.json
+    API_endpoint = get_api_endpoint(stream)
+    if API_endpoint is None:
+        return None
         
     # Send POST request to FastAPI backend : 
     
     try:
         response = requests.post(API_endpoint, json={"prompt": user_input,
-                                                "top_k_param": top_k})
+                                                "top_k_param": top_k,
+                                                "response_mode": response_mode,
+                                                "nprobe": nprobe,
+                                                "collection": collection,
+                                                "filters": filters},
+                                 stream=stream)
                                             
         response.raise_for_status()  # Raise error for non-200 responses
         return response
@@ -66,7 +88,124 @@ def call_fastapi_backend(user_input,top_k):
     except requests.exceptions.RequestException as e:
         st.error(f"API error: {e}")
         return None
+
+def read_sse_events(response):
+    """
+    Parses a server-sent events response and yields (event, data) tuples.
+
+    Args:
+        response (requests.Response): A streaming response from the FastAPI backend.
+    """
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if line == "":
+            # A blank line terminates the current event
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+
+def stream_answer(response, placeholder):
+    """
+    Renders tokens from the streaming backend as they arrive and returns the full answer and citation nodes.
+
+    Args:
+        response (requests.Response): A streaming response from the FastAPI backend.
+        placeholder: Streamlit container updated with the partial answer.
+    """
+    chatbot_response = ""
+    retrieved_nodes = []
+    try:
+        for event, data in read_sse_events(response):
+            if event == "token":
+                chatbot_response += data.get("token", "")
+                placeholder.markdown(chatbot_response + "▌")
+            elif event == "citations":
+                retrieved_nodes = data.get("nodes", [])
+            elif event == "error":
+                st.error(f"API error: {data.get('detail')}")
+    except requests.exceptions.RequestException as e:
+        st.error(f"API error: {e}")
+    finally:
+        response.close()
+    
+    # The partial answer is replaced by the formatted LaTeX rendering once streaming is complete
+    placeholder.empty()
+    return chatbot_response, retrieved_nodes
+
+def render_answer(chatbot_response, retrieved_nodes):
+    """
+    Renders the answer along with the citations of the retrieved chunks.
+
+    Args:
+        chatbot_response (str): The answer from LLM model.
+        retrieved_nodes (list): The retrieved chunks returned by the FastAPI backend.
+    """
+    # Retrieve the nodes from the query engine based on the user input.       
+    logs.log.info(f"retrieved_nodes total is {len(retrieved_nodes)}")
+    
+    # Extract filename and scores from retrieved chunks and create a dictionary for unique file names
+    file_scores_dict = {}
+    retrieval_scores = [] # List to store similarity scores of all chunks
+    for node in retrieved_nodes:
+        file_name = node.get("node", {}).get("extra_info", {}).get("file_name", "N/A")
+        logs.log.info(f"File name is {file_name}")
+        
+        score = round(node.get('score', 0), 3)
+        if file_name not in file_scores_dict:
+            file_scores_dict[file_name] = []
+            file_scores_dict[file_name].append(score)
+        else: 
+            file_scores_dict[file_name].append(score)
+
+        retrieval_scores.append(score)
+    
+    # RAG Math Enhacement 2 : Add a similarity score threshold to caition the user if the answer is not available in the context retrieved.
+    
+    similarity_score_threshold  = 0.55 # This threshold can be adjusted based on the requirement. Currently set to 0.55 based on testing . 
+    if any(score > similarity_score_threshold for score in retrieval_scores):                
+        
+        # Render response in latex and markdown language .
+        format_response_latex(chatbot_response)
+        citations = "<br>Citations:<br>"     
+    
+        # Display document from which data is retrieved along with scores
+        chunk_index = 1
+        file_index = 1
+        for file_name, scores in file_scores_dict.items():
+            citations += f"<h6>{file_index}. Filename: {file_name}<h6><br>"
+            citations += "<table><tr><th>Chunk</th><th>Similarity Score</th></tr>"
+            file_index += 1
+            for score in scores:
+                citations += f"<tr><td>{chunk_index}</td><td>{score}</td></tr>"
+                chunk_index += 1
+            citations += "</table><br>"
+
+        # Send Citations to chat.
+        st.markdown(citations, unsafe_allow_html=True)
+
+    else:
+        st.write(f"Caution : The answer to the question is not available in the context retrieved. AI Math Assistant is using its own knowledge to generate the response . Please verify the response.")
+        # Allow LLM to generate the response in case the answer is not available in the context retrieved.
+        format_response_latex(chatbot_response)
        
+def get_query_filters():
+    """
+    Returns the metadata filters selected in the settings as the API expects them, or None without any.
+    """
+    filters = {
+        "file_name": st.session_state["filter_files"] or None,
+        "file_type": st.session_state["filter_file_types"] or None,
+        "page_from": st.session_state["filter_page_from"] or None,
+        "page_to": st.session_state["filter_page_to"] or None,
+    }
+    return filters if any(value is not None for value in filters.values()) else None
+
 def chatbox():
     """
     Function to setup chatbox in Streamlit frontent.
@@ -82,70 +221,26 @@ def chatbox():
             st.markdown(prompt) 
         
         top_k = st.session_state["top_k"] # Retrieve top k value from session state
+        response_mode = st.session_state["chat_mode"] # Retrieve response mode from session state
+        nprobe = st.session_state["nprobe"] # Retrieve the number of IVF lists to search from session state
+        collection = st.session_state["query_collections"] or None # Retrieve the collections to search from session state
+        filters = get_query_filters() # Retrieve the metadata filters from session state
         
         with st.chat_message("assistant"):
+            answer_placeholder = st.empty()
             with st.spinner("Processing..."):
-                # Call the FastAPI backend to get the response with user prompt and top k values.
-                response = call_fastapi_backend(prompt, top_k)
-                # response = context_chat(
-                #      prompt=prompt, query_engine=st.session_state["query_engine"]
-                # )  
+                # Call the FastAPI streaming backend with user prompt and top k values.
+                # The spinner only covers retrieval, tokens are rendered as soon as they arrive.
+                response = call_fastapi_backend(prompt, top_k, response_mode, stream=True, nprobe=nprobe, collection=collection, filters=filters)
         
-        logs.log.info(f"Response from FastAPI backend is {response}")
+            logs.log.info(f"Response from FastAPI backend is {response}")
+            
+            if response:
+                chatbot_response, retrieved_nodes = stream_answer(response, answer_placeholder)
         
         if response:
             
-            response_json = response.json()
-            chatbot_response = response_json.get("response", "")
-            retrieved_nodes = response_json.get("nodes")
-                    
-            # Retrieve the nodes from the query engine based on the user input.       
-            logs.log.info(f"retrieved_nodes total is {len(retrieved_nodes)}")
-            
-            # Extract filename and scores from retrieved chunks and create a dictionary for unique file names
-            file_scores_dict = {}
-            retrieval_scores = [] # List to store similarity scores of all chunks
-            for node in retrieved_nodes:
-                file_name = node.get("node", {}).get("extra_info", {}).get("file_name", "N/A")
-                logs.log.info(f"File name is {file_name}")
-                
-                score = round(node.get('score', 0), 3)
-                if file_name not in file_scores_dict:
-                    file_scores_dict[file_name] = []
-                    file_scores_dict[file_name].append(score)
-                else: 
-                    file_scores_dict[file_name].append(score)
-
-                retrieval_scores.append(score)
-            
-            # RAG Math Enhacement 2 : Add a similarity score threshold to caition the user if the answer is not available in the context retrieved.
-            
-            similarity_score_threshold  = 0.55 # This threshold can be adjusted based on the requirement. Currently set to 0.55 based on testing . 
-            if any(score > similarity_score_threshold for score in retrieval_scores):                
-                
-                # Render response in latex and markdown language .
-                format_response_latex(chatbot_response)
-                citations = "<br>Citations:<br>"     
-            
-                # Display document from which data is retrieved along with scores
-                chunk_index = 1
-                file_index = 1
-                for file_name, scores in file_scores_dict.items():
-                    citations += f"<h6>{file_index}. Filename: {file_name}<h6><br>"
-                    citations += "<table><tr><th>Chunk</th><th>Similarity Score</th></tr>"
-                    file_index += 1
-                    for score in scores:
-                        citations += f"<tr><td>{chunk_index}</td><td>{score}</td></tr>"
-                        chunk_index += 1
-                    citations += "</table><br>"
-
-                # Send Citations to chat.
-                st.markdown(citations, unsafe_allow_html=True)
-
-            else:
-                st.write(f"Caution : The answer to the question is not available in the context retrieved. AI Math Assistant is using its own knowledge to generate the response . Please verify the response.")
-                # Allow LLM to generate the response in case the answer is not available in the context retrieved.
-                format_response_latex(chatbot_response)
+            render_answer(chatbot_response, retrieved_nodes)
                 
             # Add the final response to messages state
             st.session_state["messages"].append({"role": "assistant", "content": chatbot_response})
\ No newline at end of file
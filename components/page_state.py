@@ -195,3 +195,71 @@ def set_initial_state():
 
     if "chunk_overlap" not in st.session_state:
         st.session_state["chunk_overlap"] = 200
+
+    # Approximate search : an IVF index is built at ingestion and nprobe of its lists are searched per query
+    if "ivf_enabled" not in st.session_state:
+        st.session_state["ivf_enabled"] = False
+
+    if "ivf_lists" not in st.session_state:
+        st.session_state["ivf_lists"] = 0
+
+    if "nprobe" not in st.session_state:
+        st.session_state["nprobe"] = 8
+
+    # Store an int8 copy of the embeddings, searched first and re-ranked in float32
+    if "quantize_embeddings" not in st.session_state:
+        st.session_state["quantize_embeddings"] = False
+
+    # Split the index into shards searched in parallel : "none", "document" or "count"
+    if "shard_by" not in st.session_state:
+        st.session_state["shard_by"] = "none"
+
+    if "shard_size" not in st.session_state:
+        st.session_state["shard_size"] = 50000
+
+    # Uploaded files are parsed by parse_workers processes (0 = one per CPU core), each file within parse_timeout seconds
+    if "parse_workers" not in st.session_state:
+        st.session_state["parse_workers"] = 0
+
+    if "parse_timeout" not in st.session_state:
+        st.session_state["parse_timeout"] = 300
+
+    # Uploaded files are parsed, embedded and persisted ingest_batch_files at a time, bounding memory use
+    if "ingest_batch_files" not in st.session_state:
+        st.session_state["ingest_batch_files"] = 16
+
+    # Chunks are embedded in batches of similar length of up to embed_batch_tokens padded tokens, on embed_threads
+    # CPU threads (0 = one per core)
+    if "embed_batch_tokens" not in st.session_state:
+        st.session_state["embed_batch_tokens"] = 16384
+
+    if "embed_threads" not in st.session_state:
+        st.session_state["embed_threads"] = 0
+
+    # Runs the embedding model with PyTorch, or its ONNX export on ONNX Runtime : "torch", "onnx" or "onnx-int8"
+    if "embedding_backend" not in st.session_state:
+        st.session_state["embedding_backend"] = "torch"
+
+    # Chunks are embedded by embed_workers processes during ingestion, each with its own copy of the model (1 = in-process)
+    if "embed_workers" not in st.session_state:
+        st.session_state["embed_workers"] = 1
+
+    # Collection uploaded files are indexed into, and collections searched by chat (empty for the default one)
+    if "collection" not in st.session_state:
+        st.session_state["collection"] = "default"
+
+    if "query_collections" not in st.session_state:
+        st.session_state["query_collections"] = []
+
+    # Metadata filters of chat retrieval : files, MIME types and PDF page range (0 for no bound)
+    if "filter_files" not in st.session_state:
+        st.session_state["filter_files"] = []
+
+    if "filter_file_types" not in st.session_state:
+        st.session_state["filter_file_types"] = []
+
+    if "filter_page_from" not in st.session_state:
+        st.session_state["filter_page_from"] = 0
+
+    if "filter_page_to" not in st.session_state:
+        st.session_state["filter_page_to"] = 0
@@ -24,6 +24,13 @@ supported_files = (
 
 
 def local_files():
+    # Files are indexed into the selected collection, queries can then be routed to it
+    st.text_input(
+        "Collection",
+        key="collection",
+        help="The collection uploaded files are indexed into. Each collection is persisted and searched on its own, `default` is the one searched when a query names no collection.",
+    )
+
     # Force users to confirm Settings before uploading files
     if st.session_state["selected_model"] is not None:
         uploaded_files = st.file_uploader(
@@ -54,3 +61,45 @@ def local_files():
                 st.exception(error)
             else:
                 st.write("Your files are ready. Let's chat! 😎") # TODO: This should be a button.
+    elif st.session_state["selected_model"] is not None:
+        # Files of an ingestion that was interrupted are still in data/, the batches committed before are kept
+        pending = rag.interrupted_files()
+        if len(pending) > 0:
+            st.info(f"{len(pending):,} files of an interrupted ingestion were not indexed yet.")
+            if st.button("Resume Ingestion"):
+                with st.spinner("Processing..."):
+                    error = rag.rag_pipeline()
+                    if error is not None:
+                        st.exception(error)
+                    else:
+                        st.write("Your files are ready. Let's chat! 😎")
+
+    indexed_files()
+
+
+def indexed_files():
+    # Files in the persisted index, each can be removed without re-indexing the others
+    try:
+        files = rag.list_indexed_files()
+    except Exception as err:
+        st.warning(str(err), icon="⚠️")
+        return
+    if len(files) == 0:
+        return
+
+    with st.expander(f"Indexed Files ({len(files):,})"):
+        for file_name, entry in sorted(files.items()):
+            name_column, remove_column = st.columns([4, 1])
+            if entry.get("duplicate_of"):
+                name_column.write(f"{file_name} (identical to {entry['duplicate_of']})")
+            else:
+                name_column.write(f"{file_name} ({entry['node_count']:,} chunks)")
+            if remove_column.button("Remove", key=f"remove_{file_name}"):
+                with st.spinner(f"Removing {file_name}..."):
+                    try:
+                        rag.remove_indexed_file(file_name)
+                    except Exception as err:
+                        logs.log.error(f"Unable to remove {file_name} from the index: {err}")
+                        st.exception(err)
+                        return
+                st.rerun()
@@ -1,12 +1,31 @@
+import os
 import json
+import mimetypes
 
 import streamlit as st
 
 import utils.ollama_utility as ollama_utility
 
+from utils.document_manifest import read_document_manifest
+from utils.index_collections import DEFAULT_COLLECTION, collection_dir, list_collections
+
 from datetime import datetime
 
 
+def searchable_files():
+    """
+    Returns the names of the files indexed in the collections searched by chat.
+    """
+    persist_dir = os.path.join(os.getcwd(), "vector_db")
+    file_names = set()
+    for name in st.session_state["query_collections"] or [DEFAULT_COLLECTION]:
+        manifest = read_document_manifest(collection_dir(persist_dir, name))
+        if manifest:
+            file_names.update(os.path.basename(source) for source in manifest["files"])
+    # Selected files stay listed, Streamlit rejects a default value missing from the options
+    return sorted(file_names | set(st.session_state["filter_files"]))
+
+
 def settings():
     st.header("Settings")
     st.caption("Configure Local RAG settings and integrations")
@@ -39,6 +58,45 @@ def settings():
                 value=st.session_state["top_k"],
                 key="top_k",
             )
+            st.select_slider(
+                "IVF nprobe",
+                options=[1, 2, 4, 8, 16, 32, 64, 128],
+                help="The number of IVF lists searched per query when the index was built with an IVF index. Higher values find more of the exact top-k results but take longer. See `benchmarks/ivf_benchmark.py` for the recall of each value.",
+                value=st.session_state["nprobe"],
+                key="nprobe",
+                disabled=not st.session_state["ivf_enabled"],
+            )
+            st.multiselect(
+                "Collections",
+                list_collections(os.path.join(os.getcwd(), "vector_db")),
+                help="The collections searched for every question. Leave empty to search the default collection.",
+                key="query_collections",
+            )
+            indexed_files = searchable_files()
+            st.multiselect(
+                "Files",
+                indexed_files,
+                help="Only retrieve chunks from these files. Leave empty to search every file.",
+                key="filter_files",
+            )
+            st.multiselect(
+                "Document Types",
+                sorted({mimetypes.guess_type(name)[0] for name in indexed_files} - {None} | set(st.session_state["filter_file_types"])),
+                help="Only retrieve chunks from files of these types. Leave empty to search every type.",
+                key="filter_file_types",
+            )
+            st.number_input(
+                "From Page",
+                help="Only retrieve chunks from this PDF page on. 0 for no lower bound.",
+                min_value=0,
+                key="filter_page_from",
+            )
+            st.number_input(
+                "To Page",
+                help="Only retrieve chunks up to this PDF page. 0 for no upper bound.",
+                min_value=0,
+                key="filter_page_to",
+            )
             # st.text_area(
             #     "System Prompt",
             #     value=st.session_state["system_prompt"],
@@ -99,6 +157,84 @@ def settings():
                 placeholder="200",
                 value=st.session_state["chunk_overlap"],
             )
+            st.toggle(
+                "Build IVF Index",
+                help="Clusters the embeddings into inverted lists at the end of indexing, so queries only search the closest `nprobe` lists instead of every chunk. Useful for large libraries, exact search is fast enough for a few thousand chunks.",
+                key="ivf_enabled",
+            )
+            st.number_input(
+                "IVF Lists",
+                help="The number of inverted lists. 0 uses the square root of the number of chunks.",
+                min_value=0,
+                step=16,
+                key="ivf_lists",
+                disabled=not st.session_state["ivf_enabled"],
+            )
+            st.toggle(
+                "Quantize Embeddings (int8)",
+                help="Stores an int8 copy of the embeddings, 4x smaller than float32. Queries scan the int8 copy and only re-score a shortlist in full precision. Run `benchmarks/quantization_eval.py` to measure the recall loss on your index.",
+                key="quantize_embeddings",
+            )
+            st.selectbox(
+                "Index Sharding",
+                ("none", "document", "count"),
+                format_func={"none": "None", "document": "One shard per document", "count": "Fixed size shards"}.get,
+                help="Splits the index into shards persisted separately and searched in parallel by the API on all CPU cores. Only the shards that changed are written when documents are added.",
+                key="shard_by",
+            )
+            st.number_input(
+                "Shard Size",
+                help="The number of chunks per shard with fixed size shards.",
+                min_value=1000,
+                step=1000,
+                key="shard_size",
+                disabled=st.session_state["shard_by"] != "count",
+            )
+            st.number_input(
+                "Parsing Workers",
+                help="The number of processes parsing uploaded files in parallel. 0 uses one per CPU core, 1 parses in the app process without timeouts.",
+                min_value=0,
+                key="parse_workers",
+            )
+            st.number_input(
+                "Parse Timeout (s)",
+                help="A file taking longer than this to parse (e.g. a corrupt or very large PDF) is skipped and the other files carry on. 0 for no limit.",
+                min_value=0,
+                step=60,
+                key="parse_timeout",
+            )
+            st.number_input(
+                "Ingestion Batch Size",
+                help="The number of files parsed, embedded and saved to the index together. Only one batch is held in memory, and an interrupted ingestion resumes after the last saved batch.",
+                min_value=1,
+                key="ingest_batch_files",
+            )
+            st.number_input(
+                "Embedding Batch Tokens",
+                help="Chunks are embedded in batches of similar length, each batch holding up to this many tokens including padding. Larger batches are faster on GPU and use more memory. Run `benchmarks/embedding_batching_benchmark.py` to compare settings.",
+                min_value=512,
+                step=1024,
+                key="embed_batch_tokens",
+            )
+            st.number_input(
+                "Embedding Workers",
+                help="The number of processes embedding uploaded files in parallel on the CPU. Each worker loads its own copy of the model (about 1.3 GB for bge-large), so use it on machines with many cores and enough memory. 1 embeds in the app process.",
+                min_value=1,
+                key="embed_workers",
+            )
+            st.number_input(
+                "Embedding Threads",
+                help="The number of CPU threads computing embeddings, per worker with several workers. 0 uses one per CPU core, shared between the workers.",
+                min_value=0,
+                key="embed_threads",
+            )
+            st.selectbox(
+                "Embedding Backend",
+                ("torch", "onnx", "onnx-int8"),
+                format_func={"torch": "PyTorch", "onnx": "ONNX Runtime (CPU)", "onnx-int8": "ONNX Runtime, int8 weights (CPU)"}.get,
+                help="Runs the embedding model with PyTorch, or exports it once to ONNX (cached in `cache/onnx`) and runs it on ONNX Runtime, faster on CPU-only machines. The int8 export is faster still at a small cosine drift, run `benchmarks/embedding_backend_eval.py` to measure it. Requires `optimum[onnxruntime]`. Embeddings of all backends can be searched in the same index.",
+                key="embedding_backend",
+            )
 
     st.subheader("Export Data")
     export_data_settings = st.container(border=True)
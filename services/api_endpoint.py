@@ -1,21 +1,199 @@
 # fastapi_server.py
 
 from fastapi import FastAPI, HTTPException
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
 from pydantic import BaseModel
+from typing import Optional, Union
 import utils.logs as logs
 from utils.ollama_utility import create_ollama_llm
 import uvicorn
-from llama_index.core import StorageContext, load_index_from_storage, Settings
+from llama_index.core import StorageContext, load_index_from_storage, Settings, get_response_synthesizer
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import FilterOperator, MetadataFilter, MetadataFilters, VectorStoreQuery
 import os
 import json
+import asyncio
+import hashlib
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import numpy as np
 import utils.llama_index as llama_index
+from utils.index_manifest import get_index_version
+from utils.vector_search import build_embedding_matrix, normalize_rows, top_k_similarities
+from utils.answer_cache import AnswerCache
+from utils.embedding_batching import DEFAULT_BATCH_TOKENS
+from utils.index_compaction import compact_index
+from utils.index_lock import IndexBusyError
+from utils.sharded_vector_store import load_vector_store, shutdown_shard_pool
+from utils.index_collections import (DEFAULT_COLLECTION, COLLECTIONS_DIR, CollectionCache, LoadedCollection,
+                                     MultiCollectionRetriever, collection_dir, directory_size, list_collections,
+                                     validate_collection_name)
 
-app = FastAPI()
+# Directory the Streamlit app persists the vector index to, named collections are in its collections/ folder
+PERSIST_DIR = os.path.join(os.getcwd(), "vector_db")
+
+# Configuration shared with the Streamlit app
+CONFIG_PATH = os.path.join(os.getcwd(), "config" , "config.json")
+
+# Maximum number of query engines kept alive per collection, one per (top_k, response_mode, streaming, nprobe) combination
+QUERY_ENGINE_CACHE_SIZE = 8
+
+def load_config():
+    
+    '''
+    
+    Function to read the configuration from config/config.json.
+    
+    '''
+    
+    try:
+        with open(CONFIG_PATH, "r") as config_file:
+            config = json.load(config_file)
+            logs.log.info("Configuration successfully loaded from config.json")
+            return config
+    except Exception as e:
+        logs.log.error(f"Error loading configuration from config.json: {e}")
+        raise HTTPException(status_code=500, detail="Error loading configuration from config.json")
+
+class QueryLimiter:
+    
+    '''
+    
+    Class to bound the number of queries running against Ollama and the number of
+    requests waiting for a free slot. Requests beyond the wait queue are rejected
+    with 429 and a Retry-After header instead of piling up behind the event loop.
+    
+    '''
+    
+    def __init__(self, max_concurrent, max_queued, retry_after):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.retry_after = retry_after
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        
+    def check(self):
+        if self._semaphore.locked() and self.waiting >= self.max_queued:
+            logs.log.warning(f"Query queue is full ({self.waiting} waiting), rejecting request")
+            raise HTTPException(status_code=429,
+                                detail="Too many queries in progress, please retry later",
+                                headers={"Retry-After": str(self.retry_after)})
+        
+    async def acquire(self, admitted=False):
+        # Requests admitted as a whole (a batch) wait for a slot per item without being rejected
+        if not admitted:
+            self.check()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            
+    def release(self):
+        self._semaphore.release()
+        
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+def create_query_limiter():
+    
+    '''
+    
+    Function to create the query limiter and the executor running blocking query calls,
+    sized from config.json (max_concurrent_queries, max_queued_queries, query_retry_after).
+    
+    '''
+    
+    try:
+        config = load_config()
+    except HTTPException:
+        config = {}
+    max_concurrent = int(config.get("max_concurrent_queries", 2))
+    limiter = QueryLimiter(max_concurrent,
+                           int(config.get("max_queued_queries", 8)),
+                           int(config.get("query_retry_after", 5)))
+    executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="math-query")
+    return limiter, executor
+
+@asynccontextmanager
+async def lifespan(app):
+    
+    '''
+    
+    Startup phase of the FastAPI app. Configuration, embedding model, vector index and
+    Ollama LLM are loaded and warmed up in the background, so /healthz answers right away
+    while /readyz only reports ready once the first query will not pay the warm-up cost.
+    
+    '''
+    
+    loop = asyncio.get_running_loop()
+    warm_up_task = loop.run_in_executor(None, warm_up)
+    watch_task = asyncio.create_task(watch_index_manifest(warm_up_task))
+    yield
+    watch_task.cancel()
+    if not warm_up_task.done():
+        logs.log.info("Shutting down before warm-up completed")
+    app.state.query_executor.shutdown(wait=False, cancel_futures=True)
+    shutdown_shard_pool()
+
+app = FastAPI(lifespan=lifespan)
 # Allow CORS for local testing
 
+def create_answer_cache():
+    
+    '''
+    
+    Function to create the answer cache, sized from config.json (answer_cache_size,
+    answer_cache_ttl in seconds and answer_cache_similarity for near-duplicate prompts).
+    
+    '''
+    
+    try:
+        config = load_config()
+    except HTTPException:
+        config = {}
+    return AnswerCache(max_entries=int(config.get("answer_cache_size", 256)),
+                       ttl=float(config.get("answer_cache_ttl", 3600)),
+                       similarity_threshold=float(config.get("answer_cache_similarity", 0.98)))
+
+def create_collection_cache():
+    
+    '''
+    
+    Function to create the cache of loaded collections, sized from config.json
+    (max_loaded_collections and collection_memory_mb, 0 for no limit).
+    
+    '''
+    
+    try:
+        config = load_config()
+    except HTTPException:
+        config = {}
+    # load_collection is defined below, it is only called once requests arrive
+    return CollectionCache(lambda name: load_collection(name),
+                           max_loaded=int(config.get("max_loaded_collections", 4)),
+                           max_memory_mb=float(config.get("collection_memory_mb", 0)))
+
 # Initialize app state variables
-app.state.query_engine_RAG = None # Query engine for RAG
+app.state.ready = False # Set once the index is loaded and the models are warmed up
+app.state.warm_up_error = None # Reason the last warm-up failed, reported by /readyz
+app.state.models_loaded = False # Set once the LLM and embedding model are set up
+app.state.collections = create_collection_cache() # Collections loaded on first use, shared by all requests
+app.state.query_engines_lock = threading.Lock() # Guards the query engines and embedding matrix of every collection
+app.state.setup_lock = threading.Lock() # Guards the one-time setup when several requests arrive together
+app.state.query_limiter, app.state.query_executor = create_query_limiter()
+app.state.answer_cache = create_answer_cache()
+app.state.config_fingerprint = None # (config.json mtime, settings the cached answers depend on)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,6 +203,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class QueryFilters(BaseModel):
+    
+    '''
+    
+    Class to define the metadata filters restricting the chunks a query retrieves from
+    
+    '''
+
+    file_name: Optional[Union[str, list[str]]] = None # File(s) the chunks come from
+    file_type: Optional[Union[str, list[str]]] = None # MIME type(s) of those files, e.g. application/pdf
+    page_from: Optional[int] = None # First PDF page, inclusive
+    page_to: Optional[int] = None # Last PDF page, inclusive
+
 class QueryRequest(BaseModel):
     
     '''
@@ -35,6 +226,35 @@ class QueryRequest(BaseModel):
 
     prompt: str
     top_k_param: int
+    response_mode: str = "compact"
+    nprobe: Optional[int] = None # IVF lists searched, None uses ivf_nprobe from config.json, 0 forces exact search
+    collection: Optional[Union[str, list[str]]] = None # Collection(s) searched, None for the default collection
+    filters: Optional[QueryFilters] = None # Only retrieve chunks matching every filter given
+
+class BatchQueryRequest(BaseModel):
+    
+    '''
+    
+    Class to define the request parameters from a batch of queries
+    
+    '''
+
+    prompts: list[str]
+    top_k_param: int
+    response_mode: str = "compact"
+    nprobe: Optional[int] = None
+    collection: Optional[Union[str, list[str]]] = None
+    filters: Optional[QueryFilters] = None
+
+class CompactRequest(BaseModel):
+    
+    '''
+    
+    Class to define the request parameters of an index compaction
+    
+    '''
+
+    collection: str = DEFAULT_COLLECTION
     
 def setup_ollama_llm(ollama_model, ollama_endpoint, system_prompt):
     
@@ -57,7 +277,7 @@ def setup_ollama_llm(ollama_model, ollama_endpoint, system_prompt):
         logs.log.error(f"Setting up Ollama LLM failed: {str(err)}")
         raise Exception(f"Setting up Ollama LLM failed: {str(err)}")
 
-def setup_embedding_model(embedding_model):
+def setup_embedding_model(embedding_model, batch_tokens=DEFAULT_BATCH_TOKENS, threads=0, backend="torch"):
     
     '''
     
@@ -66,19 +286,25 @@ def setup_embedding_model(embedding_model):
     args:
     
     hf_embedding_model : str : The name of the embedding set in UI .
+    batch_tokens : int : The padded tokens per embedding batch.
+    threads : int : The number of CPU threads used to embed, 0 for one per core.
+    backend : str : "torch", "onnx" or "onnx-int8" (ONNX Runtime on the CPU).
     
     '''
        
     try:
         Settings.embed_model = llama_index.setup_embedding_model(
             embedding_model,
+            batch_tokens=batch_tokens,
+            threads=threads,
+            backend=backend,
         )
         
     except Exception as err:
         logs.log.error(f"Setting up Embedding Model failed: {str(err)}")
         raise Exception(f"Setting up Embedding Model failed: {str(err)}")
         
-def create_query_engine(index, top_k):
+def create_query_engine(index, top_k, response_mode="compact", streaming=False, nprobe=None, filters=None):
      
     '''
     Function to create a llama index query engine.
@@ -87,30 +313,43 @@ def create_query_engine(index, top_k):
     
     index : The llama index object.
     top_k : int : Retrieve top_k text chunks from the vector index.
+    response_mode : str : The llama index response mode used to synthesize the answer.
+    streaming : bool : Return a streaming response that yields tokens as they are generated.
+    nprobe : int : The number of IVF lists the vector store searches, None for exact search.
+    filters : MetadataFilters : Restrict retrieval to the chunks matching these metadata filters, None for every chunk.
     
     ''' 
       
     try:
         query_engine = index.as_query_engine(
             similarity_top_k=top_k,
-            response_mode="compact",
-            streaming=False,  # Set streaming to False
+            response_mode=response_mode,
+            streaming=streaming,
+            vector_store_kwargs={"nprobe": nprobe} if nprobe else {},
+            filters=filters,
         )
         return query_engine
     except Exception as e:
         logs.log.error(f"Error creating query engine: {e}")
         raise Exception(f"Error creating query engine: {e}")
 
-def load_index(top_k_param):
+def load_index(persist_dir=PERSIST_DIR):
     
     '''
-    Function to load the vector index from vector_db 
+    Function to load the vector index from vector_db, or from the directory of a collection
     
     '''
       
     # Load search index from storage
     try:            
-        storage_context = StorageContext.from_defaults(persist_dir=os.getcwd() + "/vector_db")            
+        # The embeddings are memory-mapped instead of parsed from JSON, so loading time does not grow with the index.
+        # A sharded index is searched on a pool of shard_workers processes (0 = one per CPU core).
+        try:
+            shard_workers = int(load_config().get("shard_workers", 0))
+        except HTTPException:
+            shard_workers = 0
+        storage_context = StorageContext.from_defaults(persist_dir=persist_dir,
+                                                       vector_store=load_vector_store(persist_dir, max_workers=shard_workers))            
         logs.log.info("Index successfully loaded from storage.")
             
     except Exception as e:
@@ -119,67 +358,483 @@ def load_index(top_k_param):
         logs.log.error(f"error: {err}")
         raise HTTPException(status_code=500, detail=err)
     
-    # Load the index from the storage context and create a query engine :   
+    # Load the index from the storage context :   
     
     try:
         index = load_index_from_storage(storage_context)    
-        query_engine_RAG = create_query_engine(index,top_k_param)
-        return query_engine_RAG
+        return index
     except Exception as e:
-        logs.log.error(f"Error creating query engine: {e}")
-        raise HTTPException(status_code=500, detail="Error creating query engine")
+        logs.log.error(f"Error loading index from storage: {e}")
+        raise HTTPException(status_code=500, detail="Error loading index from storage")
+
+def load_collection(name):
+    
+    '''
+    Function to load a collection and the manifest version it was persisted at.
+    
+    args:
+    
+    name : str : The collection name, DEFAULT_COLLECTION for the index at the root of vector_db.
+    
+    '''
+    
+    persist_dir = collection_dir(PERSIST_DIR, name)
+    if not os.path.exists(os.path.join(persist_dir, "docstore.json")):
+        raise HTTPException(status_code=404, detail=f"Collection {name} not found, please index documents into it from Math Reasoning RAG app")
+    # The version is read before loading so a persist racing with the load is picked up by the watcher
+    version = get_index_version(persist_dir)
+    index = load_index(persist_dir)
+    memory = directory_size(persist_dir, skip=os.path.join(PERSIST_DIR, COLLECTIONS_DIR))
+    logs.log.info(f"Collection {name} loaded ({memory / 2**20:,.1f} MB on disk)")
+    return LoadedCollection(name, index, version, memory)
+
+def resolve_collections(collection):
+    
+    '''
+    
+    Function to return the names of the collections a request searches, without duplicates.
+    Requests without a collection search the default collection.
+    
+    '''
+    
+    if collection is None:
+        return [DEFAULT_COLLECTION]
+    names = [collection] if isinstance(collection, str) else list(dict.fromkeys(collection))
+    if len(names) == 0:
+        return [DEFAULT_COLLECTION]
+    try:
+        return [validate_collection_name(name) for name in names]
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def get_collections(collection):
+    
+    '''
+    
+    Function to return the loaded collections of a request, loading the ones not in memory.
+    
+    '''
+    
+    names = resolve_collections(collection)
+    loop = asyncio.get_running_loop()
+    return [await loop.run_in_executor(None, app.state.collections.get, name) for name in names]
+
+def resolve_nprobe(nprobe, collections):
+    
+    '''
+    
+    Function to return the number of IVF lists to search for a request, or None for exact search.
+    Requests without nprobe use ivf_nprobe from config.json. nprobe only applies when one of the
+    searched collections was built with an IVF index.
+    
+    '''
+    
+    if not any(getattr(collection.index.vector_store, "ivf_lists", 0) for collection in collections):
+        return None
+    if nprobe is None:
+        try:
+            nprobe = load_config().get("ivf_nprobe")
+        except HTTPException:
+            nprobe = None
+    return int(nprobe) if nprobe else None
+
+def resolve_filters(filters):
+    
+    '''
+    
+    Function to convert the metadata filters of a request to llama index MetadataFilters, along
+    with the hashable key the query engines and cached answers are stored under.
+    Returns (None, None) when the request does not filter.
+    
+    args:
+    
+    filters : QueryFilters : The filters of the request, None to search every chunk.
+    
+    '''
+    
+    if filters is None:
+        return None, None
+    if filters.page_from is not None and filters.page_to is not None and filters.page_from > filters.page_to:
+        raise HTTPException(status_code=400, detail="page_from must not be greater than page_to")
+    
+    metadata_filters, key = [], []
+    for name in ("file_name", "file_type"):
+        value = getattr(filters, name)
+        if not value:
+            continue
+        values = [value] if isinstance(value, str) else sorted(set(value))
+        metadata_filters.append(MetadataFilter(key=name, value=values, operator=FilterOperator.IN))
+        key.append((name, tuple(values)))
+    # PDF readers store the page number as a string label, the vector store compares it as a number
+    if filters.page_from is not None:
+        metadata_filters.append(MetadataFilter(key="page_label", value=filters.page_from, operator=FilterOperator.GTE))
+        key.append(("page_from", filters.page_from))
+    if filters.page_to is not None:
+        metadata_filters.append(MetadataFilter(key="page_label", value=filters.page_to, operator=FilterOperator.LTE))
+        key.append(("page_to", filters.page_to))
+    if not metadata_filters:
+        return None, None
+    return MetadataFilters(filters=metadata_filters), tuple(key)
+
+def get_query_engine(collections, top_k, response_mode, streaming=False, nprobe=None, filters=None, filters_key=None):
+    
+    '''
+    Function to return a query engine for the requested collections, top_k and response mode.
+    
+    Engines are built on the shared index of a collection and kept in a small LRU cache per
+    collection, so varying top_k between requests never reloads the index from storage.
+    Several collections are searched by one retriever each, keeping the top_k chunks overall.
+    
+    args:
+    
+    collections : list[LoadedCollection] : The collections searched.
+    top_k : int : Retrieve top_k text chunks from the vector index.
+    response_mode : str : The llama index response mode used to synthesize the answer.
+    streaming : bool : Return an engine producing streaming responses.
+    nprobe : int : The number of IVF lists searched, None for exact search.
+    filters : MetadataFilters : The metadata filters of the request, None for every chunk.
+    filters_key : tuple : The hashable key of the filters, from resolve_filters.
+    
+    '''
+    
+    if len(collections) > 1:
+        vector_store_kwargs = {"nprobe": nprobe} if nprobe else {}
+        retriever = MultiCollectionRetriever([collection.index.as_retriever(similarity_top_k=top_k, vector_store_kwargs=vector_store_kwargs, filters=filters)
+                                              for collection in collections], top_k)
+        return RetrieverQueryEngine.from_args(retriever, response_mode=response_mode, streaming=streaming)
+    
+    collection = collections[0]
+    key = (top_k, response_mode, streaming, nprobe, filters_key)
+    with app.state.query_engines_lock:
+        query_engine = collection.query_engines.get(key)
+        if query_engine is not None:
+            collection.query_engines.move_to_end(key)
+            return query_engine
+        
+        try:
+            query_engine = create_query_engine(collection.index, top_k, response_mode, streaming, nprobe, filters)
+        except Exception:
+            raise HTTPException(status_code=500, detail="Error creating query engine")
+        
+        collection.query_engines[key] = query_engine
+        if len(collection.query_engines) > QUERY_ENGINE_CACHE_SIZE:
+            collection.query_engines.popitem(last=False)
+        logs.log.info(f"Query engine created for collection={collection.name}, top_k={top_k}, response_mode={response_mode}, streaming={streaming}, nprobe={nprobe}, filters={filters_key}")
+        return query_engine
         
-def initial_setup(top_k_param):
+def initial_setup():
     '''
     
-    Function to setup the ollana LLM model, embedding model and creating a query engine.
+    Function to setup the ollana LLM model, embedding model and load the default collection.
     
     '''
-    # Read configuration from config.json
-    config_path = os.path.join(os.getcwd(), "config" , "config.json")
+    with app.state.setup_lock:
+        if app.state.models_loaded:
+            return
+        
+        # Read configuration from config.json
+        config = load_config()
+
+        # Setup Ollama LLM and embedding model using the configuration
+        setup_ollama_llm(config["ollama_model"], config["ollama_endpoint"], config["system_prompt"])
+        setup_embedding_model(config.get("embedding_model"),
+                              batch_tokens=int(config.get("embed_batch_tokens", DEFAULT_BATCH_TOKENS)),
+                              threads=int(config.get("embed_threads", 0)),
+                              backend=config.get("embedding_backend", "torch"))
+        
+        # The default collection is loaded up front, other collections on their first query.
+        # Query engines are created per request parameters.
+        collections = list_collections(PERSIST_DIR)
+        if len(collections) == 0:
+            raise HTTPException(status_code=500, detail="No index found, please check if documents have been loaded and indexed form Math Reasoning RAG app")
+        app.state.collections.get(DEFAULT_COLLECTION if DEFAULT_COLLECTION in collections else collections[0])
+        app.state.models_loaded = True
+
+def reload_collection(name, version):
+    
+    '''
+    
+    Function to load a newly persisted collection and swap it in atomically.
+    
+    Queries already running keep the engine they started with, new queries use the
+    new index once the swap is done. Its engine cache is replaced in the same step.
+    
+    args:
+    
+    name : str : The collection to reload.
+    version : str : The manifest version of the index being loaded.
+    
+    '''
+    
+    logs.log.info(f"New version {version} of collection {name} detected, loading it in the background")
+    app.state.collections.put(load_collection(name))
+    logs.log.info(f"Swapped collection {name} to version {version}")
+
+async def watch_index_manifest(warm_up_task=None):
+    
+    '''
+    
+    Background task polling the index manifests written by the ingestion pipeline and
+    reloading every loaded collection whose version changed. The interval is read from
+    config.json (index_poll_interval, seconds).
+    
+    A failed warm-up (for example no documents were indexed when the service started) is
+    run again once a collection is persisted or updated, so /readyz reports ready without
+    waiting for a first query.
+    
+    args:
+    
+    warm_up_task : Future : The startup warm-up, not retried while it is still running.
+    
+    '''
+    
     try:
-        with open(config_path, "r") as config_file:
-            config = json.load(config_file)
-            logs.log.info("Configuration successfully loaded from config.json")
+        poll_interval = float(load_config().get("index_poll_interval", 10))
+    except HTTPException:
+        poll_interval = 10.0
+    loop = asyncio.get_running_loop()
+    failed_versions = {} # Not retried until a newer version is persisted
+    warm_up_versions = {} # Collection versions the last retried warm-up saw
+    
+    while True:
+        await asyncio.sleep(poll_interval)
+        if not app.state.ready and (warm_up_task is None or warm_up_task.done()):
+            versions = {name: get_index_version(collection_dir(PERSIST_DIR, name)) for name in list_collections(PERSIST_DIR)}
+            if versions and versions != warm_up_versions:
+                warm_up_versions = versions
+                logs.log.info(f"Collections {sorted(versions)} found, retrying the warm-up")
+                warm_up_task = loop.run_in_executor(None, warm_up)
+        # Collections not loaded yet are read at their latest version when first queried
+        for collection in app.state.collections.loaded():
+            version = get_index_version(collection_dir(PERSIST_DIR, collection.name))
+            if version is None or version in (collection.version, failed_versions.get(collection.name)):
+                continue
+            try:
+                await loop.run_in_executor(None, reload_collection, collection.name, version)
+            except Exception as e:
+                failed_versions[collection.name] = version
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                logs.log.error(f"Reloading version {version} of collection {collection.name} failed, still serving version {collection.version}: {detail}")
+
+def warm_up():
+    
+    '''
+    
+    Function to load everything a query needs and run one warm-up embedding and one
+    warm-up Ollama completion, so the model weights are resident before traffic arrives.
+    
+    '''
+    
+    try:
+        logs.log.info("Warming up the query service...")
+        initial_setup()
+        for collection in app.state.collections.loaded():
+            if hasattr(collection.index.vector_store, "warm_up"):
+                collection.index.vector_store.warm_up()
+                logs.log.info(f"Shard search processes warmed up for collection {collection.name}")
+        Settings.embed_model.get_query_embedding("warm-up")
+        logs.log.info("Embedding model warmed up")
+        Settings.llm.complete("Hello")
+        logs.log.info("Ollama LLM warmed up")
+        app.state.warm_up_error = None
+        app.state.ready = True
+        logs.log.info("Warm-up complete, query service is ready")
     except Exception as e:
-        logs.log.error(f"Error loading configuration from config.json: {e}")
-        raise HTTPException(status_code=500, detail="Error loading configuration from config.json")
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        app.state.warm_up_error = detail
+        logs.log.error(f"Warm-up failed, index will be loaded on the first query: {detail}")
+
+async def ensure_index_loaded():
+    
+    '''
+    
+    Function to load the index on the first query if the startup warm-up did not succeed,
+    for example when documents were indexed after the service started.
+    
+    '''
+    
+    if not app.state.models_loaded:
+        logs.log.info("Index is not available for processing the query. Setting up the index...")
+        await asyncio.get_running_loop().run_in_executor(None, initial_setup)
+        app.state.warm_up_error = None
+        app.state.ready = True
+        logs.log.info("Index is available for processing the query")
+        
+    else : 
+        logs.log.info("Index is available for processing the query")
+
+@app.get("/healthz")
+async def healthz():
+    
+    '''
+    
+    Liveness probe, answers as soon as the process is serving HTTP.
+    
+    '''
+    
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    
+    '''
+    
+    Readiness probe, answers 503 until the index is loaded and the models are warmed up.
+    
+    '''
+    
+    if app.state.ready:
+        return {"status": "ready"}
+    return JSONResponse(status_code=503, content={"status": "starting" if app.state.warm_up_error is None else "unavailable",
+                                                  "detail": app.state.warm_up_error})
+    
+def answer_cache_fingerprint():
+    
+    '''
+    
+    Function to return what cached answers depend on besides the request: the models, embedding
+    backend and system prompt in config.json (int8 query embeddings are not compared with the exact
+    ones of cached answers). config.json is only re-read when its modification time changes. The
+    versions of the searched collections are part of the cache parameters of every answer instead.
+    
+    '''
+    
+    try:
+        mtime = os.path.getmtime(CONFIG_PATH)
+    except OSError:
+        mtime = None
+    if app.state.config_fingerprint is None or app.state.config_fingerprint[0] != mtime:
+        config = load_config()
+        settings = (config.get("ollama_model"),
+                    config.get("embedding_model"),
+                    config.get("embedding_backend", "torch"),
+                    hashlib.sha256(str(config.get("system_prompt", "")).encode("utf-8")).hexdigest())
+        app.state.config_fingerprint = (mtime, settings)
+    return app.state.config_fingerprint[1]
 
-    # Setup Ollama LLM and embedding model using the configuration
-    setup_ollama_llm(config["ollama_model"], config["ollama_endpoint"], config["system_prompt"])
-    setup_embedding_model(config.get("embedding_model"))
+@app.get("/api/collections")
+async def collections_status():
+    
+    '''
+    
+    Lists the persisted collections and the ones currently loaded, with their approximate memory.
     
-    # Load the index from the storage context and create a query engine
-    app.state.query_engine_RAG = load_index(top_k_param)
+    '''
+    
+    loaded = {collection.name: collection for collection in app.state.collections.loaded()}
+    return {"collections": [{"name": name,
+                             "loaded": name in loaded,
+                             "version": loaded[name].version if name in loaded else None,
+                             "memory_mb": round(loaded[name].memory / 2**20, 1) if name in loaded else None}
+                            for name in list_collections(PERSIST_DIR)]}
+
+@app.post("/api/admin/compact")
+async def compact_collection(request: CompactRequest):
+    
+    '''
     
+    Rewrites a persisted collection without the chunks of removed files and other orphaned
+    entries, and reports its size on disk before and after. Queries keep being served from
+    the current files meanwhile; a loaded collection is swapped to the compacted index once
+    it is persisted.
+    
+    '''
+    
+    try:
+        name = validate_collection_name(request.collection)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    loop = asyncio.get_running_loop()
+    try:
+        report = await loop.run_in_executor(None, compact_index, collection_dir(PERSIST_DIR, name))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Collection {name} not found")
+    except IndexBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        logs.log.error(f"Error compacting collection {name}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error compacting collection {name}: {e}")
+    
+    # Swapped right away rather than on the next manifest poll, so the old files are released
+    if app.state.collections.peek(name) is not None:
+        version = get_index_version(collection_dir(PERSIST_DIR, name))
+        await loop.run_in_executor(None, reload_collection, name, version)
+    return {"collection": name, **report}
+
+@app.get("/api/cache/stats")
+async def answer_cache_stats():
+    
+    '''
+    
+    Returns the hit/miss metrics of the answer cache and of the query embedding cache.
+    
+    '''
+    
+    stats = {"answers": app.state.answer_cache.stats()}
+    if hasattr(Settings.embed_model, "query_cache_stats"):
+        stats["query_embeddings"] = Settings.embed_model.query_cache_stats()
+    return stats
+
 @app.post("/api/math-query")
 async def query_llamaindex(request: QueryRequest):
     
     logs.log.info(f"Received query request: {request.prompt}")
     logs.log.info(f"Top K parameter: {request.top_k_param}")
     
-    # Initial setup for creating a query engine if there is no query running instance available . 
-    if app.state.query_engine_RAG is None:
-        
-        logs.log.info("Query engine is not available for processing the query. Setting up the query engine...")
-        initial_setup(request.top_k_param)
-        logs.log.info("Query engine is available for processing the query")
-        
-    else : 
-        logs.log.info("Query engine is available for processing the query")
-    # Send the query to the query engine and retrieve the response
+    loop = asyncio.get_running_loop()
+    
+    # Initial setup for loading the index if there is no loaded instance available . 
+    await ensure_index_loaded()
+    collections = await get_collections(request.collection)
+    
+    # Answers are cached per request parameters and collection versions, first by normalized prompt then by query embedding
+    cache = app.state.answer_cache
+    nprobe = resolve_nprobe(request.nprobe, collections)
+    filters, filters_key = resolve_filters(request.filters)
+    cache_params = (request.top_k_param, request.response_mode, nprobe, filters_key, tuple((collection.name, collection.version) for collection in collections))
+    fingerprint = answer_cache_fingerprint()
+    cache.validate(fingerprint)
+    cached_answer = cache.get_exact(cache_params, request.prompt)
+    if cached_answer is not None:
+        logs.log.info("Answer served from cache (exact prompt match)")
+        return cached_answer
+    
+    query_engine = get_query_engine(collections, request.top_k_param, request.response_mode, nprobe=nprobe, filters=filters, filters_key=filters_key)
+    
+    # Send the query to the query engine and retrieve the response. The blocking call runs on the
+    # query executor behind the limiter so a slow Ollama generation never stalls the event loop.
+    # The prompt embedding used for the cache lookup is passed on, so retrieval does not embed it again.
+    
+    async with app.state.query_limiter:
+        try:
+            query_embedding = await loop.run_in_executor(app.state.query_executor, Settings.embed_model.get_query_embedding, request.prompt)
+            cached_answer = cache.get_similar(cache_params, request.prompt, query_embedding)
+            if cached_answer is None:
+                query_bundle = QueryBundle(query_str=request.prompt, embedding=query_embedding)
+                chatbot_response = await loop.run_in_executor(app.state.query_executor, query_engine.query, query_bundle)
+        except Exception as e:
+            logs.log.error(f"Error processing query: {e}")
+            raise HTTPException(status_code=500, detail="Error processing query")
+    
+    if cached_answer is not None:
+        logs.log.info("Answer served from cache (similar prompt)")
+        return cached_answer
     
     try:
-        chatbot_response = app.state.query_engine_RAG.query(request.prompt)
         if chatbot_response is None:
             logs.log.error(f"Error processing query: {request.prompt}")
             raise HTTPException(status_code=500, detail="Error processing query")
         
         else:
-            doc_nodes = app.state.query_engine_RAG.retrieve(request.prompt) 
+            # Citations are built from the nodes the synthesizer already used, so the
+            # prompt is embedded and searched only once per request.
+            doc_nodes = chatbot_response.source_nodes
             logs.log.info(f"Response from query engine: {chatbot_response.response}")
             if hasattr(chatbot_response, 'response') and len(doc_nodes) > 0:
-                return {"response": chatbot_response.response, "nodes": doc_nodes}
+                answer = {"response": chatbot_response.response, "nodes": jsonable_encoder(doc_nodes)}
+                cache.put(cache_params, request.prompt, query_embedding, answer, fingerprint)
+                return answer
             else:
                 logs.log.error("Response or source nodes missing in chatbot response")
                 raise HTTPException(status_code=500, detail="Response or source nodes missing in chatbot response")            
@@ -188,6 +843,243 @@ async def query_llamaindex(request: QueryRequest):
         logs.log.error(f"Error processing query: {e}")
         raise HTTPException(status_code=500, detail="Error processing query")  
     
+def format_sse_event(event, data):
+    
+    '''
+    
+    Function to format a server-sent event carrying a JSON payload.
+    
+    args:
+    
+    event : str : The event name (token, citations, error or done).
+    data : The JSON serializable payload of the event.
+    
+    '''
+    
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def cached_answer_events(answer):
+    
+    '''
+    
+    Function to replay a cached answer as server-sent events, in the same shape as a generated one.
+    
+    '''
+    
+    yield format_sse_event("token", {"token": answer["response"]})
+    yield format_sse_event("citations", {"nodes": answer["nodes"]})
+    yield format_sse_event("done", {})
+
+@app.post("/api/math-query/stream")
+async def stream_query_llamaindex(request: QueryRequest):
+    
+    '''
+    
+    Streams the answer token by token as server-sent events. Each token is sent as a
+    "token" event, the citation nodes as a final "citations" event followed by "done".
+    
+    '''
+    
+    logs.log.info(f"Received streaming query request: {request.prompt}")
+    logs.log.info(f"Top K parameter: {request.top_k_param}")
+    
+    loop = asyncio.get_running_loop()
+    
+    await ensure_index_loaded()
+    collections = await get_collections(request.collection)
+    
+    sse_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    cache = app.state.answer_cache
+    nprobe = resolve_nprobe(request.nprobe, collections)
+    filters, filters_key = resolve_filters(request.filters)
+    cache_params = (request.top_k_param, request.response_mode, nprobe, filters_key, tuple((collection.name, collection.version) for collection in collections))
+    fingerprint = answer_cache_fingerprint()
+    cache.validate(fingerprint)
+    cached_answer = cache.get_exact(cache_params, request.prompt)
+    if cached_answer is not None:
+        logs.log.info("Answer served from cache (exact prompt match)")
+        return StreamingResponse(cached_answer_events(cached_answer), media_type="text/event-stream", headers=sse_headers)
+    
+    query_engine = get_query_engine(collections, request.top_k_param, request.response_mode, streaming=True, nprobe=nprobe, filters=filters, filters_key=filters_key)
+    
+    # A full queue is rejected with 429 before the response starts. The query slot itself is taken inside
+    # the stream and held until the last token has been sent, since generation happens while streaming:
+    # it is released however the stream ends, and never taken if the response is not sent at all.
+    app.state.query_limiter.check()
+    
+    async def event_stream():
+        try:
+            async with app.state.query_limiter:
+                query_embedding = await loop.run_in_executor(app.state.query_executor, Settings.embed_model.get_query_embedding, request.prompt)
+                cached_answer = cache.get_similar(cache_params, request.prompt, query_embedding)
+                if cached_answer is not None:
+                    logs.log.info("Answer served from cache (similar prompt)")
+                    async for event in cached_answer_events(cached_answer):
+                        yield event
+                    return
+                
+                query_bundle = QueryBundle(query_str=request.prompt, embedding=query_embedding)
+                streaming_response = await loop.run_in_executor(app.state.query_executor, query_engine.query, query_bundle)
+                tokens = []
+                async for token in iterate_in_threadpool(streaming_response.response_gen):
+                    tokens.append(token)
+                    yield format_sse_event("token", {"token": token})
+                nodes = jsonable_encoder(streaming_response.source_nodes)
+                yield format_sse_event("citations", {"nodes": nodes})
+                yield format_sse_event("done", {})
+                if nodes:
+                    cache.put(cache_params, request.prompt, query_embedding, {"response": "".join(tokens), "nodes": nodes}, fingerprint)
+        except Exception as e:
+            logs.log.error(f"Error streaming query response: {e}")
+            yield format_sse_event("error", {"detail": "Error processing query"})
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=sse_headers)
+    
+def get_embedding_matrix(collection):
+    
+    '''
+    
+    Function to return the node ids and normalized embedding matrix of a loaded collection.
+    The matrix is built once per loaded collection and rebuilt after a hot reload.
+    
+    '''
+    
+    with app.state.query_engines_lock:
+        if collection.embedding_matrix is None:
+            collection.embedding_matrix = build_embedding_matrix(collection.index.vector_store)
+        return collection.embedding_matrix
+
+def retrieve_from_collection(collection, query_embeddings, top_k, nprobe=None, filters=None):
+    
+    '''
+    
+    Function to retrieve the top_k chunks of one collection for a batch of query embeddings.
+    
+    '''
+    
+    index = collection.index
+    if nprobe or filters is not None or getattr(index.vector_store, "quantized", False):
+        retrieved = []
+        for query_embedding in query_embeddings:
+            result = index.vector_store.query(VectorStoreQuery(query_embedding=query_embedding, similarity_top_k=top_k, filters=filters), nprobe=nprobe)
+            nodes = index.docstore.get_nodes(result.ids)
+            retrieved.append([NodeWithScore(node=node, score=score) for node, score in zip(nodes, result.similarities)])
+        return retrieved
+    
+    node_ids, matrix = get_embedding_matrix(collection)
+    query_matrix = normalize_rows(np.asarray(query_embeddings, dtype=np.float32))
+    indices, scores = top_k_similarities(query_matrix, matrix, top_k)
+    
+    retrieved = []
+    for row_indices, row_scores in zip(indices, scores):
+        nodes = index.docstore.get_nodes([node_ids[i] for i in row_indices])
+        retrieved.append([NodeWithScore(node=node, score=float(score)) for node, score in zip(nodes, row_scores)])
+    return retrieved
+
+def batch_retrieve(prompts, top_k, nprobe=None, collections=None, filters=None):
+    
+    '''
+    
+    Function to retrieve the top_k chunks for a batch of prompts. All prompts are embedded
+    in one batched call and scored against every chunk with one matrix product. When nprobe is
+    set, the request filters metadata or the embeddings are quantized, every prompt is searched by
+    the vector store instead, so only the nprobe closest IVF lists, the chunks matching the filters
+    or the int8 embeddings are scanned.
+    
+    args:
+    
+    prompts : list[str] : The prompts to retrieve chunks for.
+    top_k : int : Retrieve top_k text chunks from the vector index.
+    nprobe : int : The number of IVF lists searched, None for exact search.
+    collections : list[LoadedCollection] : The collections searched, the top_k chunks overall are kept.
+    filters : MetadataFilters : The metadata filters of the request, None for every chunk.
+    
+    '''
+    
+    query_embeddings = llama_index.embed_queries(Settings.embed_model, prompts)
+    per_collection = [retrieve_from_collection(collection, query_embeddings, top_k, nprobe, filters) for collection in collections]
+    if len(per_collection) == 1:
+        return per_collection[0]
+    return [heapq.nlargest(top_k, [node for nodes in prompt_nodes for node in nodes], key=lambda node: node.score or 0.0)
+            for prompt_nodes in zip(*per_collection)]
+
+def synthesize_answer(synthesizer, position, prompt, nodes):
+    
+    '''
+    
+    Function to generate the answer of one batch item from its retrieved chunks.
+    Errors are reported in the item instead of failing the whole batch.
+    
+    '''
+    
+    try:
+        response = synthesizer.synthesize(QueryBundle(query_str=prompt), nodes)
+        return {"index": position, "prompt": prompt, "response": response.response, "nodes": nodes}
+    except Exception as e:
+        logs.log.error(f"Error processing batch query {position}: {e}")
+        return {"index": position, "prompt": prompt, "error": "Error processing query", "nodes": nodes}
+
+@app.post("/api/math-query/batch")
+async def batch_query_llamaindex(request: BatchQueryRequest):
+    
+    '''
+    
+    Answers a batch of prompts. Retrieval for the whole batch is vectorized, then the LLM
+    calls run concurrently (batch_max_concurrency in config.json), each holding a query slot
+    shared with the other endpoints. Results are returned as newline delimited JSON in the
+    order they finish, each carrying the index of its prompt.
+    
+    '''
+    
+    logs.log.info(f"Received batch query request with {len(request.prompts)} prompts")
+    logs.log.info(f"Top K parameter: {request.top_k_param}")
+    
+    loop = asyncio.get_running_loop()
+    await ensure_index_loaded()
+    collections = await get_collections(request.collection)
+    filters, _ = resolve_filters(request.filters)
+    # A full query queue rejects the whole batch with 429 before it is retrieved
+    app.state.query_limiter.check()
+    
+    try:
+        retrieved = await loop.run_in_executor(None, batch_retrieve, request.prompts, request.top_k_param,
+                                               resolve_nprobe(request.nprobe, collections), collections, filters)
+    except Exception as e:
+        logs.log.error(f"Error retrieving batch queries: {e}")
+        raise HTTPException(status_code=500, detail="Error retrieving batch queries")
+    
+    try:
+        max_concurrency = int(load_config().get("batch_max_concurrency", 4))
+    except HTTPException:
+        max_concurrency = 4
+    synthesizer = get_response_synthesizer(response_mode=request.response_mode)
+    
+    # The LLM calls go through the query limiter and executor of the other endpoints, so a batch never runs
+    # more generations against Ollama than max_concurrent_queries. At most batch_max_concurrency prompts of
+    # the batch wait for a slot at once.
+    async def synthesize_with_limit(batch_slots, position, prompt, nodes):
+        async with batch_slots:
+            await app.state.query_limiter.acquire(admitted=True)
+            try:
+                return await loop.run_in_executor(app.state.query_executor, synthesize_answer, synthesizer, position, prompt, nodes)
+            finally:
+                app.state.query_limiter.release()
+    
+    async def result_stream():
+        batch_slots = asyncio.Semaphore(max_concurrency)
+        tasks = [asyncio.ensure_future(synthesize_with_limit(batch_slots, position, prompt, nodes))
+                 for position, (prompt, nodes) in enumerate(zip(request.prompts, retrieved))]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                yield json.dumps(jsonable_encoder(result)) + "\n"
+        finally:
+            # Prompts still waiting for a slot are dropped when the client goes away
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+    
 # Function to run FastAPI in a separate process
 def run_fastapi():
     logs.log.info("Starting FastAPI server...")
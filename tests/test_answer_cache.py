@@ -0,0 +1,42 @@
+from utils.answer_cache import AnswerCache, math_signature, normalize_prompt
+
+PARAMS = (3, "compact", None, None, (("default", "v1"),))
+
+# One embedding for every prompt, the worst case of prompts the embedding model cannot tell apart
+EMBEDDING = [0.6, 0.8, 0.0]
+
+
+def cache_with(prompt, answer):
+    cache = AnswerCache(similarity_threshold=0.98)
+    cache.validate("fingerprint")
+    cache.put(PARAMS, prompt, EMBEDDING, answer, "fingerprint")
+    return cache
+
+
+def test_normalize_prompt_keeps_case():
+    assert normalize_prompt("Solve  x ^ 2 = 4 ") == normalize_prompt("Solve x^2=4")
+    assert normalize_prompt(r"What is \Gamma(5)?") != normalize_prompt(r"What is \gamma(5)?")
+    assert normalize_prompt("Invert the matrix A") != normalize_prompt("Invert the matrix a")
+
+
+def test_case_variants_are_not_served_from_cache():
+    cache = cache_with(r"What is \Gamma(5)?", "24")
+
+    assert cache.get_exact(PARAMS, r"What is \gamma(5)?") is None
+    assert cache.get_similar(PARAMS, r"What is \gamma(5)?", EMBEDDING) is None
+
+
+def test_prompts_differing_in_numbers_are_not_served_from_cache():
+    cache = cache_with("Solve x^2 = 4", "x = 2 or x = -2")
+
+    assert cache.get_exact(PARAMS, "Solve x^2 = 9") is None
+    assert cache.get_similar(PARAMS, "Solve x^2 = 9", EMBEDDING) is None
+    assert cache.get_similar(PARAMS, "Solve x^2 = 4.5", EMBEDDING) is None
+    assert cache.stats()["semantic_hits"] == 0
+
+
+def test_rephrased_prompt_with_same_math_is_served_from_cache():
+    cache = cache_with("Solve x^2 = 4", "x = 2 or x = -2")
+
+    assert math_signature("Please solve x^2=4.") == math_signature("Solve x^2 = 4")
+    assert cache.get_similar(PARAMS, "Please solve x^2=4.", EMBEDDING) == "x = 2 or x = -2"
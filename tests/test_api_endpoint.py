@@ -0,0 +1,291 @@
+import os
+import json
+import asyncio
+import hashlib
+import threading
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from llama_index.core import Document, Settings
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import MockLLM
+
+import utils.incremental_index as incremental_index
+from utils.memmap_vector_store import MemmapVectorStore
+from utils.sharded_vector_store import create_vector_store
+
+# The API imports the Ollama client and uvicorn at module level
+pytest.importorskip("uvicorn")
+pytest.importorskip("ollama")
+pytest.importorskip("llama_index.llms.ollama")
+from fastapi.testclient import TestClient
+
+import services.api_endpoint as api_endpoint
+
+TEXT = " ".join(f"The derivative of x to the power {i} is {i} times x to the power {i - 1}." for i in range(1, 40))
+
+
+class CountingEmbedding(MockEmbedding):
+    """
+    Mock embedding model counting its calls, with a distinct embedding per text so
+    different prompts are never answered from the similar-prompt cache.
+    """
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:4], "little")
+        return np.random.default_rng(seed).standard_normal(self.embed_dim).tolist()
+
+    def _get_query_embedding(self, query):
+        calls["embed"] += 1
+        return self._vector(query)
+
+    def _get_text_embedding(self, text):
+        calls["embed"] += 1
+        return self._vector(text)
+
+    def _get_text_embeddings(self, texts):
+        calls["embed"] += 1
+        return [self._vector(text) for text in texts]
+
+
+calls = Counter()
+
+
+def persist_default_collection(persist_dir, data_dir):
+    # A default collection persisted at the root of the index directory
+    index, manifest = incremental_index.open_index(persist_dir, "mock", lambda: create_vector_store("none", 0))
+    documents = [Document(text=TEXT, metadata={"file_path": f"{data_dir}/calculus.txt", "file_name": "calculus.txt"})]
+    incremental_index.upsert_documents(index, manifest, documents, data_dir, {"calculus.txt": "h1"}, 64, 0)
+    incremental_index.persist_index(index, manifest, persist_dir, embedding_model="mock")
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    Settings.embed_model = CountingEmbedding(embed_dim=64)
+    Settings.llm = MockLLM(max_tokens=16)
+
+    persist_dir, data_dir = str(tmp_path / "vector_db"), str(tmp_path / "data")
+    persist_default_collection(persist_dir, data_dir)
+
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({"ollama_model": "mock", "embedding_model": "mock", "system_prompt": ""}))
+    monkeypatch.setattr(api_endpoint, "PERSIST_DIR", persist_dir)
+    monkeypatch.setattr(api_endpoint, "CONFIG_PATH", str(config_path))
+    # Searches of the memory-mapped vector store are counted
+    search = MemmapVectorStore.query
+    def counting_search(self, query, **kwargs):
+        calls["search"] += 1
+        return search(self, query, **kwargs)
+    monkeypatch.setattr(MemmapVectorStore, "query", counting_search)
+
+    # The Ollama setup is skipped, the models above are already in Settings
+    state = api_endpoint.app.state
+    monkeypatch.setattr(state, "models_loaded", True)
+    monkeypatch.setattr(state, "ready", True)
+    monkeypatch.setattr(state, "collections", api_endpoint.create_collection_cache())
+    monkeypatch.setattr(state, "answer_cache", api_endpoint.create_answer_cache())
+    monkeypatch.setattr(state, "config_fingerprint", None)
+    # One query at a time and none waiting, a slot that is never released fails the next query with 429
+    monkeypatch.setattr(state, "query_limiter", api_endpoint.QueryLimiter(1, 0, 5))
+    calls.clear()
+    # Not used as a context manager, so the lifespan warm-up does not run
+    return TestClient(api_endpoint.app)
+
+
+def test_query_embeds_and_searches_once(client):
+    prompts = ["What is the derivative of x to the power 3?", "What is the derivative of x to the power 7?"]
+    for prompt in prompts:
+        calls.clear()
+        response = client.post("/api/math-query", json={"prompt": prompt, "top_k_param": 3})
+
+        assert response.status_code == 200
+        assert len(response.json()["nodes"]) > 0
+        assert calls == Counter(embed=1, search=1)
+
+
+def test_repeated_query_is_not_embedded_again(client):
+    request = {"prompt": "What is the derivative of x to the power 3?", "top_k_param": 3}
+    first = client.post("/api/math-query", json=request)
+    calls.clear()
+    second = client.post("/api/math-query", json=request)
+
+    assert second.json() == first.json()
+    assert calls == Counter()
+
+
+def stream_events(client, prompt):
+    response = client.post("/api/math-query/stream", json={"prompt": prompt, "top_k_param": 3})
+    assert response.status_code == 200
+    return [line.split(": ", 1)[1] for line in response.text.splitlines() if line.startswith("event: ")]
+
+
+def test_stream_releases_query_slot(client):
+    assert stream_events(client, "What is the derivative of x to the power 3?")[-1] == "done"
+    assert stream_events(client, "What is the derivative of x to the power 7?")[-1] == "done"
+
+
+def test_stream_not_sent_does_not_hold_query_slot(client):
+    request = api_endpoint.QueryRequest(prompt="What is the derivative of x to the power 3?", top_k_param=3)
+    # The response is created but its body never iterated, e.g. the client went away first
+    asyncio.run(api_endpoint.stream_query_llamaindex(request))
+
+    assert stream_events(client, "What is the derivative of x to the power 7?")[-1] == "done"
+
+
+def test_batch_synthesis_shares_query_slots(client, monkeypatch):
+    running, threads = Counter(), set()
+    synthesize = api_endpoint.synthesize_answer
+    def counting_synthesize(*args):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        threads.add(threading.current_thread().name)
+        try:
+            return synthesize(*args)
+        finally:
+            running["now"] -= 1
+    monkeypatch.setattr(api_endpoint, "synthesize_answer", counting_synthesize)
+
+    prompts = [f"What is the derivative of x to the power {i}?" for i in range(6)]
+    response = client.post("/api/math-query/batch", json={"prompts": prompts, "top_k_param": 3})
+    results = [json.loads(line) for line in response.text.splitlines()]
+
+    assert sorted(result["index"] for result in results) == list(range(len(prompts)))
+    assert all("error" not in result for result in results)
+    # One query slot, the synthesis runs one prompt at a time on the query executor
+    assert running["max"] == 1
+    assert all(name.startswith("math-query") for name in threads)
+    assert stream_events(client, "What is the derivative of x to the power 7?")[-1] == "done"
+
+
+def test_answer_cache_fingerprint_changes_with_embedding_backend(client, tmp_path):
+    fingerprint = api_endpoint.answer_cache_fingerprint()
+    config_path = tmp_path / "config.json"
+    config = json.loads(config_path.read_text())
+    config_path.write_text(json.dumps({**config, "embedding_backend": "onnx-int8"}))
+    # A new modification time, the config is read again
+    os.utime(config_path, (0, 0))
+
+    assert api_endpoint.answer_cache_fingerprint() != fingerprint
+
+
+def test_failed_warm_up_is_retried_once_a_collection_is_persisted(client, tmp_path, monkeypatch):
+    persist_dir = str(tmp_path / "empty_db")
+    monkeypatch.setattr(api_endpoint, "PERSIST_DIR", persist_dir)
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({**json.loads(config_path.read_text()), "index_poll_interval": 0.01}))
+    state = api_endpoint.app.state
+    monkeypatch.setattr(state, "ready", False)
+    monkeypatch.setattr(state, "warm_up_error", "No index found")
+    warm_ups = []
+    def recording_warm_up():
+        warm_ups.append(api_endpoint.list_collections(persist_dir))
+        state.ready = True
+    monkeypatch.setattr(api_endpoint, "warm_up", recording_warm_up)
+
+    async def watch():
+        # The startup warm-up already failed, nothing is indexed yet
+        failed_warm_up = asyncio.get_running_loop().create_future()
+        failed_warm_up.set_result(None)
+        watch_task = asyncio.create_task(api_endpoint.watch_index_manifest(failed_warm_up))
+        try:
+            await asyncio.sleep(0.1)
+            assert warm_ups == []
+            persist_default_collection(persist_dir, str(tmp_path / "data"))
+            for _ in range(200):
+                if state.ready:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            watch_task.cancel()
+    asyncio.run(watch())
+
+    assert warm_ups == [["default"]]
+    assert client.get("/readyz").status_code == 200
+
+
+def test_query_engines_are_cached_per_top_k_and_response_mode(client, monkeypatch):
+    loads = []
+    load_collection = api_endpoint.load_collection
+    monkeypatch.setattr(api_endpoint, "load_collection", lambda name: loads.append(name) or load_collection(name))
+
+    settings = [(2, "compact"), (5, "compact"), (2, "tree_summarize"), (5, "compact")]
+    for i, (top_k, response_mode) in enumerate(settings):
+        request = {"prompt": f"What is the derivative of x to the power {i}?", "top_k_param": top_k, "response_mode": response_mode}
+        response = client.post("/api/math-query", json=request)
+
+        assert response.status_code == 200
+        assert len(response.json()["nodes"]) == top_k
+
+    # The index is loaded once, each setting gets its own engine on it and repeating one reuses it
+    assert loads == ["default"]
+    collection = api_endpoint.app.state.collections.peek("default")
+    assert set(collection.query_engines) == {(2, "compact", False, None, None), (5, "compact", False, None, None),
+                                             (2, "tree_summarize", False, None, None)}
+
+
+def test_query_beyond_the_queue_is_rejected_with_retry_after(client, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    search = MemmapVectorStore.query
+    def blocking_search(self, query, **kwargs):
+        started.set()
+        release.wait(timeout=10)
+        return search(self, query, **kwargs)
+    monkeypatch.setattr(MemmapVectorStore, "query", blocking_search)
+
+    # The first query holds the only slot, none may wait for it
+    responses = {}
+    running = threading.Thread(target=lambda: responses.setdefault("first", client.post(
+        "/api/math-query", json={"prompt": "What is the derivative of x to the power 3?", "top_k_param": 3})))
+    running.start()
+    assert started.wait(timeout=10)
+    try:
+        rejected = client.post("/api/math-query", json={"prompt": "What is the derivative of x to the power 7?", "top_k_param": 3})
+    finally:
+        release.set()
+        running.join(timeout=10)
+
+    assert rejected.status_code == 429
+    assert rejected.headers["Retry-After"] == "5"
+    assert responses["first"].status_code == 200
+    assert client.post("/api/math-query", json={"prompt": "What is the derivative of x to the power 7?", "top_k_param": 3}).status_code == 200
+
+
+def test_new_index_version_is_swapped_in_while_serving(client, tmp_path):
+    request = {"prompt": "What is the derivative of x to the power 3?", "top_k_param": 3}
+    assert client.post("/api/math-query", json=request).status_code == 200
+    state = api_endpoint.app.state
+    old = state.collections.peek("default")
+    old_engine = next(iter(old.query_engines.values()))
+
+    # The ingestion pipeline persists a new version with another file
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({**json.loads(config_path.read_text()), "index_poll_interval": 0.01}))
+    persist_dir, data_dir = api_endpoint.PERSIST_DIR, str(tmp_path / "data")
+    index, manifest = incremental_index.open_index(persist_dir, "mock", lambda: create_vector_store("none", 0))
+    algebra = " ".join(f"The square of {i} plus {i} equals {i * i + i}." for i in range(40))
+    documents = [Document(text=algebra, metadata={"file_path": f"{data_dir}/algebra.txt", "file_name": "algebra.txt"})]
+    incremental_index.upsert_documents(index, manifest, documents, data_dir, {"algebra.txt": "h2"}, 64, 0)
+    incremental_index.persist_index(index, manifest, persist_dir, embedding_model="mock")
+
+    async def watch():
+        watch_task = asyncio.create_task(api_endpoint.watch_index_manifest())
+        try:
+            for _ in range(200):
+                if state.collections.peek("default") is not old:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            watch_task.cancel()
+    asyncio.run(watch())
+
+    new = state.collections.peek("default")
+    assert new is not old and new.version != old.version
+    assert new.query_engines == {}
+    response = client.post("/api/math-query", json={"prompt": "What is the square of 7 plus 7?", "top_k_param": 3,
+                                                    "filters": {"file_name": "algebra.txt"}})
+    assert response.status_code == 200
+    assert {node["node"]["extra_info"]["file_name"] for node in response.json()["nodes"]} == {"algebra.txt"}
+    # A query that started on the old version finishes on it
+    assert all(node.metadata["file_name"] == "calculus.txt" for node in old_engine.retrieve(api_endpoint.QueryBundle(request["prompt"])))
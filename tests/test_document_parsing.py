@@ -0,0 +1,52 @@
+import os
+import time
+import multiprocessing
+
+from llama_index.core import Document
+
+import utils.document_parsing as document_parsing
+
+
+def flaky_parse_worker(connection):
+    # Like document_parsing._parse_worker, but hangs on hang* files and crashes its process on crash* files
+    while True:
+        path = connection.recv()
+        if path is None:
+            return
+        name = os.path.basename(path)
+        if name.startswith("hang"):
+            time.sleep(60)
+        if name.startswith("crash"):
+            os._exit(3)
+        with open(path) as source_file:
+            connection.send(([Document(text=source_file.read(), metadata={"file_path": path})], 0.0, None))
+
+
+def test_hanging_and_crashing_files_fail_alone(tmp_path, monkeypatch):
+    started = []
+    def start_flaky_worker(context):
+        parent_connection, child_connection = context.Pipe()
+        process = context.Process(target=flaky_parse_worker, args=(child_connection,), daemon=True)
+        process.start()
+        child_connection.close()
+        started.append(process)
+        return process, parent_connection
+    monkeypatch.setattr(document_parsing, "_start_worker", start_flaky_worker)
+
+    paths = []
+    for name in ("crash.txt", "hang.txt", "a.txt", "b.txt"):
+        paths.append(str(tmp_path / name))
+        (tmp_path / name).write_text(f"The content of {name}")
+
+    start = time.monotonic()
+    # The timeout leaves the spawned workers time to import llama-index
+    documents, failures = document_parsing.parse_files(paths, workers=2, timeout=10)
+
+    assert time.monotonic() - start < 40
+    # The other files are parsed, in the order of the paths
+    assert [document.text for document in documents] == ["The content of a.txt", "The content of b.txt"]
+    assert failures == {paths[0]: "worker process exited with code 3", paths[1]: "timed out after 10s"}
+    # The crashed worker was replaced, and no worker is left running
+    assert len(started) >= 3
+    assert not any(process.is_alive() for process in started)
+    assert multiprocessing.active_children() == []
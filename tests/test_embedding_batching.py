@@ -0,0 +1,51 @@
+import random
+
+from llama_index.core.embeddings import MockEmbedding
+
+from utils.embedding_batching import BucketedEmbedding, padded_tokens, plan_batches
+
+
+class RecordingEmbedding(MockEmbedding):
+    """
+    Mock embedding model whose embedding identifies its text, recording the batches it is given.
+    """
+
+    batches: list = []
+
+    def _get_text_embeddings(self, texts):
+        self.batches.append(list(texts))
+        return [[float(len(text)), float(sum(map(ord, text)))] for text in texts]
+
+
+def texts(count=300, seed=0):
+    rng = random.Random(seed)
+    return [" ".join(f"word{i}" for i in range(rng.randint(1, 200))) + f" #{position}" for position in range(count)]
+
+
+def test_embeddings_are_returned_in_text_order():
+    inner = RecordingEmbedding(embed_dim=2, batches=[])
+    model = BucketedEmbedding(inner, batch_tokens=2048, max_batch_size=64)
+    chunks = texts()
+
+    embeddings = model.get_text_embedding_batch(chunks)
+
+    assert embeddings == [[float(len(text)), float(sum(map(ord, text)))] for text in chunks]
+    # Several batches, each of similar lengths within the token budget
+    assert len(inner.batches) > 1
+    assert sorted(text for batch in inner.batches for text in batch) == sorted(chunks)
+    assert all(len(batch) <= 64 for batch in inner.batches)
+
+
+def test_batches_fit_the_token_budget_with_less_padding():
+    lengths = [random.Random(position).randint(5, 512) for position in range(1000)]
+    batches = plan_batches(lengths, batch_tokens=4096, max_batch_size=256)
+
+    assert sorted(position for batch in batches for position in batch) == list(range(len(lengths)))
+    assert all(len(batch) * max(lengths[position] for position in batch) <= 4096 for batch in batches)
+    # Batches of the same count in document order pad much more
+    in_order = [list(range(start, min(start + 16, len(lengths)))) for start in range(0, len(lengths), 16)]
+    assert padded_tokens(lengths, batches) < 0.7 * padded_tokens(lengths, in_order)
+
+
+def test_text_longer_than_the_budget_gets_its_own_batch():
+    assert plan_batches([10, 5000, 20], batch_tokens=100) == [[0, 2], [1]]
@@ -0,0 +1,59 @@
+from functools import partial
+
+from llama_index.core import Document, Settings
+from llama_index.core.embeddings import MockEmbedding
+
+import utils.incremental_index as incremental_index
+from utils.embedding_cache import CachedEmbedding, EmbeddingCache
+from utils.sharded_vector_store import create_vector_store
+
+TEXT = " ".join(f"The integral of x to the power {i} is x to the power {i + 1} over {i + 1}." for i in range(1, 40))
+
+
+class CountingEmbedding(MockEmbedding):
+    """
+    Mock embedding model counting the texts it embeds.
+    """
+
+    embedded: int = 0
+
+    def _get_text_embeddings(self, texts):
+        self.embedded += len(texts)
+        return [[float(len(text)), 1.0, 0.0, 0.0] for text in texts]
+
+
+def ingest(tmp_path, name, model_name="mock", text=TEXT):
+    # A fresh index and a fresh embedding model on the same cache file, as after a restart
+    inner = CountingEmbedding(embed_dim=4, model_name=model_name)
+    Settings.embed_model = CachedEmbedding(inner, EmbeddingCache(str(tmp_path / "embeddings.sqlite")))
+    index, manifest = incremental_index.open_index(str(tmp_path / name), "mock", partial(create_vector_store, "none", 0))
+    data_dir = str(tmp_path / "data")
+    documents = [Document(text=text, metadata={"file_path": f"{data_dir}/calculus.txt", "file_name": "calculus.txt"})]
+    report = incremental_index.upsert_documents(index, manifest, documents, data_dir, {"calculus.txt": "h1"}, 128, 0)
+    return inner, Settings.embed_model.stats(), report
+
+
+def test_reingested_chunks_are_read_from_the_cache(tmp_path):
+    first, first_stats, report = ingest(tmp_path, "db1")
+    second, second_stats, _ = ingest(tmp_path, "db2")
+
+    assert first.embedded == first_stats["computed"] > 1
+    assert second.embedded == 0
+    assert second_stats == {"reused": report["chunks"], "computed": 0}
+
+
+def test_only_new_chunks_are_embedded(tmp_path):
+    ingest(tmp_path, "db1")
+    changed, stats, report = ingest(tmp_path, "db2", text=TEXT + " A closing remark about constants of integration.")
+
+    # Only the last chunk holds the new sentence
+    assert changed.embedded == stats["computed"] == 1
+    assert stats["reused"] == report["chunks"] - 1
+
+
+def test_cache_is_keyed_by_model(tmp_path):
+    first, _, _ = ingest(tmp_path, "db1")
+    other, stats, _ = ingest(tmp_path, "db2", model_name="other-model")
+
+    assert other.embedded == first.embedded
+    assert stats["reused"] == 0
@@ -0,0 +1,159 @@
+import os
+from functools import partial
+
+import pytest
+
+from llama_index.core import Document, Settings
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.vector_stores.types import FilterOperator, MetadataFilter, MetadataFilters, VectorStoreQuery
+
+import utils.incremental_index as incremental_index
+from utils.document_manifest import hash_directory, plan_changes
+from utils.sharded_vector_store import create_vector_store
+
+# Enough sentences for several chunks, shared by two files so their chunks are stored once
+SHARED_TEXT = " ".join(f"Shared sentence number {i} with some words." for i in range(40))
+
+
+@pytest.fixture(autouse=True)
+def mock_embedding():
+    Settings.embed_model = MockEmbedding(embed_dim=8)
+
+
+def open_index(persist_dir):
+    return incremental_index.open_index(str(persist_dir), "mock", partial(create_vector_store, "none", 0))
+
+
+def documents(data_dir, texts: dict):
+    return [Document(text=text, metadata={"file_path": os.path.join(data_dir, name), "file_name": os.path.basename(name)}) for name, text in texts.items()]
+
+
+def test_replace_changed_file_with_shared_registry(tmp_path):
+    index, manifest = open_index(tmp_path / "db")
+    data_dir = str(tmp_path / "data")
+    registry = incremental_index.chunk_registry(index)
+
+    incremental_index.upsert_documents(index, manifest, documents(data_dir, {"a.txt": SHARED_TEXT, "b.txt": SHARED_TEXT}), data_dir,
+                                       {"a.txt": "a1", "b.txt": "b1"}, 48, 0, registry=registry)
+    # a.txt owns the shared chunks, replacing it moves them to b.txt under new node ids
+    changed = SHARED_TEXT + " A brand new closing sentence here."
+    report = incremental_index.upsert_documents(index, manifest, documents(data_dir, {"a.txt": changed}), data_dir,
+                                                {"a.txt": "a2"}, 48, 0, registry=registry)
+
+    assert manifest["files"]["a.txt"]["hash"] == "a2"
+    assert report["duplicate_chunks"] > 0
+    assert set(registry.values()) <= set(index.docstore.docs)
+    assert registry == incremental_index.chunk_registry(index)
+
+
+def test_ingest_in_batches_replaces_changed_file(tmp_path):
+    pytest.importorskip("llama_index.readers.file")
+    persist_dir, data_dir = str(tmp_path / "db"), str(tmp_path / "data")
+
+    def ingest(texts: dict):
+        os.makedirs(data_dir, exist_ok=True)
+        for name, text in texts.items():
+            with open(os.path.join(data_dir, name), "w") as data_file:
+                data_file.write(text)
+        index, manifest = open_index(persist_dir)
+        hashes = hash_directory(data_dir)
+        added, replaced, _ = plan_changes(manifest, hashes)
+        changed = {source: hashes[source] for source in added + replaced}
+        for _ in incremental_index.ingest_in_batches(index, manifest, data_dir, changed, persist_dir, 48, 0, batch_files=1, workers=1):
+            pass
+        return open_index(persist_dir)
+
+    ingest({"a.txt": SHARED_TEXT, "b.txt": SHARED_TEXT})
+    index, manifest = ingest({"a.txt": SHARED_TEXT + " A brand new closing sentence here."})
+
+    assert sorted(manifest["files"]) == ["a.txt", "b.txt"]
+    assert os.listdir(data_dir) == []
+    assert set(incremental_index.chunk_registry(index).values()) <= set(index.docstore.docs)
+
+
+def test_interrupted_ingestion_resumes_from_last_committed_batch(tmp_path, monkeypatch):
+    pytest.importorskip("llama_index.readers.file")
+    persist_dir, data_dir = str(tmp_path / "db"), str(tmp_path / "data")
+    texts = {f"{name}.txt": " ".join(f"Sentence {i} of file {name}." for i in range(30)) for name in "abc"}
+    os.makedirs(data_dir)
+    for name, text in texts.items():
+        with open(os.path.join(data_dir, name), "w") as data_file:
+            data_file.write(text)
+
+    def ingest():
+        index, manifest = open_index(persist_dir)
+        hashes = hash_directory(data_dir)
+        added, replaced, _ = plan_changes(manifest, hashes)
+        changed = {source: hashes[source] for source in added + replaced}
+        return [batch for batch, _, _ in incremental_index.ingest_in_batches(index, manifest, data_dir, changed, persist_dir, 48, 0, batch_files=1, workers=1)]
+
+    # The second batch fails while embedding, after the first one was committed
+    upsert = incremental_index.upsert_documents
+    upserts = []
+    def failing_upsert(*args, **kwargs):
+        upserts.append(args[2])
+        if len(upserts) == 2:
+            raise RuntimeError("embedding failed")
+        return upsert(*args, **kwargs)
+    monkeypatch.setattr(incremental_index, "upsert_documents", failing_upsert)
+    with pytest.raises(RuntimeError):
+        ingest()
+
+    index, manifest = open_index(persist_dir)
+    assert sorted(manifest["files"]) == ["a.txt"]
+    assert sorted(os.listdir(data_dir)) == ["b.txt", "c.txt"]
+    committed_nodes = set(index.docstore.docs)
+
+    monkeypatch.setattr(incremental_index, "upsert_documents", upsert)
+    assert ingest() == [["b.txt"], ["c.txt"]]
+
+    index, manifest = open_index(persist_dir)
+    assert sorted(manifest["files"]) == sorted(texts)
+    assert os.listdir(data_dir) == []
+    # The chunks of the committed batch are kept, not embedded again
+    assert committed_nodes < set(index.docstore.docs)
+    assert len(index.docstore.docs) == index.vector_store.size
+    assert {node.metadata["file_name"] for node in index.docstore.docs.values()} == set(texts)
+
+
+def search_file(index, file_name, top_k=100):
+    filters = MetadataFilters(filters=[MetadataFilter(key="file_name", value=[file_name], operator=FilterOperator.IN)])
+    return set(index.vector_store.query(VectorStoreQuery(query_embedding=[1.0] * 8, similarity_top_k=top_k, filters=filters)).ids)
+
+
+def test_filter_on_deduplicated_file_finds_shared_chunks(tmp_path):
+    index, manifest = open_index(tmp_path / "db")
+    data_dir = str(tmp_path / "data")
+    extra = " ".join(f"Only the second file has sentence {i}." for i in range(20))
+    incremental_index.upsert_documents(index, manifest, documents(data_dir, {"a.txt": SHARED_TEXT, "b.txt": SHARED_TEXT + " " + extra, "c.txt": SHARED_TEXT}),
+                                       data_dir, {"a.txt": "a1", "b.txt": "b1", "c.txt": "c1"}, 48, 0, duplicates={"c.txt": "a.txt"})
+    shared = {node.node_id for node in incremental_index.nodes_of_source(index, manifest["files"]["a.txt"])}
+
+    # b.txt owns its own chunks only, c.txt is a byte-identical copy of a.txt without chunks of its own
+    assert shared and shared <= search_file(index, "b.txt")
+    assert search_file(index, "c.txt") == shared
+    assert search_file(index, "a.txt") == shared
+
+    # The same after persisting and loading, and when the filter is scanned instead of resolved by the index
+    incremental_index.persist_index(index, manifest, str(tmp_path / "db"), embedding_model="mock")
+    index, _ = open_index(tmp_path / "db")
+    assert search_file(index, "c.txt") == shared
+    store = index.vector_store
+    scanned = store._filter_mask(MetadataFilters(filters=[MetadataFilter(key="file_name", value="c.txt")]))
+    assert {store._node_ids[row] for row in scanned.nonzero()[0]} == shared
+
+
+def test_same_file_name_in_different_folders_are_different_sources(tmp_path):
+    index, manifest = open_index(tmp_path / "db")
+    data_dir = str(tmp_path / "data")
+    incremental_index.upsert_documents(index, manifest, documents(data_dir, {"v1/notes.txt": SHARED_TEXT, "v2/notes.txt": SHARED_TEXT}),
+                                       data_dir, {"v1/notes.txt": "h1", "v2/notes.txt": "h2"}, 48, 0)
+
+    stored = incremental_index.nodes_of_source(index, manifest["files"]["v1/notes.txt"])
+    assert stored and all(node.metadata["duplicate_sources"] == ["v2/notes.txt"] for node in stored)
+
+    # Removing the owner moves its chunks to the other folder's file
+    incremental_index.remove_source(index, manifest, "v1/notes.txt")
+    moved = incremental_index.nodes_of_source(index, manifest["files"]["v2/notes.txt"])
+    assert len(moved) == len(stored)
+    assert all(node.metadata["file_path"] == os.path.join(data_dir, "v2/notes.txt") for node in moved)
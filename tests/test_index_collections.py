@@ -0,0 +1,24 @@
+import os
+
+from utils.index_collections import COLLECTIONS_DIR, DEFAULT_COLLECTION, list_collections
+from utils.index_manifest import MANIFEST_FILE
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "w").close()
+
+
+def test_index_without_manifest_is_listed(tmp_path):
+    # Indexes persisted before index manifests existed, like the committed vector_db, only have their docstore
+    touch(os.path.join(tmp_path, "docstore.json"))
+    touch(os.path.join(tmp_path, COLLECTIONS_DIR, "papers", "docstore.json"))
+    touch(os.path.join(tmp_path, COLLECTIONS_DIR, "notes", MANIFEST_FILE))
+    os.makedirs(os.path.join(tmp_path, COLLECTIONS_DIR, "empty"))
+
+    assert list_collections(str(tmp_path)) == [DEFAULT_COLLECTION, "notes", "papers"]
+
+
+def test_no_index(tmp_path):
+    assert list_collections(str(tmp_path)) == []
+    assert list_collections(str(tmp_path / "missing")) == []
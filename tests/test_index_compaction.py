@@ -0,0 +1,75 @@
+import os
+import hashlib
+from functools import partial
+
+import numpy as np
+import pytest
+
+from llama_index.core import Document, Settings
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+import utils.incremental_index as incremental_index
+from utils.index_compaction import compact_index
+from utils.sharded_vector_store import create_vector_store, load_vector_store
+
+
+class TextEmbedding(MockEmbedding):
+    """
+    Mock embedding model with a distinct embedding per text, so searches have a single right answer.
+    """
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:4], "little")
+        return np.random.default_rng(seed).standard_normal(self.embed_dim).tolist()
+
+    def _get_query_embedding(self, query):
+        return self._vector(query)
+
+    def _get_text_embedding(self, text):
+        return self._vector(text)
+
+
+TEXTS = {
+    "limits.txt": " ".join(f"The limit number {i} of a sequence is unique." for i in range(30)),
+    "series.txt": " ".join(f"The series number {i} converges absolutely." for i in range(30)),
+    "matrix.txt": " ".join(f"The matrix number {i} has a vector basis." for i in range(30)),
+}
+
+
+@pytest.fixture(autouse=True)
+def mock_embedding():
+    Settings.embed_model = TextEmbedding(embed_dim=16)
+
+
+def search(vector_store, query="limit series matrix"):
+    embedding = Settings.embed_model.get_query_embedding(query)
+    return vector_store.query(VectorStoreQuery(query_embedding=embedding, similarity_top_k=5)).ids
+
+
+def tombstones(vector_store):
+    shards = vector_store.shards.values() if hasattr(vector_store, "shards") else [vector_store]
+    return sum(len(shard._deleted) for shard in shards)
+
+
+@pytest.mark.parametrize("shard_by", ["none", "document"])
+def test_compaction_removes_tombstones_and_keeps_results(tmp_path, shard_by):
+    persist_dir, data_dir = str(tmp_path / "db"), str(tmp_path / "data")
+    index, manifest = incremental_index.open_index(persist_dir, "mock", partial(create_vector_store, shard_by, 0, 1))
+    documents = [Document(text=text, metadata={"file_path": os.path.join(data_dir, name), "file_name": name}) for name, text in TEXTS.items()]
+    incremental_index.upsert_documents(index, manifest, documents, data_dir, {name: name for name in TEXTS}, 48, 0)
+    removed = incremental_index.remove_source(index, manifest, "series.txt")
+    incremental_index.persist_index(index, manifest, persist_dir, embedding_model="mock")
+
+    before = load_vector_store(persist_dir, max_workers=1)
+    expected = search(before)
+    assert removed > 0 and tombstones(before) == removed
+
+    report = compact_index(persist_dir)
+
+    after = load_vector_store(persist_dir, max_workers=1)
+    assert report["rows_removed"] == removed
+    assert tombstones(after) == 0
+    assert len(after.node_ids) == len(index.docstore.docs)
+    assert search(after) == expected
+    assert report["size_after"] < report["size_before"]
@@ -0,0 +1,185 @@
+import json
+
+import numpy as np
+import pytest
+
+from llama_index.core.vector_stores.types import FilterCondition, FilterOperator, MetadataFilter, MetadataFilters, VectorStoreQuery
+
+from utils.memmap_vector_store import MemmapVectorStore
+
+
+def embeddings(count, dim=8, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+
+
+def persisted_store(persist_path, count, seed=0):
+    store = MemmapVectorStore()
+    store.add_embeddings([f"node-{seed}-{i}" for i in range(count)], embeddings(count, seed=seed), metadata=[{"file_name": f"{seed}.pdf"}] * count)
+    store.persist(persist_path)
+    return store
+
+
+def assert_rows_match_ids(store):
+    # Every row is found by its own embedding, so node ids are paired with the right matrix rows
+    node_ids, matrix = store.embedding_matrix()
+    for node_id, row in zip(node_ids, matrix):
+        assert store.query(VectorStoreQuery(query_embedding=row.tolist(), similarity_top_k=1)).ids == [node_id]
+
+
+def test_reload_during_persist_loads_a_consistent_generation(tmp_path, monkeypatch):
+    persist_path = str(tmp_path / "default__vector_store.json")
+    persisted_store(persist_path, 4)
+
+    load_generation = MemmapVectorStore._load_generation.__func__
+    attempts = []
+    def persist_meanwhile(cls, path, header, **kwargs):
+        # The header was read, another process persists new rows before the sidecars are
+        attempts.append(header["count"])
+        if len(attempts) == 1:
+            writer = MemmapVectorStore.from_persist_path(path)
+            writer.add_embeddings([f"node-1-{i}" for i in range(3)], embeddings(3, seed=1))
+            writer.persist(path)
+        return load_generation(cls, path, header, **kwargs)
+    monkeypatch.setattr(MemmapVectorStore, "_load_generation", classmethod(persist_meanwhile))
+
+    store = MemmapVectorStore.from_persist_path(persist_path)
+
+    assert attempts[0] == 4 and attempts[-1] == 7
+    assert store.size == 7
+    assert_rows_match_ids(store)
+
+
+def test_previous_generation_is_removed(tmp_path):
+    persist_path = str(tmp_path / "default__vector_store.json")
+    store = persisted_store(persist_path, 4)
+    store.add_embeddings(["extra"], embeddings(1, seed=2))
+    store.persist(persist_path)
+
+    with open(persist_path) as header_file:
+        header = json.load(header_file)
+    sidecars = {path.name for path in tmp_path.iterdir() if path.name.endswith((".ids.json", ".meta.json", ".postings.json"))}
+    assert sidecars == {header["ids"], header["metadata"], header["postings"]}
+    assert_rows_match_ids(MemmapVectorStore.from_persist_path(persist_path))
+
+
+def test_mismatched_sidecars_are_rejected(tmp_path):
+    persist_path = str(tmp_path / "default__vector_store.json")
+    persisted_store(persist_path, 4)
+    with open(persist_path) as header_file:
+        header = json.load(header_file)
+    with open(tmp_path / header["ids"]) as ids_file:
+        ids = json.load(ids_file)
+    ids["node_ids"], ids["ref_doc_ids"] = ids["node_ids"][:3], ids["ref_doc_ids"][:3]
+    with open(tmp_path / header["ids"], "w") as ids_file:
+        json.dump(ids, ids_file)
+
+    with pytest.raises(Exception, match="inconsistent"):
+        MemmapVectorStore.from_persist_path(persist_path)
+
+
+def exact_top_k(matrix, query, k, allowed=None):
+    # Brute-force cosine search, the reference the vector store is checked against
+    normalized = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    scores = normalized @ (query / np.linalg.norm(query))
+    if allowed is not None:
+        scores[~allowed] = -np.inf
+    order = np.argsort(-scores, kind="stable")[:k]
+    return [int(row) for row in order if np.isfinite(scores[row])]
+
+
+def filtered_store(count=300):
+    matrix = embeddings(count, dim=16, seed=3)
+    metadata = [{"file_name": f"file-{row % 5}.pdf", "page_label": str(row % 40), "tags": ["odd"] if row % 2 else []} for row in range(count)]
+    store = MemmapVectorStore()
+    store.add_embeddings([f"row-{row}" for row in range(count)], matrix, metadata=metadata)
+    return store, matrix, metadata
+
+
+def search(store, query, k, filters=None, **kwargs):
+    result = store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=k, filters=filters), **kwargs)
+    return [int(node_id.split("-")[1]) for node_id in result.ids]
+
+
+def test_filtered_search_matches_brute_force(tmp_path):
+    store, matrix, metadata = filtered_store()
+    store.delete_nodes(["row-0", "row-5", "row-10"])
+    store.persist(str(tmp_path / "default__vector_store.json"))
+    deleted = {0, 5, 10}
+
+    cases = [
+        # Resolved by the metadata index
+        (MetadataFilters(filters=[MetadataFilter(key="file_name", value=["file-0.pdf", "file-3.pdf"], operator=FilterOperator.IN)]),
+         lambda row: metadata[row]["file_name"] in ("file-0.pdf", "file-3.pdf")),
+        (MetadataFilters(filters=[MetadataFilter(key="page_label", value=10, operator=FilterOperator.GTE),
+                                  MetadataFilter(key="page_label", value=20, operator=FilterOperator.LTE)]),
+         lambda row: 10 <= int(metadata[row]["page_label"]) <= 20),
+        (MetadataFilters(filters=[MetadataFilter(key="file_name", value="file-1.pdf"), MetadataFilter(key="page_label", value="3")],
+                         condition=FilterCondition.OR),
+         lambda row: metadata[row]["file_name"] == "file-1.pdf" or metadata[row]["page_label"] == "3"),
+        # Scanned with boolean masks
+        (MetadataFilters(filters=[MetadataFilter(key="file_name", value="file-2.pdf", operator=FilterOperator.NE),
+                                  MetadataFilter(key="tags", value="odd", operator=FilterOperator.CONTAINS)]),
+         lambda row: metadata[row]["file_name"] != "file-2.pdf" and "odd" in metadata[row]["tags"]),
+    ]
+    queries = embeddings(5, dim=16, seed=4)
+    for filters, matches in cases:
+        allowed = np.array([matches(row) and row not in deleted for row in range(len(metadata))])
+        for query in queries:
+            assert search(store, query, 10, filters) == exact_top_k(matrix, query, 10, allowed)
+
+
+def clustered_embeddings(clusters=20, per_cluster=100, dim=32, seed=5):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim))
+    return (np.repeat(centers, per_cluster, axis=0) + 0.3 * rng.standard_normal((clusters * per_cluster, dim))).astype(np.float32)
+
+
+def recall(found, expected):
+    return len(set(found) & set(expected)) / len(expected)
+
+
+def test_ivf_search_recall_against_exact_search(tmp_path):
+    matrix = clustered_embeddings()
+    persist_path = str(tmp_path / "default__vector_store.json")
+    store = MemmapVectorStore()
+    store.add_embeddings([f"row-{row}" for row in range(len(matrix))], matrix)
+    store.build_ivf(n_lists=20)
+    store.persist(persist_path)
+    store = MemmapVectorStore.from_persist_path(persist_path)
+    queries = matrix[::97] + 0.1 * embeddings(len(matrix[::97]), dim=32, seed=6)
+
+    recalls = []
+    for query in queries:
+        expected = exact_top_k(matrix, query, 10)
+        # Probing every list is exact search
+        assert search(store, query, 10, nprobe=20) == expected
+        recalls.append(recall(search(store, query, 10, nprobe=3), expected))
+    assert np.mean(recalls) >= 0.9
+
+    # Rows added after the index was built are scanned, whatever nprobe
+    store.add_embeddings([f"row-{len(matrix)}"], queries[:1])
+    assert search(store, queries[0], 1, nprobe=1) == [len(matrix)]
+
+
+def test_int8_search_reranked_against_exact_search(tmp_path):
+    matrix = embeddings(2000, dim=32, seed=7)
+    persist_path = str(tmp_path / "default__vector_store.json")
+    store = MemmapVectorStore()
+    store.add_embeddings([f"row-{row}" for row in range(len(matrix))], matrix)
+    store.quantize()
+    store.persist(persist_path)
+    store = MemmapVectorStore.from_persist_path(persist_path)
+    assert store.quantized and store._codes.shape == matrix.shape
+
+    normalized = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    coarse_recalls = []
+    for query in embeddings(20, dim=32, seed=8):
+        expected = exact_top_k(matrix, query, 10)
+        result = store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=10))
+        found = [int(node_id.split("-")[1]) for node_id in result.ids]
+        # The int8 shortlist is re-scored in float32, the results and scores are the exact ones
+        assert found == expected
+        assert np.allclose(result.similarities, normalized[found] @ (query / np.linalg.norm(query)), atol=1e-5)
+        coarse_recalls.append(recall(search(store, query, 10, rerank_factor=0), expected))
+    # Without re-ranking the int8 scores alone miss a few
+    assert np.mean(coarse_recalls) >= 0.9
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+import utils.sharded_vector_store as sharded_vector_store
+from utils.sharded_vector_store import ShardedVectorStore, create_vector_store, load_vector_store
+
+
+def embeddings(count, dim=16, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+
+
+def nodes(matrix, start=0):
+    return [TextNode(id_=f"row-{start + row}", text="", embedding=embedding.tolist(), metadata={"file_name": f"file-{(start + row) % 7}.pdf"})
+            for row, embedding in enumerate(matrix)]
+
+
+def exact_top_k(matrix, query, k):
+    scores = (matrix / np.linalg.norm(matrix, axis=1, keepdims=True)) @ (query / np.linalg.norm(query))
+    return [f"row-{row}" for row in np.argsort(-scores, kind="stable")[:k]]
+
+
+def search(store, query, k=10):
+    return store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=k)).ids
+
+
+@pytest.fixture
+def shard_pool():
+    yield
+    sharded_vector_store.shutdown_shard_pool()
+
+
+@pytest.mark.parametrize("shard_by", ["count", "document"])
+def test_merged_shard_results_match_exact_search(tmp_path, shard_by):
+    matrix = embeddings(450)
+    store = create_vector_store(shard_by, 100, max_workers=1)
+    store.add(nodes(matrix))
+    assert len(store.shards) == (5 if shard_by == "count" else 7)
+
+    for query in embeddings(10, seed=1):
+        assert search(store, query) == exact_top_k(matrix, query, 10)
+    store.persist(str(tmp_path / "default__vector_store.json"))
+    store = load_vector_store(str(tmp_path), max_workers=1)
+    for query in embeddings(10, seed=1):
+        assert search(store, query) == exact_top_k(matrix, query, 10)
+
+
+def test_parallel_search_merges_persisted_and_changed_shards(tmp_path, monkeypatch, shard_pool):
+    # Shards are searched on two worker processes whatever the store size
+    monkeypatch.setattr(sharded_vector_store, "PARALLEL_MIN_ROWS", 0)
+    matrix = embeddings(450)
+    store = ShardedVectorStore(shard_by="count", shard_size=100, max_workers=2)
+    store.add(nodes(matrix))
+    store.persist(str(tmp_path / "default__vector_store.json"))
+    store = load_vector_store(str(tmp_path), max_workers=2)
+    store.warm_up()
+    queries = embeddings(10, seed=1)
+    for query in queries:
+        assert search(store, query) == exact_top_k(matrix, query, 10)
+
+    # The last shard gains rows not persisted yet, it is searched in-process and merged with the workers' results
+    added = queries[:3] * 2
+    store.add(nodes(added, start=len(matrix)))
+    matrix = np.concatenate([matrix, added])
+    for query in queries:
+        assert search(store, query) == exact_top_k(matrix, query, 10)
@@ -0,0 +1,187 @@
+import re
+import time
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+
+import utils.logs as logs
+
+
+###################################
+#
+# Normalize Prompt
+#
+###################################
+
+
+def normalize_prompt(prompt: str):
+    """
+    Normalizes a prompt so that wording-preserving variations map to the same cache key.
+
+    Args:
+        prompt (str): The prompt sent by the user.
+
+    Returns:
+        str: The prompt with whitespace collapsed and removed around symbols, so "Solve x ^ 2 = 4" and
+        "Solve x^2=4" are the same key. Case is kept, `A` and `a` or `\\Gamma` and `\\gamma` are different symbols.
+    """
+    prompt = re.sub(r"\s+", " ", prompt.strip())
+    prompt = re.sub(r"\s*([^\w\s])\s*", r"\1", prompt)
+    return prompt
+
+
+# Numbers, LaTeX commands, operators and single-letter variables of a prompt
+MATH_TOKEN_PATTERN = re.compile(r"\d+(?:\.\d+)?|\\[A-Za-z]+|[^\w\s.,;:!?'\"]|\b[A-Za-z]\b")
+
+
+def math_signature(prompt: str):
+    """
+    Returns the mathematical content of a prompt: its numbers, LaTeX commands, operators and single-letter
+    variables, in order and with their case.
+
+    Args:
+        prompt (str): The prompt sent by the user.
+
+    Returns:
+        tuple: The tokens, e.g. ("x", "^", "2", "=", "4") for "Solve x^2 = 4".
+
+    Notes:
+        Embeddings of prompts differing only in a number or a variable are nearly identical, so a cached answer
+        is only reused for a similar prompt with the same signature.
+    """
+    return tuple(MATH_TOKEN_PATTERN.findall(prompt))
+
+
+###################################
+#
+# Answer Cache
+#
+###################################
+
+
+class AnswerCache:
+    """
+    In-memory cache of answers in front of the query engine.
+
+    Entries are looked up first by normalized prompt, then by cosine similarity of the query embedding
+    against the cached ones with the same math signature (see `math_signature`). Entries expire after
+    `ttl` seconds, the least recently used entry is evicted once `max_entries` is reached, and the whole
+    cache is cleared whenever the fingerprint given by the caller changes (the API uses the models,
+    embedding backend and system prompt of its config). Anything else an answer depends on, such as the
+    versions of the searched collections, belongs in the `params` of its entry.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 3600, similarity_threshold: float = 0.98):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()  # (params, normalized prompt) -> (created_at, embedding, answer, math signature)
+        self._fingerprint = None
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def validate(self, fingerprint):
+        """
+        Clears the cache if the fingerprint differs from the one the cached answers were produced with.
+        """
+        with self._lock:
+            if fingerprint == self._fingerprint:
+                return
+            if self._entries:
+                logs.log.info(f"Answer cache invalidated, dropping {len(self._entries)} entries")
+                self._stats["invalidations"] += 1
+            self._entries.clear()
+            self._fingerprint = fingerprint
+
+    def get_exact(self, params, prompt: str):
+        """
+        Returns the cached answer for the normalized prompt, or None.
+
+        Args:
+            params (tuple): Request parameters the answer depends on (e.g. top_k and response mode).
+            prompt (str): The prompt sent by the user.
+        """
+        key = (params, normalize_prompt(prompt))
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self._stats["exact_hits"] += 1
+            return entry[2]
+
+    def get_similar(self, params, prompt: str, embedding):
+        """
+        Returns the cached answer whose query embedding is the most similar to `embedding`, among the answers
+        to prompts with the same math signature, if the similarity reaches the threshold. Counts a miss otherwise.
+
+        Args:
+            params (tuple): Request parameters the answer depends on.
+            prompt (str): The prompt sent by the user.
+            embedding (list[float]): The query embedding of the prompt.
+        """
+        signature = math_signature(prompt)
+        with self._lock:
+            self._expire()
+            keys = [key for key, entry in self._entries.items() if key[0] == params and entry[3] == signature]
+            if keys:
+                query = _normalize(embedding)
+                scores = np.stack([self._entries[key][1] for key in keys]) @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity_threshold:
+                    self._entries.move_to_end(keys[best])
+                    self._stats["semantic_hits"] += 1
+                    return self._entries[keys[best]][2]
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, params, prompt: str, embedding, answer, fingerprint):
+        """
+        Stores an answer for the prompt, evicting the least recently used entries above the size cap.
+
+        Args:
+            fingerprint: The fingerprint validated before the answer was produced. The answer is dropped if the
+                cache was invalidated in the meantime, so an answer from a replaced index is never cached.
+        """
+        key = (params, normalize_prompt(prompt))
+        with self._lock:
+            if fingerprint != self._fingerprint:
+                return
+            self._entries[key] = (time.monotonic(), _normalize(embedding), answer, math_signature(prompt))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        """
+        Returns the hit/miss counters, the hit rate and the current number of entries.
+        """
+        with self._lock:
+            lookups = self._stats["exact_hits"] + self._stats["semantic_hits"] + self._stats["misses"]
+            hits = self._stats["exact_hits"] + self._stats["semantic_hits"]
+            return {
+                **self._stats,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+    def _expire(self):
+        # Entries are kept in recency order, not creation order, so every entry is checked.
+        if self.ttl is None or self.ttl <= 0:
+            return
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if now - entry[0] > self.ttl]
+        for key in expired:
+            del self._entries[key]
+            self._stats["evictions"] += 1
+
+
+def _normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
@@ -0,0 +1,169 @@
+import os
+import json
+import hashlib
+
+from datetime import datetime, timezone
+
+import utils.logs as logs
+
+# Written into the persist directory next to the docstore, records which source files the index holds.
+# Ingestion compares the content hash of every uploaded file to it to decide what must be re-indexed.
+DOCUMENT_MANIFEST_FILE = "document_manifest.json"
+
+# Bytes read at a time when hashing a file
+HASH_BLOCK = 1 << 20
+
+
+###################################
+#
+# Hash Source Files
+#
+###################################
+
+
+def hash_file(path: str):
+    """
+    Returns the sha256 hex digest of a file's content, read block by block.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as source_file:
+        for block in iter(lambda: source_file.read(HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_directory(data_dir: str):
+    """
+    Returns the content hash of every file in a directory, keyed by its path relative to the directory.
+
+    Args:
+        data_dir (str): The directory the uploaded files were saved to.
+
+    Returns:
+        dict: {source path: sha256}. Empty if the directory does not exist.
+    """
+    hashes = {}
+    if not os.path.isdir(data_dir):
+        return hashes
+    for root, _, files in os.walk(data_dir):
+        for name in sorted(files):
+            if name.startswith(".gitkeep"):
+                continue
+            path = os.path.join(root, name)
+            hashes[os.path.relpath(path, data_dir)] = hash_file(path)
+    return hashes
+
+
+###################################
+#
+# Read / Write Document Manifest
+#
+###################################
+
+
+def read_document_manifest(persist_dir: str):
+    """
+    Reads the document manifest from the persist directory.
+
+    Args:
+        persist_dir (str): The directory the index was persisted to.
+
+    Returns:
+        dict: The manifest, {"files": {source path: {"hash", "ref_doc_ids", "node_count", "ingested_at"}}},
+        or None if the index was persisted before document manifests existed or is unreadable. Files identical
+        to another indexed file have no nodes of their own and name that file in "duplicate_of".
+    """
+    manifest_path = os.path.join(persist_dir, DOCUMENT_MANIFEST_FILE)
+    try:
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest.setdefault("files", {})
+        return manifest
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        logs.log.warning(f"Unable to read document manifest {manifest_path}: {err}")
+        return None
+
+
+def write_document_manifest(persist_dir: str, manifest: dict):
+    """
+    Writes the document manifest into the persist directory.
+
+    Notes:
+        It is written to a temporary file and renamed, and must be written after the index itself so it never
+        lists a file whose nodes were not persisted.
+    """
+    manifest_path = os.path.join(persist_dir, DOCUMENT_MANIFEST_FILE)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(tmp_path, manifest_path)
+    logs.log.info(f"Document manifest with {len(manifest['files']):,} files written to {persist_dir}")
+
+
+def manifest_entry(file_hash, ref_doc_ids: list, node_count: int):
+    return {
+        "hash": file_hash,
+        "ref_doc_ids": ref_doc_ids,
+        "node_count": node_count,
+        "ingested_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+###################################
+#
+# Plan Changes
+#
+###################################
+
+
+def plan_changes(manifest: dict, hashes: dict):
+    """
+    Compares the uploaded files to the files already indexed.
+
+    Args:
+        manifest (dict): The document manifest of the index.
+        hashes (dict): {source path: sha256} of the uploaded files.
+
+    Returns:
+        tuple: The source paths to add (not indexed yet), to replace (indexed with a different content) and
+        unchanged (indexed with the same content), each sorted.
+    """
+    added, replaced, unchanged = [], [], []
+    for source, file_hash in sorted(hashes.items()):
+        entry = manifest["files"].get(source)
+        if entry is None:
+            added.append(source)
+        elif entry.get("hash") != file_hash:
+            replaced.append(source)
+        else:
+            unchanged.append(source)
+    return added, replaced, unchanged
+
+
+def find_duplicate_files(manifest: dict, hashes: dict, changed: list):
+    """
+    Finds the changed files that are byte-identical to another file, so they are not parsed or embedded.
+
+    Args:
+        manifest (dict): The document manifest of the index.
+        hashes (dict): {source path: sha256} of the uploaded files.
+        changed (list): The source paths to add or replace, in processing order.
+
+    Returns:
+        dict: {source path: source path of the identical file}. The identical file is an indexed file that is
+        not itself replaced, or a changed file processed earlier.
+    """
+    changed_set = set(changed)
+    primaries = {}
+    for source, entry in manifest["files"].items():
+        if source not in changed_set and entry.get("hash") and not entry.get("duplicate_of"):
+            primaries.setdefault(entry["hash"], source)
+
+    duplicates = {}
+    for source in changed:
+        primary = primaries.setdefault(hashes[source], source)
+        if primary != source:
+            duplicates[source] = primary
+    return duplicates
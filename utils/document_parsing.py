@@ -0,0 +1,164 @@
+import os
+import time
+import multiprocessing
+
+from collections import deque
+from multiprocessing.connection import wait
+
+import utils.logs as logs
+
+from utils.worker_processes import stop_worker
+
+from llama_index.core import SimpleDirectoryReader
+
+# A file still being parsed after this many seconds is given up and its worker process killed
+DEFAULT_PARSE_TIMEOUT = 300
+
+
+###################################
+#
+# Parse One File
+#
+###################################
+
+
+def parse_file(path: str):
+    """
+    Parses one file into llama-index documents.
+
+    Returns:
+        tuple: The documents and the parsing time in seconds.
+
+    Raises:
+        Exception: If the file cannot be parsed. SimpleDirectoryReader would otherwise log the error and
+        return no documents, and the file would be recorded as indexed.
+    """
+    start = time.perf_counter()
+    documents = SimpleDirectoryReader(input_files=[path], raise_on_error=True).load_data()
+    return documents, time.perf_counter() - start
+
+
+def _parse_worker(connection):
+    # Parses the paths sent by the parent one at a time, until it sends None
+    while True:
+        path = connection.recv()
+        if path is None:
+            return
+        try:
+            documents, seconds = parse_file(path)
+            connection.send((documents, seconds, None))
+        except Exception as err:
+            connection.send(([], 0.0, f"{type(err).__name__}: {err}"))
+
+
+###################################
+#
+# Parse Files in Worker Processes
+#
+###################################
+
+
+def _start_worker(context):
+    parent_connection, child_connection = context.Pipe()
+    process = context.Process(target=_parse_worker, args=(child_connection,), daemon=True)
+    process.start()
+    child_connection.close()
+    return process, parent_connection
+
+
+def parse_files(paths: list, workers: int = 0, timeout: float = DEFAULT_PARSE_TIMEOUT):
+    """
+    Parses files in parallel worker processes, each file on its own with a timeout.
+
+    Args:
+        paths (list[str]): The files to parse.
+        workers (int): The number of worker processes, 0 for one per CPU core. 1 parses in this process,
+            without timeouts.
+        timeout (float): Seconds a file may take before its worker is killed, 0 for no limit.
+
+    Returns:
+        tuple: The documents of the parsed files, in the order of `paths`, and {path: reason} of the files
+        that could not be parsed.
+
+    Notes:
+        A worker parses one file at a time, so a file that hangs or crashes its process (a corrupt or huge PDF)
+        only costs that file: the worker is killed and replaced, the other files carry on. Workers are spawned
+        rather than forked, forking the Streamlit process and its threads is unsafe.
+    """
+    paths = [str(path) for path in paths]
+    in_process = workers == 1
+    workers = max(1, min(workers or os.cpu_count() or 1, len(paths)))
+    parsed, failures = {}, {}
+    start = time.perf_counter()
+
+    if in_process:
+        for path in paths:
+            try:
+                parsed[path], seconds = parse_file(path)
+                logs.log.info(f"Parsed {path} in {seconds:.2f}s ({len(parsed[path]):,} documents)")
+            except Exception as err:
+                failures[path] = f"{type(err).__name__}: {err}"
+                logs.log.error(f"Failed to parse {path}: {failures[path]}")
+    elif len(paths) > 0:
+        _parse_in_workers(paths, workers, timeout, parsed, failures)
+
+    documents = [document for path in paths for document in parsed.get(path, [])]
+    logs.log.info(f"Parsed {len(parsed):,} files into {len(documents):,} documents in {time.perf_counter() - start:.2f}s "
+                  f"with {workers} workers, {len(failures):,} failed")
+    return documents, failures
+
+
+def _parse_in_workers(paths: list, workers: int, timeout: float, parsed: dict, failures: dict):
+    context = multiprocessing.get_context("spawn")
+    pending = deque(paths)
+    idle = [_start_worker(context) for _ in range(workers)]
+    busy = {}  # connection -> (process, path, start time)
+    try:
+        while pending or busy:
+            while pending and idle:
+                process, connection = idle.pop()
+                path = pending.popleft()
+                connection.send(path)
+                busy[connection] = (process, path, time.monotonic())
+
+            wait_seconds = None
+            if timeout:
+                first_deadline = min(started for _, _, started in busy.values()) + timeout
+                wait_seconds = max(0.0, first_deadline - time.monotonic())
+            for connection in wait(list(busy), timeout=wait_seconds):
+                process, path, started = busy.pop(connection)
+                try:
+                    documents, seconds, error = connection.recv()
+                except (EOFError, OSError):
+                    # The worker died, e.g. a parser crashed the interpreter or ran out of memory
+                    process.join(timeout=5)
+                    stop_worker(process, connection, graceful=False)
+                    failures[path] = f"worker process exited with code {process.exitcode}"
+                    logs.log.error(f"Failed to parse {path}: {failures[path]}")
+                    if pending:
+                        idle.append(_start_worker(context))
+                    continue
+                if error is None:
+                    parsed[path] = documents
+                    logs.log.info(f"Parsed {path} in {seconds:.2f}s ({len(documents):,} documents)")
+                else:
+                    failures[path] = error
+                    logs.log.error(f"Failed to parse {path} after {time.monotonic() - started:.2f}s: {error}")
+                idle.append((process, connection))
+
+            if timeout:
+                now = time.monotonic()
+                for connection, (process, path, started) in list(busy.items()):
+                    if now - started < timeout:
+                        continue
+                    del busy[connection]
+                    failures[path] = f"timed out after {timeout:g}s"
+                    logs.log.error(f"Failed to parse {path}: {failures[path]}, its worker process was killed")
+                    stop_worker(process, connection, graceful=False)
+                    if pending:
+                        idle.append(_start_worker(context))
+    finally:
+        for process, connection in idle:
+            stop_worker(process, connection, graceful=True)
+        for connection, (process, _, _) in busy.items():
+            stop_worker(process, connection, graceful=False)
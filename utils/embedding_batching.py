@@ -0,0 +1,170 @@
+from typing import List
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+# Padded tokens (batch size x longest text in the batch) the model is given per forward pass
+DEFAULT_BATCH_TOKENS = 16384
+
+# Upper bound on the texts of one batch, however short they are
+DEFAULT_MAX_BATCH_SIZE = 256
+
+# Texts llama-index hands to the embedding model per call, the batches are formed within this window
+BUCKETING_WINDOW = 2048
+
+
+###################################
+#
+# Plan Batches by Token Length
+#
+###################################
+
+
+def token_lengths(embed_model, texts: List[str]):
+    """
+    Returns the number of tokens of each text as the model will see it, truncated to its maximum length.
+
+    Args:
+        embed_model (BaseEmbedding): The embedding model. A `HuggingFaceEmbedding` is measured with its
+            tokenizer, other models by an estimate of 4 characters per token.
+        texts (list[str]): The texts to embed.
+
+    Returns:
+        list[int]: The token count of each text.
+    """
+    model = getattr(embed_model, "_model", None)
+    tokenizer = getattr(model, "tokenizer", None)
+    max_length = getattr(model, "max_seq_length", None) or getattr(embed_model, "max_length", None)
+    if tokenizer is not None:
+        encoded = tokenizer(texts, add_special_tokens=True, truncation=max_length is not None, max_length=max_length,
+                            return_attention_mask=False, return_token_type_ids=False)
+        return [len(input_ids) for input_ids in encoded["input_ids"]]
+    lengths = [len(text) // 4 + 2 for text in texts]
+    return [min(length, max_length) for length in lengths] if max_length else lengths
+
+
+def plan_batches(lengths: List[int], batch_tokens: int = DEFAULT_BATCH_TOKENS, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE):
+    """
+    Groups texts of similar length into batches sized to a token budget.
+
+    Args:
+        lengths (list[int]): The token count of each text.
+        batch_tokens (int): The padded tokens allowed per batch, the batch size times its longest text.
+        max_batch_size (int): The maximum number of texts per batch.
+
+    Returns:
+        list[list[int]]: The positions of the texts in each batch, shortest texts first.
+
+    Notes:
+        A batch is padded to its longest text, so sorting by length keeps the padding small, and sizing batches
+        by tokens rather than by count gives short texts large batches and long texts small ones. A text longer
+        than the budget gets a batch of its own.
+    """
+    batches, current = [], []
+    for position in sorted(range(len(lengths)), key=lengths.__getitem__):
+        # Texts are visited shortest first, so the text being added is the longest of the batch
+        if current and ((len(current) + 1) * lengths[position] > batch_tokens or len(current) >= max_batch_size):
+            batches.append(current)
+            current = []
+        current.append(position)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def padded_tokens(lengths: List[int], batches: List[List[int]]):
+    """
+    Returns the number of tokens the model computes for batches, padding included.
+    """
+    return sum(len(batch) * max(lengths[position] for position in batch) for batch in batches if batch)
+
+
+###################################
+#
+# Length-Bucketed Embedding Model
+#
+###################################
+
+
+class BucketedEmbedding(BaseEmbedding):
+    """
+    Embedding model wrapper that embeds texts in batches of similar token length sized to a token budget,
+    and returns the embeddings in the order of the texts.
+
+    Args:
+        inner (BaseEmbedding): The embedding model, e.g. a `HuggingFaceEmbedding`.
+        batch_tokens (int): The padded tokens allowed per batch.
+        max_batch_size (int): The maximum number of texts per batch.
+
+    Notes:
+        llama-index embeds chunks in document order, `embed_batch_size` (10 by default) at a time, so every
+        batch mixes short and long chunks. The wrapper asks llama-index for up to `BUCKETING_WINDOW` texts per
+        call and forms the batches itself, the wrapped model receives each batch in one call.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _batch_tokens: int = PrivateAttr()
+    _max_batch_size: int = PrivateAttr()
+    _stats: dict = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, batch_tokens: int = DEFAULT_BATCH_TOKENS, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE, **kwargs):
+        super().__init__(model_name=inner.model_name, embed_batch_size=BUCKETING_WINDOW, **kwargs)
+        max_batch_size = max(1, min(int(max_batch_size), BUCKETING_WINDOW))
+        # The wrapped model must not split the batches again
+        inner.embed_batch_size = max_batch_size
+        self._inner = inner
+        self._batch_tokens = max(1, int(batch_tokens))
+        self._max_batch_size = max_batch_size
+        self._stats = {"batches": 0, "tokens": 0, "padded_tokens": 0}
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "BucketedEmbedding"
+
+    @property
+    def inner_model(self) -> BaseEmbedding:
+        return self._inner
+
+    def stats(self):
+        """
+        Returns the number of batches embedded, and the tokens of their texts without and with padding.
+        """
+        return dict(self._stats)
+
+    def _embed_batches(self, texts: List[str], embed):
+        lengths = token_lengths(self._inner, texts)
+        batches = plan_batches(lengths, self._batch_tokens, self._max_batch_size)
+        embeddings = [None] * len(texts)
+        for batch in batches:
+            for position, embedding in zip(batch, embed([texts[position] for position in batch])):
+                embeddings[position] = embedding
+        self._stats["batches"] += len(batches)
+        self._stats["tokens"] += sum(lengths)
+        self._stats["padded_tokens"] += padded_tokens(lengths, batches)
+        return embeddings
+
+    def _embed(self, sentences: List[str], prompt_name: str = None) -> List[List[float]]:
+        # HuggingFaceEmbedding embeds queries and texts through _embed, with the instruction of each prompt
+        if hasattr(self._inner, "_embed"):
+            return self._embed_batches(sentences, lambda batch: self._inner._embed(batch, prompt_name=prompt_name))
+        if prompt_name == "query":
+            return [self._inner._get_query_embedding(sentence) for sentence in sentences]
+        return self._embed_batches(sentences, self._inner._get_text_embeddings)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._inner._get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await self._inner._aget_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._inner._get_text_embedding(text)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, prompt_name="text")
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._get_text_embeddings(texts)
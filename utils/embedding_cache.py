@@ -0,0 +1,229 @@
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+
+###################################
+#
+# Hash Chunk Text
+#
+###################################
+
+
+def hash_text(text: str):
+    """
+    Hashes a chunk of text after normalizing its whitespace.
+
+    Args:
+        text (str): The chunk text.
+
+    Returns:
+        str: The hex SHA-256 digest of the normalized text.
+    """
+    normalized = re.sub(r"\s+", " ", text).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+###################################
+#
+# Persistent Embedding Cache
+#
+###################################
+
+
+class EmbeddingCache:
+    """
+    SQLite backed store of embeddings keyed by (embedding model name, chunk text hash).
+
+    Args:
+        path (str): The SQLite database file, created if missing.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, text_hash))"
+        )
+        self._connection.commit()
+
+    def get_many(self, model: str, text_hashes: List[str]):
+        """
+        Returns a dict of text hash to embedding for the hashes found in the cache.
+        """
+        found = {}
+        unique_hashes = list(dict.fromkeys(text_hashes))
+        with self._lock:
+            # SQLite limits the number of bound parameters, so look up in slices
+            for start in range(0, len(unique_hashes), 500):
+                batch = unique_hashes[start:start + 500]
+                rows = self._connection.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch],
+                ).fetchall()
+                for text_hash, vector in rows:
+                    found[text_hash] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model: str, items: dict):
+        """
+        Stores a dict of text hash to embedding.
+        """
+        rows = [(model, text_hash, np.asarray(vector, dtype=np.float32).tobytes()) for text_hash, vector in items.items()]
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            self._connection.commit()
+
+
+###################################
+#
+# Cached Embedding Model
+#
+###################################
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Embedding model wrapper that serves text (chunk) embeddings from an EmbeddingCache and only
+    sends unseen chunks to the wrapped model. Query embeddings are kept in a bounded in-process
+    LRU so repeated prompts skip the model entirely.
+
+    Args:
+        inner (BaseEmbedding): The embedding model computing missing embeddings.
+        cache (EmbeddingCache): The persistent cache.
+        query_cache_size (int): The maximum number of query embeddings kept in memory.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+    _stats: dict = PrivateAttr()
+    _query_cache: OrderedDict = PrivateAttr()
+    _query_cache_size: int = PrivateAttr()
+    _query_stats: dict = PrivateAttr()
+    _query_lock: threading.Lock = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, cache: EmbeddingCache, query_cache_size: int = 1024, **kwargs):
+        super().__init__(model_name=inner.model_name, embed_batch_size=inner.embed_batch_size, **kwargs)
+        self._inner = inner
+        self._cache = cache
+        self._stats = {"reused": 0, "computed": 0}
+        self._query_cache = OrderedDict()  # query text -> embedding
+        self._query_cache_size = query_cache_size
+        self._query_stats = {"hits": 0, "misses": 0}
+        self._query_lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def inner_model(self) -> BaseEmbedding:
+        return self._inner
+
+    def stats(self):
+        """
+        Returns how many chunk embeddings were reused from the cache and how many were computed.
+        """
+        return dict(self._stats)
+
+    def reset_stats(self):
+        self._stats = {"reused": 0, "computed": 0}
+
+    def query_cache_stats(self):
+        """
+        Returns the hit/miss counters and the size of the query embedding LRU.
+        """
+        with self._query_lock:
+            return {**self._query_stats, "size": len(self._query_cache), "max_size": self._query_cache_size}
+
+    def _lookup_query(self, query: str):
+        with self._query_lock:
+            embedding = self._query_cache.get(query)
+            if embedding is None:
+                self._query_stats["misses"] += 1
+                return None
+            self._query_cache.move_to_end(query)
+            self._query_stats["hits"] += 1
+            return embedding
+
+    def _store_query(self, query: str, embedding: List[float]):
+        with self._query_lock:
+            self._query_cache[query] = embedding
+            self._query_cache.move_to_end(query)
+            while len(self._query_cache) > self._query_cache_size:
+                self._query_cache.popitem(last=False)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        embedding = self._lookup_query(query)
+        if embedding is None:
+            embedding = self._inner._get_query_embedding(query)
+            self._store_query(query, embedding)
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        embedding = self._lookup_query(query)
+        if embedding is None:
+            embedding = await self._inner._aget_query_embedding(query)
+            self._store_query(query, embedding)
+        return embedding
+
+    def _get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        embeddings = {}
+        missing = []
+        for query in dict.fromkeys(queries):
+            embedding = self._lookup_query(query)
+            if embedding is None:
+                missing.append(query)
+            else:
+                embeddings[query] = embedding
+        if missing:
+            # HuggingFaceEmbedding can embed a batch of queries with its query instruction in one call
+            if hasattr(self._inner, "_embed"):
+                computed = self._inner._embed(missing, prompt_name="query")
+            else:
+                computed = [self._inner._get_query_embedding(query) for query in missing]
+            for query, embedding in zip(missing, computed):
+                self._store_query(query, embedding)
+                embeddings[query] = embedding
+        return [embeddings[query] for query in queries]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        text_hashes = [hash_text(text) for text in texts]
+        cached = self._cache.get_many(self.model_name, text_hashes)
+
+        missing = {}
+        for text_hash, text in zip(text_hashes, texts):
+            if text_hash not in cached and text_hash not in missing:
+                missing[text_hash] = text
+        if missing:
+            computed = self._inner._get_text_embeddings(list(missing.values()))
+            new_embeddings = dict(zip(missing.keys(), computed))
+            self._cache.put_many(self.model_name, new_embeddings)
+            cached.update(new_embeddings)
+
+        self._stats["reused"] += len(texts) - len(missing)
+        self._stats["computed"] += len(missing)
+        return [cached[text_hash] for text_hash in text_hashes]
@@ -0,0 +1,251 @@
+import os
+import atexit
+import threading
+import multiprocessing
+
+from collections import deque
+from multiprocessing.connection import wait
+from typing import List
+
+import numpy as np
+
+import utils.logs as logs
+
+from utils.embedding_batching import DEFAULT_BATCH_TOKENS, BucketedEmbedding
+from utils.onnx_embedding import OnnxEmbedding
+from utils.worker_processes import stop_worker
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+# Texts sent to a worker at once, sorted by length so each piece is bucketed with little padding
+DEFAULT_PIECE_SIZE = 128
+
+# Seconds a worker may take to load the model before it is given up
+WORKER_START_TIMEOUT = 600
+
+
+###################################
+#
+# Create the Embedding Model
+#
+###################################
+
+
+def create_embedding_model(model: str, backend: str = "torch", batch_tokens: int = DEFAULT_BATCH_TOKENS, threads: int = 0, device: str = "cpu"):
+    """
+    Creates the embedding model of a backend, embedding in length-bucketed batches.
+
+    Args:
+        model (str): The Hugging Face model name.
+        backend (str): "torch", "onnx" or "onnx-int8", see `onnx_embedding.OnnxEmbedding`.
+        batch_tokens (int): The padded tokens per batch, see `embedding_batching.BucketedEmbedding`.
+        threads (int): The CPU threads used to embed, 0 for one per core.
+        device (str): The torch device, "cpu" or "cuda". The ONNX backends always run on the CPU.
+
+    Returns:
+        BucketedEmbedding: The model, not cached.
+    """
+    if backend in ("onnx", "onnx-int8"):
+        embed_model = OnnxEmbedding(model, quantize=backend == "onnx-int8", threads=threads)
+    else:
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+        if threads > 0:
+            import torch
+            torch.set_num_threads(int(threads))
+        embed_model = HuggingFaceEmbedding(model_name=model, device=device)
+    return BucketedEmbedding(embed_model, batch_tokens=batch_tokens)
+
+
+###################################
+#
+# Embedding Worker Process
+#
+###################################
+
+
+def _embedding_worker(connection, model: str, backend: str, batch_tokens: int, threads: int):
+    # Loads the model once, then embeds the pieces sent by the parent until it sends None
+    try:
+        embed_model = create_embedding_model(model, backend, batch_tokens, threads)
+    except Exception as err:
+        connection.send((None, f"{type(err).__name__}: {err}"))
+        return
+    connection.send((None, None))
+    while True:
+        request = connection.recv()
+        if request is None:
+            return
+        texts, prompt_name = request
+        try:
+            connection.send((np.asarray(embed_model._embed(texts, prompt_name=prompt_name), dtype=np.float32), None))
+        except Exception as err:
+            connection.send((None, f"{type(err).__name__}: {err}"))
+
+
+class EmbeddingWorkerPool(BaseEmbedding):
+    """
+    Embedding model running in worker processes, each with its own copy of the model and its own thread budget.
+
+    Texts are sorted by length and cut into pieces handed to the next idle worker, each worker buckets its pieces
+    into batches (see `BucketedEmbedding`). The embeddings of a piece are placed back in the order of the texts
+    as soon as it is done, so a slow worker never holds up the others.
+
+    Args:
+        model (str): The Hugging Face model name.
+        workers (int): The number of worker processes.
+        backend (str): "torch", "onnx" or "onnx-int8".
+        batch_tokens (int): The padded tokens per batch of a worker.
+        threads (int): The CPU threads of every worker, 0 to share the CPU cores between the workers.
+        piece_size (int): The texts sent to a worker at once.
+
+    Notes:
+        Workers are spawned rather than forked, forking the Streamlit process and its threads is unsafe, so the
+        model weights are loaded once per worker instead of being shared copy-on-write: each worker holds a copy of
+        the model in memory. The workers live as long as the pool and embed every ingestion. Workers always run on
+        the CPU.
+    """
+
+    _model: str = PrivateAttr()
+    _backend: str = PrivateAttr()
+    _batch_tokens: int = PrivateAttr()
+    _threads: int = PrivateAttr()
+    _piece_size: int = PrivateAttr()
+    _context = PrivateAttr()
+    _workers: list = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+
+    def __init__(self, model: str, workers: int, backend: str = "torch", batch_tokens: int = DEFAULT_BATCH_TOKENS, threads: int = 0,
+                 piece_size: int = DEFAULT_PIECE_SIZE, **kwargs):
+        workers = max(1, int(workers))
+        # int8 embeddings are cached apart from the exact ones, like OnnxEmbedding does
+        super().__init__(model_name=f"{model}@onnx-int8" if backend == "onnx-int8" else model, embed_batch_size=2048, **kwargs)
+        self._model = model
+        self._backend = backend
+        self._batch_tokens = batch_tokens
+        self._threads = int(threads) or max(1, (os.cpu_count() or 1) // workers)
+        self._piece_size = max(1, int(piece_size))
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._workers = []
+        # Workers load the model in parallel
+        starting = [self._start_worker() for _ in range(workers)]
+        try:
+            for process, connection in starting:
+                self._workers.append(self._wait_ready(process, connection))
+        except Exception:
+            for process, connection in starting:
+                stop_worker(process, connection, graceful=False)
+            raise
+        atexit.register(self.close)
+        logs.log.info(f"Started {workers} embedding workers for {model} ({backend}), {self._threads} threads each")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "EmbeddingWorkerPool"
+
+    @property
+    def workers(self) -> int:
+        return len(self._workers)
+
+    def _start_worker(self):
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(target=_embedding_worker,
+                                        args=(child_connection, self._model, self._backend, self._batch_tokens, self._threads),
+                                        daemon=True)
+        process.start()
+        child_connection.close()
+        return process, parent_connection
+
+    def _wait_ready(self, process, connection):
+        # The worker reports once its model is loaded, or why it could not load it
+        if not connection.poll(WORKER_START_TIMEOUT):
+            stop_worker(process, connection, graceful=False)
+            raise Exception(f"Embedding worker did not load {self._model} within {WORKER_START_TIMEOUT}s")
+        try:
+            _, error = connection.recv()
+        except (EOFError, OSError):
+            process.join(timeout=5)
+            error = f"worker process exited with code {process.exitcode}"
+        if error is not None:
+            stop_worker(process, connection, graceful=False)
+            raise Exception(f"Embedding worker could not load {self._model}: {error}")
+        return process, connection
+
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+        self._stop_workers(graceful=True)
+
+    def _stop_workers(self, graceful: bool):
+        workers, self._workers = self._workers, []
+        for process, connection in workers:
+            stop_worker(process, connection, graceful=graceful)
+
+    ###################################
+    # Embed
+    ###################################
+
+    def _embed(self, sentences: List[str], prompt_name: str = None) -> List[List[float]]:
+        if len(sentences) == 0:
+            return []
+        order = sorted(range(len(sentences)), key=lambda position: len(sentences[position]))
+        pending = deque(order[start:start + self._piece_size] for start in range(0, len(order), self._piece_size))
+        embeddings = [None] * len(sentences)
+        with self._lock:
+            if not self._workers:
+                raise Exception("Embedding workers are stopped")
+            idle = list(self._workers)
+            busy = {}  # connection -> (process, positions)
+            error = None
+            dead = 0
+            try:
+                while (pending and error is None) or busy:
+                    while pending and idle and error is None:
+                        process, connection = idle.pop()
+                        positions = pending.popleft()
+                        connection.send(([sentences[position] for position in positions], prompt_name))
+                        busy[connection] = (process, positions)
+                    for connection in wait(list(busy)):
+                        process, positions = busy.pop(connection)
+                        try:
+                            piece_embeddings, piece_error = connection.recv()
+                        except (EOFError, OSError):
+                            # The worker died, e.g. it ran out of memory: the embedding fails and it is replaced below
+                            process.join(timeout=5)
+                            stop_worker(process, connection, graceful=False)
+                            error = f"embedding worker exited with code {process.exitcode}"
+                            self._workers.remove((process, connection))
+                            dead += 1
+                            continue
+                        idle.append((process, connection))
+                        if piece_error is not None:
+                            error = piece_error
+                            continue
+                        for position, embedding in zip(positions, piece_embeddings):
+                            embeddings[position] = embedding.tolist()
+            except BaseException:
+                # A reply still owed by a busy worker would be read as the reply of the next embedding
+                self._stop_workers(graceful=False)
+                raise
+            # Replaced once every piece was answered, so a worker failing to start leaves no reply unread
+            for _ in range(dead):
+                self._workers.append(self._wait_ready(*self._start_worker()))
+            if error is not None:
+                logs.log.error(f"Embedding failed: {error}")
+                raise Exception(f"Embedding failed: {error}")
+        return embeddings
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed([query], prompt_name="query")[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed([text], prompt_name="text")[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, prompt_name="text")
@@ -0,0 +1,438 @@
+import os
+import uuid
+
+import utils.logs as logs
+
+from utils.document_parsing import DEFAULT_PARSE_TIMEOUT, parse_files
+from utils.embedding_cache import hash_text
+from utils.document_manifest import manifest_entry, read_document_manifest, write_document_manifest
+from utils.index_lock import index_lock
+from utils.index_manifest import read_index_manifest, write_index_manifest
+from utils.metadata_index import DUPLICATE_SOURCES_KEY
+from utils.sharded_vector_store import load_vector_store
+
+from llama_index.core import VectorStoreIndex, StorageContext, load_index_from_storage
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode, NodeRelationship, RelatedNodeInfo, TextNode
+
+# Node metadata holding the hash of the normalized chunk text, the other files containing the same chunk are
+# listed under DUPLICATE_SOURCES_KEY
+CHUNK_HASH_KEY = "chunk_hash"
+
+
+###################################
+#
+# Open Index
+#
+###################################
+
+
+def open_index(persist_dir: str, embedding_model: str, vector_store_factory):
+    """
+    Opens the index persisted in a directory so documents can be added to or removed from it.
+
+    Args:
+        persist_dir (str): The directory the index is persisted to.
+        embedding_model (str): The embedding model used for the new embeddings.
+        vector_store_factory (callable): Returns the empty vector store of a new index.
+
+    Returns:
+        tuple: The `VectorStoreIndex` and its document manifest.
+
+    Notes:
+        A new, empty index is returned if nothing was persisted yet, or if the persisted index was embedded with
+        another model, since its embeddings cannot be compared with the new ones. The vector store keeps the
+        type it was persisted with, `vector_store_factory` is only used for a new index.
+
+        An index persisted before document manifests existed gets one built from its docstore, grouping the
+        documents by file name. Those files have no hash yet, so uploading them again replaces them once.
+    """
+    index_manifest = read_index_manifest(persist_dir)
+    if index_manifest is not None:
+        if index_manifest.get("embedding_model") not in (None, embedding_model):
+            logs.log.warning(f"Index in {persist_dir} was embedded with {index_manifest.get('embedding_model')}, starting a new index for {embedding_model}")
+        else:
+            try:
+                # Ingestion runs in the Streamlit process, shards are searched in it instead of in worker processes
+                storage_context = StorageContext.from_defaults(persist_dir=persist_dir,
+                                                               vector_store=load_vector_store(persist_dir, max_workers=1))
+                index = load_index_from_storage(storage_context, show_progress=True)
+                manifest = read_document_manifest(persist_dir) or bootstrap_document_manifest(index)
+                # Indexes persisted before the vector store rows carried the duplicate sources get them now
+                write_node_metadata(index, [node for node in index.docstore.docs.values() if node.metadata.get(DUPLICATE_SOURCES_KEY)])
+                logs.log.info(f"Opened index in {persist_dir} with {len(manifest['files']):,} files")
+                return index, manifest
+            except Exception as err:
+                logs.log.error(f"Unable to open the index in {persist_dir}, starting a new index: {err}")
+
+    index = VectorStoreIndex(nodes=[], storage_context=StorageContext.from_defaults(vector_store=vector_store_factory()))
+    return index, {"files": {}}
+
+
+def bootstrap_document_manifest(index: VectorStoreIndex):
+    """
+    Returns a document manifest listing the documents of an index by file name, without content hashes.
+    """
+    files = {}
+    for ref_doc_id, ref_doc_info in index.ref_doc_info.items():
+        source = ref_doc_info.metadata.get("file_name") or ref_doc_id
+        entry = files.setdefault(source, manifest_entry(None, [], 0))
+        entry["ref_doc_ids"].append(ref_doc_id)
+        entry["node_count"] += len(ref_doc_info.node_ids)
+    logs.log.info(f"Built a document manifest for {len(files):,} files from the docstore")
+    return {"files": files}
+
+
+###################################
+#
+# Upsert / Remove Source Files
+#
+###################################
+
+
+def source_of(metadata: dict, data_dir: str):
+    """
+    Returns the source path of a document or node, relative to the directory its file was loaded from.
+    """
+    file_path = metadata.get("file_path", "")
+    return os.path.relpath(file_path, data_dir) if os.path.isabs(file_path) else file_path
+
+
+def write_node_metadata(index: VectorStoreIndex, nodes: list):
+    """
+    Writes the metadata of stored nodes to the docstore and to their vector store rows, so metadata filters
+    (e.g. on the file names of `duplicate_sources`) see it.
+    """
+    if not nodes:
+        return
+    index.docstore.add_documents(nodes, allow_update=True)
+    if hasattr(index.vector_store, "update_metadata"):
+        index.vector_store.update_metadata({node.node_id: dict(node.metadata) for node in nodes})
+
+
+def nodes_of_source(index: VectorStoreIndex, entry: dict):
+    """
+    Returns the nodes stored for a manifest entry, read from the docstore.
+    """
+    node_ids = []
+    for ref_doc_id in entry["ref_doc_ids"]:
+        ref_doc_info = index.docstore.get_ref_doc_info(ref_doc_id)
+        if ref_doc_info is not None:
+            node_ids.extend(ref_doc_info.node_ids)
+    return index.docstore.get_nodes(node_ids, raise_error=False)
+
+
+def nodes_shared_with(index: VectorStoreIndex, source: str):
+    """
+    Returns the nodes stored once for several files that list `source` among their duplicate sources.
+    """
+    return [node for node in index.docstore.docs.values() if source in node.metadata.get(DUPLICATE_SOURCES_KEY, ())]
+
+
+def remove_source(index: VectorStoreIndex, manifest: dict, source: str):
+    """
+    Removes every node of a source file from the index and the manifest.
+
+    Returns:
+        int: The number of nodes removed.
+
+    Notes:
+        A node also referenced by other files (see `upsert_documents`) is inserted again for the first of them,
+        which becomes its owner. Only those nodes are embedded again.
+    """
+    entry = manifest["files"].pop(source, None)
+    if entry is None:
+        return 0
+
+    # The file no longer references chunks owned by other files
+    shared = nodes_shared_with(index, source)
+    for node in shared:
+        node.metadata[DUPLICATE_SOURCES_KEY] = [other for other in node.metadata[DUPLICATE_SOURCES_KEY] if other != source]
+    write_node_metadata(index, shared)
+
+    owned = [node for node in nodes_of_source(index, entry) if node.metadata.get(DUPLICATE_SOURCES_KEY)]
+    for ref_doc_id in entry["ref_doc_ids"]:
+        index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+
+    new_owners = set()
+    rehomed = []
+    for node in owned:
+        owners = [other for other in node.metadata[DUPLICATE_SOURCES_KEY] if other in manifest["files"]]
+        if len(owners) == 0:
+            continue
+        owner, *others = owners
+        owner_entry = manifest["files"][owner]
+        if len(owner_entry["ref_doc_ids"]) == 0:
+            owner_entry["ref_doc_ids"].append(str(uuid.uuid4()))
+        owner_entry.pop("duplicate_of", None)
+        owner_entry["node_count"] += 1
+        new_owners.add(owner)
+        # The owner may be in another folder than the removed file, only the part of the path after the data directory is replaced
+        file_path = node.metadata.get("file_path")
+        if file_path and file_path.endswith(source):
+            file_path = file_path[: len(file_path) - len(source)] + owner
+        elif file_path:
+            file_path = os.path.join(os.path.dirname(file_path), owner)
+        rehomed.append(TextNode(
+            text=node.get_content(metadata_mode=MetadataMode.NONE),
+            metadata={**node.metadata,
+                      "file_name": os.path.basename(owner),
+                      "file_path": file_path or owner,
+                      DUPLICATE_SOURCES_KEY: others},
+            excluded_embed_metadata_keys=node.excluded_embed_metadata_keys,
+            excluded_llm_metadata_keys=node.excluded_llm_metadata_keys,
+            relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=owner_entry["ref_doc_ids"][0])},
+        ))
+    index.insert_nodes(rehomed)
+
+    # Whole-file duplicates of the removed file now point to the file that took over its chunks
+    for other, other_entry in manifest["files"].items():
+        if other_entry.get("duplicate_of") == source:
+            other_entry["duplicate_of"] = min(new_owners) if new_owners and other not in new_owners else None
+    logs.log.info(f"Removed {source} ({entry['node_count']:,} nodes, {len(rehomed):,} kept for duplicate files) from the index")
+    return entry["node_count"] - len(rehomed)
+
+
+def split_documents(documents: list, chunk_size: int, chunk_overlap: int):
+    """
+    Splits documents into nodes with the user's chunk size and overlap, or the llama-index defaults if those fail.
+    """
+    try:
+        return run_transformations(documents,
+                                   [SentenceSplitter(chunk_size=chunk_size,
+                                                     chunk_overlap=chunk_overlap,
+                                                     separator=".",
+                                                     paragraph_separator='\n\n')],
+                                   show_progress=True)
+    except Exception as err:
+        logs.log.error(f"Splitting failed with user defined chunk size and chunk overlap: {err}")
+        return run_transformations(documents, [SentenceSplitter()], show_progress=True)
+
+
+def chunk_registry(index: VectorStoreIndex):
+    """
+    Returns {chunk hash: node id} of every node in the index.
+    """
+    registry = {}
+    for node_id, node in index.docstore.docs.items():
+        chunk_hash = node.metadata.get(CHUNK_HASH_KEY)
+        if chunk_hash is not None:
+            registry.setdefault(chunk_hash, node_id)
+    return registry
+
+
+def tag_chunk(node):
+    """
+    Records the hash of the normalized chunk text in the node metadata, excluded from the embedded and LLM text.
+    """
+    node.metadata[CHUNK_HASH_KEY] = hash_text(node.get_content(metadata_mode=MetadataMode.NONE))
+    node.metadata.setdefault(DUPLICATE_SOURCES_KEY, [])
+    for keys in (node.excluded_embed_metadata_keys, node.excluded_llm_metadata_keys):
+        keys.extend(key for key in (CHUNK_HASH_KEY, DUPLICATE_SOURCES_KEY) if key not in keys)
+    return node.metadata[CHUNK_HASH_KEY]
+
+
+def add_duplicate_source(node, source: str, updated: dict):
+    sources = node.metadata.setdefault(DUPLICATE_SOURCES_KEY, [])
+    if source not in sources:
+        sources.append(source)
+        updated[node.node_id] = node
+
+
+def upsert_documents(index: VectorStoreIndex, manifest: dict, documents: list, data_dir: str, hashes: dict, chunk_size: int, chunk_overlap: int, duplicates: dict = None, registry: dict = None):
+    """
+    Adds the documents loaded from new or changed source files to the index, replacing the previous version
+    of each file.
+
+    Args:
+        index (VectorStoreIndex): The index opened with `open_index`.
+        manifest (dict): Its document manifest, updated in place.
+        documents (list): The documents loaded from the changed files only.
+        data_dir (str): The directory the files were loaded from.
+        hashes (dict): {source path: sha256} of the changed files.
+        chunk_size (int): The chunk size of the node parser.
+        chunk_overlap (int): The chunk overlap of the node parser.
+        duplicates (dict, optional): {source path: source path of an identical file}, for the changed files that
+            are byte-identical to another file (see `document_manifest.find_duplicate_files`). They are not loaded.
+        registry (dict, optional): The `chunk_registry` of the index, kept up to date across calls, and built
+            again after files are replaced. Built from the docstore if not given.
+
+    Returns:
+        dict: The number of chunks, of chunks inserted (and embedded unless cached), and of duplicate chunks
+        and the bytes of their text, which were not inserted.
+
+    Notes:
+        Only the nodes of the given documents are embedded, every other file keeps its nodes and embeddings.
+
+        A chunk whose normalized text is already stored, by another file or earlier in the same file, is not
+        inserted again. The stored node lists the other files in its `duplicate_sources` metadata instead, and
+        a byte-identical file only adds itself to the nodes of the file it duplicates.
+    """
+    duplicates = duplicates or {}
+    removed = [source for source in hashes if source in manifest["files"]]
+    for source in removed:
+        remove_source(index, manifest, source)
+
+    sources = {}
+    for document in documents:
+        sources.setdefault(source_of(document.metadata, data_dir), []).append(document)
+
+    report = {"chunks": 0, "inserted": 0, "duplicate_chunks": 0, "duplicate_bytes": 0}
+    if registry is None:
+        registry = chunk_registry(index)
+    elif removed:
+        # Removed nodes are gone and shared ones were inserted again under new ids, the registry given is updated in place
+        registry.clear()
+        registry.update(chunk_registry(index))
+    updated = {}
+    for source, file_hash in hashes.items():
+        if source in duplicates:
+            continue
+        source_documents = sources.get(source, [])
+        nodes = split_documents(source_documents, chunk_size, chunk_overlap) if source_documents else []
+        new_nodes, pending = [], {}
+        for node in nodes:
+            chunk_hash = tag_chunk(node)
+            stored_id = registry.get(chunk_hash)
+            if stored_id is None:
+                registry[chunk_hash] = node.node_id
+                pending[node.node_id] = node
+                new_nodes.append(node)
+                continue
+            report["duplicate_chunks"] += 1
+            report["duplicate_bytes"] += len(node.get_content(metadata_mode=MetadataMode.NONE).encode("utf-8"))
+            if stored_id in pending:
+                # Repeated within the file itself
+                continue
+            stored = updated.get(stored_id) or index.docstore.get_node(stored_id)
+            # Compared by path, files with the same name in different folders are different sources
+            if source_of(stored.metadata, data_dir) != source:
+                add_duplicate_source(stored, source, updated)
+        index.insert_nodes(new_nodes)
+        manifest["files"][source] = manifest_entry(file_hash, [document.doc_id for document in source_documents], len(new_nodes))
+        report["chunks"] += len(nodes)
+        report["inserted"] += len(new_nodes)
+        logs.log.info(f"Indexed {source} ({len(new_nodes):,} nodes, {len(nodes) - len(new_nodes):,} duplicate chunks)")
+
+    # Identical files reference the nodes of the file they duplicate, processed after it in case both are new
+    for source, primary in duplicates.items():
+        for node in nodes_of_source(index, manifest["files"][primary]):
+            add_duplicate_source(updated.get(node.node_id, node), source, updated)
+        manifest["files"][source] = {**manifest_entry(hashes[source], [], 0), "duplicate_of": primary}
+        logs.log.info(f"{source} is identical to {primary}, its chunks are not indexed again")
+
+    # Nodes inserted above are already in the docstore and the vector store, only stored nodes that gained a source
+    # are written again
+    write_node_metadata(index, list(updated.values()))
+    return report
+
+
+###################################
+#
+# Persist Index
+#
+###################################
+
+
+def persist_index(index: VectorStoreIndex, manifest: dict, persist_dir: str, **details):
+    """
+    Persists the index, then its document manifest, then the index manifest.
+
+    Args:
+        index (VectorStoreIndex): The updated index.
+        manifest (dict): Its document manifest.
+        persist_dir (str): The directory to persist to.
+        **details: Recorded in the index manifest (e.g. embedding model).
+
+    Notes:
+        The index manifest is written last so the API only reloads a completely persisted index. The write lock
+        of the directory is held meanwhile, so a compaction never persists at the same time.
+    """
+    with index_lock(persist_dir):
+        index.storage_context.persist(persist_dir=persist_dir)
+        write_document_manifest(persist_dir, manifest)
+        return write_index_manifest(persist_dir, files=len(manifest["files"]), **details)
+
+
+###################################
+#
+# Streaming Ingestion
+#
+###################################
+
+
+def ingest_in_batches(index: VectorStoreIndex, manifest: dict, data_dir: str, hashes: dict, persist_dir: str, chunk_size: int, chunk_overlap: int,
+                      duplicates: dict = None, batch_files: int = 16, workers: int = 0, timeout: float = DEFAULT_PARSE_TIMEOUT, **details):
+    """
+    Parses, chunks, embeds and persists new or changed source files a fixed number of files at a time.
+
+    Args:
+        index (VectorStoreIndex): The index opened with `open_index`.
+        manifest (dict): Its document manifest, updated in place.
+        data_dir (str): The directory holding the files.
+        hashes (dict): {source path: sha256} of the changed files.
+        persist_dir (str): The directory the index is persisted to after each batch.
+        chunk_size (int): The chunk size of the node parser.
+        chunk_overlap (int): The chunk overlap of the node parser.
+        duplicates (dict, optional): {source path: source path of an identical file}, indexed after all the
+            other files so their primary is indexed first.
+        batch_files (int): The number of files parsed and embedded together.
+        workers (int): The number of processes parsing files, see `document_parsing.parse_files`.
+        timeout (float): Seconds a single file may take to parse, 0 for no limit.
+        **details: Recorded in the index manifest (e.g. embedding model).
+
+    Yields:
+        tuple: The sources of each committed batch, the `upsert_documents` report of the batch and
+        {source: reason} of its files that failed to parse.
+
+    Notes:
+        Only the parsed documents of one batch are held in memory, the nodes of every batch stay in the docstore
+        of `index`. Each batch is persisted together with its manifest entries and its files are then removed
+        from `data_dir`, so an ingestion interrupted midway resumes from the last committed batch: the files of
+        earlier batches match the manifest by hash and are skipped, the files left in `data_dir` are ingested.
+
+        Persisting a batch writes the vector store incrementally but rewrites the whole docstore.json, so the
+        writes of an ingestion grow with the square of the corpus size and the docstore is held in memory. A
+        larger `batch_files` means fewer of these rewrites at the cost of more work lost on an interruption.
+
+        Files that fail to parse, and the copies of a failed file, keep their previous version if any and are not
+        recorded in the manifest.
+    """
+    duplicates = duplicates or {}
+    batch_files = max(1, int(batch_files))
+    sources = [source for source in hashes if source not in duplicates]
+    registry = chunk_registry(index)
+    failed = set()
+
+    for start in range(0, len(sources), batch_files):
+        batch = sources[start:start + batch_files]
+        documents, failures = parse_files([os.path.join(data_dir, source) for source in batch], workers=workers, timeout=timeout)
+        failures = {os.path.relpath(path, data_dir): reason for path, reason in failures.items()}
+        failed.update(failures)
+        report = upsert_documents(index, manifest, documents, data_dir,
+                                  {source: hashes[source] for source in batch if source not in failures},
+                                  chunk_size, chunk_overlap, registry=registry)
+        del documents
+        persist_index(index, manifest, persist_dir, **details)
+        _remove_files(data_dir, batch)
+        logs.log.info(f"Committed batch of {len(batch):,} files ({start + len(batch):,} of {len(sources):,}): {report}")
+        yield batch, report, failures
+
+    # Identical files only reference the nodes of their primary, which is committed by now
+    copies = {source: primary for source, primary in duplicates.items() if primary not in failed}
+    if duplicates:
+        report = upsert_documents(index, manifest, [], data_dir, {source: hashes[source] for source in copies},
+                                  chunk_size, chunk_overlap, duplicates=copies, registry=registry)
+        if copies:
+            persist_index(index, manifest, persist_dir, **details)
+        _remove_files(data_dir, list(duplicates))
+        yield list(copies), report, {}
+
+
+def _remove_files(data_dir: str, sources: list):
+    for source in sources:
+        try:
+            os.remove(os.path.join(data_dir, source))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,226 @@
+import os
+import re
+import heapq
+import threading
+
+from collections import OrderedDict
+from typing import List
+
+import utils.logs as logs
+
+from utils.index_manifest import MANIFEST_FILE
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+# The collection persisted at the root of the persist directory, where the index lived before collections
+DEFAULT_COLLECTION = "default"
+
+# Sub-directory of the persist directory holding one directory per named collection
+COLLECTIONS_DIR = "collections"
+
+COLLECTION_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+
+
+###################################
+#
+# Collection Directories
+#
+###################################
+
+
+def validate_collection_name(name: str):
+    """
+    Returns the collection name, or raises if it cannot be used as a directory name.
+    """
+    if not isinstance(name, str) or not COLLECTION_NAME.match(name):
+        raise Exception(f"Invalid collection name {name!r}: use up to 64 letters, digits, '-' or '_'")
+    return name
+
+
+def collection_dir(persist_dir: str, name: str = DEFAULT_COLLECTION):
+    """
+    Returns the directory a collection is persisted to.
+
+    Args:
+        persist_dir (str): The root persist directory (vector_db).
+        name (str): The collection name. The default collection lives in `persist_dir` itself, so indexes
+            persisted before collections existed are its content.
+    """
+    if validate_collection_name(name) == DEFAULT_COLLECTION:
+        return persist_dir
+    return os.path.join(persist_dir, COLLECTIONS_DIR, name)
+
+
+def has_index(directory: str):
+    """
+    Returns True if an index is persisted in a directory. Indexes persisted before index manifests existed (e.g.
+    the committed vector_db) only have their docstore.
+    """
+    return os.path.exists(os.path.join(directory, MANIFEST_FILE)) or os.path.exists(os.path.join(directory, "docstore.json"))
+
+
+def list_collections(persist_dir: str):
+    """
+    Returns the sorted names of the collections with a persisted index.
+    """
+    names = []
+    if has_index(persist_dir):
+        names.append(DEFAULT_COLLECTION)
+    root = os.path.join(persist_dir, COLLECTIONS_DIR)
+    if os.path.isdir(root):
+        for name in sorted(os.listdir(root)):
+            if COLLECTION_NAME.match(name) and has_index(os.path.join(root, name)):
+                names.append(name)
+    return names
+
+
+def directory_size(path: str, skip: str = None):
+    """
+    Returns the total size in bytes of the files under a directory, not descending into `skip`.
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        if skip is not None:
+            dirs[:] = [name for name in dirs if os.path.join(root, name) != skip]
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+###################################
+#
+# Loaded Collections (LRU)
+#
+###################################
+
+
+class LoadedCollection:
+    """
+    A collection loaded in memory, with the query engines and batch embedding matrix built on it.
+
+    Args:
+        name (str): The collection name.
+        index (VectorStoreIndex): The loaded index.
+        version (str): The index manifest version it was loaded at.
+        memory (int): The approximate memory it takes, in bytes.
+    """
+
+    def __init__(self, name: str, index, version, memory: int):
+        self.name = name
+        self.index = index
+        self.version = version
+        self.memory = memory
+        self.query_engines = OrderedDict()
+        self.embedding_matrix = None
+
+
+class CollectionCache:
+    """
+    Loads collections on first use and keeps the most recently used ones.
+
+    A collection is evicted, least recently used first, once more than `max_loaded` are loaded or their
+    approximate memory exceeds `max_memory_mb`. The most recently used collection is always kept.
+
+    Args:
+        loader (callable): Returns the `LoadedCollection` of a collection name, raises if it does not exist.
+        max_loaded (int): The maximum number of loaded collections, 0 for no limit.
+        max_memory_mb (float): The memory budget of the loaded collections in MB, 0 for no limit.
+    """
+
+    def __init__(self, loader, max_loaded: int = 4, max_memory_mb: float = 0):
+        self._loader = loader
+        self.max_loaded = max_loaded
+        self.max_memory = max_memory_mb * 2**20
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def get(self, name: str):
+        """
+        Returns the loaded collection, loading it (once, even for concurrent callers) if needed.
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+                return entry
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(name)
+            if entry is None:
+                entry = self._loader(name)
+                self.put(entry)
+            return entry
+
+    def put(self, entry: LoadedCollection):
+        """
+        Adds or replaces a loaded collection, then evicts the least recently used ones over the limits.
+        """
+        with self._lock:
+            self._entries[entry.name] = entry
+            self._entries.move_to_end(entry.name)
+            evicted = self._evict()
+        for old_entry in evicted:
+            release = getattr(old_entry.index.vector_store, "release", None)
+            if release is not None:
+                release()
+            logs.log.info(f"Collection {old_entry.name} evicted ({old_entry.memory / 2**20:,.1f} MB)")
+
+    def _evict(self):
+        evicted = []
+        while len(self._entries) > 1:
+            memory = sum(entry.memory for entry in self._entries.values())
+            over_count = self.max_loaded and len(self._entries) > self.max_loaded
+            over_memory = self.max_memory and memory > self.max_memory
+            if not over_count and not over_memory:
+                break
+            evicted.append(self._entries.popitem(last=False)[1])
+        return evicted
+
+    def peek(self, name: str):
+        """
+        Returns the collection if it is loaded, without loading it or changing the LRU order.
+        """
+        with self._lock:
+            return self._entries.get(name)
+
+    def loaded(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+###################################
+#
+# Retrieve From Several Collections
+#
+###################################
+
+
+class MultiCollectionRetriever(BaseRetriever):
+    """
+    Retrieves from the retriever of every collection and keeps the top_k nodes by score overall.
+
+    Args:
+        retrievers (list): One retriever per collection.
+        top_k (int): The number of nodes returned.
+    """
+
+    def __init__(self, retrievers: List[BaseRetriever], top_k: int):
+        super().__init__()
+        self._retrievers = retrievers
+        self._top_k = top_k
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = []
+        for retriever in self._retrievers:
+            nodes.extend(retriever.retrieve(query_bundle))
+        return heapq.nlargest(self._top_k, nodes, key=lambda node: node.score or 0.0)
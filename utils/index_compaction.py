@@ -0,0 +1,140 @@
+import os
+import json
+import argparse
+
+import utils.logs as logs
+
+from utils.index_collections import COLLECTIONS_DIR, DEFAULT_COLLECTION, collection_dir, directory_size
+from utils.index_lock import IndexBusyError, index_lock
+from utils.index_manifest import get_index_version, read_index_manifest, write_index_manifest
+from utils.sharded_vector_store import load_vector_store
+
+from llama_index.core import Settings, StorageContext, load_index_from_storage
+
+
+###################################
+#
+# Garbage Collection
+#
+###################################
+
+
+def collect_garbage(index):
+    """
+    Removes the entries of the index that nothing refers to anymore.
+
+    Args:
+        index (VectorStoreIndex): The loaded index, with its text in the docstore.
+
+    Returns:
+        dict: The number of index entries without an embedding, docstore nodes outside the index and
+        embeddings without a node that were removed.
+
+    Notes:
+        They are left over by an ingestion interrupted between writing the vector store and the docstore. Removed
+        documents only leave deleted rows in the vector store, which `compact()` drops afterwards.
+    """
+    vector_store = index.vector_store
+    docstore = index.storage_context.docstore
+    index_struct = index.index_struct
+
+    live_rows = set(vector_store.node_ids)
+    dangling_entries = [vector_id for vector_id in index_struct.nodes_dict if vector_id not in live_rows]
+    for vector_id in dangling_entries:
+        index_struct.delete(vector_id)
+
+    indexed = set(index_struct.nodes_dict.values())
+    orphan_nodes = [node_id for node_id in docstore.docs if node_id not in indexed]
+    for node_id in orphan_nodes:
+        docstore.delete_document(node_id, raise_error=False)
+
+    orphan_embeddings = [node_id for node_id in live_rows if node_id not in index_struct.nodes_dict]
+    if orphan_embeddings:
+        vector_store.delete_nodes(orphan_embeddings)
+
+    # Documents whose nodes were all removed above
+    for ref_doc_id, ref_doc_info in (docstore.get_all_ref_doc_info() or {}).items():
+        if not any(node_id in indexed for node_id in ref_doc_info.node_ids):
+            docstore.delete_ref_doc(ref_doc_id, raise_error=False)
+
+    index.storage_context.index_store.add_index_struct(index_struct)
+    return {
+        "dangling_entries": len(dangling_entries),
+        "orphan_nodes": len(orphan_nodes),
+        "orphan_embeddings": len(orphan_embeddings),
+    }
+
+
+###################################
+#
+# Compact Index
+#
+###################################
+
+
+def compact_index(persist_dir: str):
+    """
+    Rewrites the index persisted in a directory without its deleted and orphaned entries.
+
+    Args:
+        persist_dir (str): The directory the index is persisted to.
+
+    Returns:
+        dict: The garbage collected, the vector rows removed and the size of the directory before and after, in bytes.
+
+    Notes:
+        The index is loaded and compacted without any lock, the API keeps serving the current files meanwhile. The
+        write lock is only held to persist; if the index was persisted by someone else in between the compaction
+        is abandoned with `IndexBusyError` rather than overwriting their changes. The vector store is written to new
+        files, so the API switches to the compacted index on its next manifest poll, like after an ingestion.
+    """
+    index_manifest = read_index_manifest(persist_dir)
+    if index_manifest is None or not os.path.exists(os.path.join(persist_dir, "docstore.json")):
+        raise FileNotFoundError(f"No index persisted in {persist_dir}")
+    version = index_manifest.get("version")
+    # Named collections live under the persist directory of the default collection
+    skip = os.path.join(persist_dir, COLLECTIONS_DIR)
+    size_before = directory_size(persist_dir, skip=skip)
+
+    # Shards are compacted in this process, like during ingestion
+    storage_context = StorageContext.from_defaults(persist_dir=persist_dir,
+                                                   vector_store=load_vector_store(persist_dir, max_workers=1))
+    index = load_index_from_storage(storage_context)
+    report = collect_garbage(index)
+    report["rows_removed"] = index.vector_store.compact()
+
+    with index_lock(persist_dir):
+        if get_index_version(persist_dir) != version:
+            raise IndexBusyError(f"Index in {persist_dir} changed during compaction, run it again")
+        index.storage_context.persist(persist_dir=persist_dir)
+        details = {key: value for key, value in index_manifest.items() if key not in ("version", "created_at")}
+        write_index_manifest(persist_dir, **details)
+
+    report["size_before"] = size_before
+    report["size_after"] = directory_size(persist_dir, skip=skip)
+    logs.log.info(f"Compacted index in {persist_dir} from {size_before / 2**20:,.1f} MB to {report['size_after'] / 2**20:,.1f} MB: {report}")
+    return report
+
+
+###################################
+#
+# Command Line
+#
+###################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rewrite a persisted index without its deleted and orphaned entries.")
+    parser.add_argument("--persist-dir", default="vector_db", help="The root persist directory.")
+    parser.add_argument("--collection", default=DEFAULT_COLLECTION, help="The collection to compact.")
+    args = parser.parse_args()
+
+    # Nothing is embedded, the embedding model does not need to be loaded
+    Settings.embed_model = None
+    report = compact_index(collection_dir(args.persist_dir, args.collection))
+    print(json.dumps(report, indent=4))
+    print(f"{report['size_before'] / 2**20:,.1f} MB -> {report['size_after'] / 2**20:,.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import os
+import time
+
+from contextlib import contextmanager
+
+import utils.logs as logs
+
+# Created in the persist directory while the index is written, so ingestion and compaction never persist at once
+LOCK_FILE = ".index.lock"
+
+# A lock older than this is left over by a process that died while writing, and is taken over
+LOCK_STALE_SECONDS = 600
+
+
+class IndexBusyError(Exception):
+    """
+    Raised when the index is being written by another process, or changed while it was being compacted.
+    """
+
+
+###################################
+#
+# Persist Lock
+#
+###################################
+
+
+@contextmanager
+def index_lock(persist_dir: str, timeout: float = 60.0):
+    """
+    Holds the write lock of a persist directory.
+
+    Args:
+        persist_dir (str): The directory the index is persisted to.
+        timeout (float): Seconds to wait for another writer to finish before raising `IndexBusyError`.
+
+    Notes:
+        The lock is a file created exclusively, so it also works between the Streamlit app, the API and the
+        compaction CLI. Readers never take it: they only load an index once its manifest is written.
+    """
+    os.makedirs(persist_dir, exist_ok=True)
+    lock_path = os.path.join(persist_dir, LOCK_FILE)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > LOCK_STALE_SECONDS:
+                    logs.log.warning(f"Removing stale index lock {lock_path}")
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise IndexBusyError(f"Index in {persist_dir} is being written by another process")
+            time.sleep(0.1)
+
+    try:
+        os.write(lock_fd, str(os.getpid()).encode("utf-8"))
+        os.close(lock_fd)
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
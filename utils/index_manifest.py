@@ -0,0 +1,86 @@
+import os
+import json
+import uuid
+
+from datetime import datetime, timezone
+
+import utils.logs as logs
+
+# Written into the persist directory after every successful persist of the index.
+# Readers compare its version to detect that a new index is available.
+MANIFEST_FILE = "index_manifest.json"
+
+
+###################################
+#
+# Write Index Manifest
+#
+###################################
+
+
+def write_index_manifest(persist_dir: str, **details):
+    """
+    Writes a new index manifest with a fresh version into the persist directory.
+
+    Args:
+        persist_dir (str): The directory the index was persisted to.
+        **details: Extra JSON serializable values recorded in the manifest (e.g. embedding model).
+
+    Returns:
+        str: The version written to the manifest.
+
+    Notes:
+        The manifest must be written after the index files, it is what tells readers the persisted index is complete.
+        It is written to a temporary file and renamed so readers never see a partially written manifest.
+    """
+    version = uuid.uuid4().hex
+    manifest = {
+        "version": version,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        **details,
+    }
+
+    manifest_path = os.path.join(persist_dir, MANIFEST_FILE)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+    logs.log.info(f"Index manifest version {version} written to {persist_dir}")
+    return version
+
+
+###################################
+#
+# Read Index Manifest
+#
+###################################
+
+
+def read_index_manifest(persist_dir: str):
+    """
+    Reads the index manifest from the persist directory.
+
+    Args:
+        persist_dir (str): The directory the index was persisted to.
+
+    Returns:
+        dict: The manifest, or None if the index was persisted before manifests existed or is unreadable.
+    """
+    manifest_path = os.path.join(persist_dir, MANIFEST_FILE)
+    try:
+        with open(manifest_path, "r") as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        logs.log.warning(f"Unable to read index manifest {manifest_path}: {err}")
+        return None
+
+
+def get_index_version(persist_dir: str):
+    """
+    Returns the version of the index persisted in the directory, or None if it has no manifest.
+    """
+    manifest = read_index_manifest(persist_dir)
+    return manifest.get("version") if manifest else None
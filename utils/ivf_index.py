@@ -0,0 +1,187 @@
+import os
+
+import numpy as np
+
+import utils.logs as logs
+
+from utils.vector_search import normalize_rows, top_k_from_scores
+
+# Number of rows scored against the centroids at a time, bounds the (rows x lists) score matrix
+ASSIGN_BLOCK = 65536
+
+# Training points per list, k-means runs on a sample of this many rows per list
+TRAINING_POINTS_PER_LIST = 64
+
+
+###################################
+#
+# Spherical K-Means
+#
+###################################
+
+
+def assign_to_centroids(matrix, centroids):
+    """
+    Assigns every row to its most similar centroid.
+
+    Args:
+        matrix (np.ndarray): Normalized rows, shape (rows, dim). May be a memmap, it is read block by block.
+        centroids (np.ndarray): Normalized centroids, shape (lists, dim).
+
+    Returns:
+        np.ndarray: The list number of every row.
+    """
+    assignments = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], ASSIGN_BLOCK):
+        block = np.asarray(matrix[start:start + ASSIGN_BLOCK], dtype=np.float32)
+        assignments[start:start + block.shape[0]] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(matrix, n_lists: int, iterations: int = 10, seed: int = 0):
+    """
+    Clusters normalized rows by cosine similarity.
+
+    Args:
+        matrix (np.ndarray): Normalized rows, shape (rows, dim).
+        n_lists (int): The number of clusters.
+        iterations (int): The number of assignment/update rounds.
+        seed (int): Seed of the sampling and initialization.
+
+    Returns:
+        np.ndarray: The normalized centroids, shape (n_lists, dim).
+
+    Notes:
+        Training runs on a random sample of TRAINING_POINTS_PER_LIST rows per list, the full matrix is only
+        read once afterwards to fill the inverted lists. Empty clusters are re-seeded with random sample rows.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(matrix.shape[0], n_lists * TRAINING_POINTS_PER_LIST)
+    sample_rows = np.sort(rng.choice(matrix.shape[0], sample_size, replace=False))
+    sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = assign_to_centroids(sample, centroids)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=n_lists)
+        non_empty = np.flatnonzero(counts)
+        # Sums of the rows of every non-empty cluster in one pass over the sorted sample
+        sums = np.add.reduceat(sample[order], np.concatenate(([0], np.cumsum(counts)[:-1]))[non_empty], axis=0)
+        centroids[non_empty] = normalize_rows(sums)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty) > 0:
+            centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+    return centroids
+
+
+###################################
+#
+# IVF Index
+#
+###################################
+
+
+class IVFIndex:
+    """
+    Inverted file index over the rows of an embedding matrix.
+
+    The rows are clustered with spherical k-means, and every row is stored in the inverted list of its closest
+    centroid. A search scores the query against the centroids, then only against the rows of the `nprobe`
+    closest lists, so `nprobe` trades recall for latency.
+
+    Rows are referenced by position, the embeddings themselves stay in the caller's matrix. Rows past
+    `indexed_count` (added after the index was built) are not in any list and must be scanned by the caller.
+
+    Args:
+        centroids (np.ndarray): Normalized centroids, shape (lists, dim).
+        list_rows (np.ndarray): Row positions grouped by list, in increasing order within a list.
+        list_offsets (np.ndarray): Start of every list in `list_rows`, plus the total length at the end.
+        indexed_count (int): The number of matrix rows the index was built from.
+    """
+
+    def __init__(self, centroids, list_rows, list_offsets, indexed_count: int):
+        self.centroids = centroids
+        self.list_rows = list_rows
+        self.list_offsets = list_offsets
+        self.indexed_count = indexed_count
+
+    @property
+    def n_lists(self) -> int:
+        return self.centroids.shape[0]
+
+    @staticmethod
+    def default_n_lists(count: int) -> int:
+        """
+        Returns the usual sqrt(rows) number of lists, so a list holds about as many rows as there are lists.
+        """
+        return max(1, int(np.sqrt(count)))
+
+    @classmethod
+    def build(cls, matrix, n_lists: int = 0, iterations: int = 10, seed: int = 0):
+        """
+        Clusters the rows of a normalized matrix and fills the inverted lists.
+
+        Args:
+            matrix (np.ndarray): Normalized rows, shape (rows, dim).
+            n_lists (int): The number of lists, 0 for default_n_lists.
+            iterations (int): The number of k-means rounds.
+            seed (int): Seed of the k-means initialization.
+        """
+        count = matrix.shape[0]
+        if count == 0:
+            raise Exception("Cannot build an IVF index without embeddings")
+        n_lists = min(n_lists or cls.default_n_lists(count), count)
+
+        centroids = spherical_kmeans(matrix, n_lists, iterations=iterations, seed=seed)
+        assignments = assign_to_centroids(matrix, centroids)
+        list_rows = np.argsort(assignments, kind="stable").astype(np.int64)
+        list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=n_lists)))).astype(np.int64)
+        logs.log.info(f"IVF index built with {n_lists:,} lists over {count:,} embeddings")
+        return cls(centroids, list_rows, list_offsets, count)
+
+    def candidates(self, query, nprobe: int):
+        """
+        Returns the sorted row positions stored in the `nprobe` lists closest to a normalized query.
+        """
+        nprobe = min(max(nprobe, 1), self.n_lists)
+        probes, _ = top_k_from_scores(self.centroids @ query, nprobe)
+        rows = np.concatenate([self.list_rows[self.list_offsets[probe]:self.list_offsets[probe + 1]] for probe in probes])
+        # Sorted positions read a memory-mapped matrix front to back
+        rows.sort()
+        return rows
+
+    def compacted(self, keep):
+        """
+        Returns the index after removing rows, without clustering again.
+
+        Args:
+            keep (np.ndarray): Boolean mask over the matrix rows, False for the removed rows. The kept rows are
+                renumbered in order, as in `matrix[keep]`.
+        """
+        positions = np.cumsum(keep) - 1
+        lists = np.repeat(np.arange(self.n_lists), np.diff(self.list_offsets))
+        kept = keep[self.list_rows]
+        list_offsets = np.concatenate(([0], np.cumsum(np.bincount(lists[kept], minlength=self.n_lists)))).astype(np.int64)
+        return IVFIndex(self.centroids, positions[self.list_rows[kept]].astype(np.int64), list_offsets, int(keep[:self.indexed_count].sum()))
+
+    ###################################
+    # Save / Load
+    ###################################
+
+    def save(self, path: str):
+        """
+        Saves the index to a .npz file, written to a temporary file and renamed.
+        """
+        tmp_path = path[: -len(".npz")] + ".tmp.npz" if path.endswith(".npz") else path + ".tmp.npz"
+        np.savez(tmp_path,
+                 centroids=self.centroids,
+                 list_rows=self.list_rows,
+                 list_offsets=self.list_offsets,
+                 indexed_count=np.int64(self.indexed_count))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["list_rows"], data["list_offsets"], int(data["indexed_count"]))
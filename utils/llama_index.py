@@ -4,19 +4,24 @@ import streamlit as st
 
 import utils.logs as logs
 
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-
-from llama_index.core.node_parser import SentenceSplitter
+from utils.embedding_batching import DEFAULT_BATCH_TOKENS
+from utils.embedding_cache import CachedEmbedding, EmbeddingCache
+from utils.embedding_workers import EmbeddingWorkerPool, create_embedding_model
 
 # This is not used but required by llama-index and must be set FIRST
 # os.environ["OPENAI_API_KEY"] = "sk-abc123"
 
 
-from llama_index.core import (
-    VectorStoreIndex,
-    SimpleDirectoryReader,
-    Settings,
-)
+from llama_index.core import Settings
+
+# Chunk embeddings are cached across ingestions, keyed by model name and chunk text hash
+EMBEDDING_CACHE_PATH = os.path.join(os.getcwd(), "cache", "embeddings.sqlite")
+
+# Number of query embeddings kept in memory, so repeated prompts are not embedded again
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+
+# The worker pool of the cached embedding model, stopped when the model is set up again with other settings
+_worker_pool = None
 
 
 ###################################
@@ -26,15 +31,25 @@ from llama_index.core import (
 ###################################
 
 
-@st.cache_resource(show_spinner=False)
+@st.cache_resource(show_spinner=False, max_entries=1)
 def setup_embedding_model(
     model: str,
+    batch_tokens: int = DEFAULT_BATCH_TOKENS,
+    threads: int = 0,
+    backend: str = "torch",
+    workers: int = 1,
 ):
     """
     Sets up an embedding model using the Hugging Face library.
 
     Args:
         model (str): The name of the embedding model to use.
+        batch_tokens (int): The padded tokens per embedding batch, see `embedding_batching.BucketedEmbedding`.
+        threads (int): The number of CPU threads torch uses for the embeddings, 0 for its default (one per core).
+        backend (str): "torch" to run the model with PyTorch, "onnx" to run its ONNX export on ONNX Runtime, or
+            "onnx-int8" to run the export with int8 weights, see `onnx_embedding.OnnxEmbedding`.
+        workers (int): The number of processes embedding chunks in parallel on the CPU, each with its own copy of
+            the model, see `embedding_workers.EmbeddingWorkerPool`. 1 embeds in this process.
 
     Returns:
         An instance of the HuggingFaceEmbedding class, configured with the specified model and device.
@@ -44,10 +59,23 @@ def setup_embedding_model(
 
     Notes:
         The `device` parameter can be set to 'cpu' or 'cuda' to specify the device to use for the embedding computations. If 'cuda' is used and CUDA is available, the embedding model will be run on the GPU. Otherwise, it will be run on the CPU.
+
+        Chunks are embedded in batches of similar token length sized to `batch_tokens`, rather than in document
+        order 10 at a time, so little of the computation is spent on padding.
+
+        The ONNX backends always run on the CPU. The model is exported once and cached in `ONNX_CACHE_DIR`,
+        its embeddings can be added to and searched against an index built with the PyTorch model.
+
+        With several workers `threads` is the thread budget of each worker, 0 shares the CPU cores between them.
+
+        Only the model of the last settings is cached: setting the model up with other settings stops the workers
+        of the previous one, switching back starts them again.
+
+        The model is wrapped in a `CachedEmbedding` so chunks already embedded by a previous ingestion are read from the on-disk cache at `EMBEDDING_CACHE_PATH` instead of being embedded again, and the embeddings of the last `QUERY_EMBEDDING_CACHE_SIZE` distinct prompts are kept in memory.
     """
     try:
         from torch import cuda
-        device = "cpu" if not cuda.is_available() else "cuda"
+        device = "cpu" if not cuda.is_available() or workers > 1 else "cuda"
     except:
         device = "cpu"
     finally:
@@ -56,12 +84,23 @@ def setup_embedding_model(
     # Settting to use HuggingFaceEmbedding model set by the user.
     # It is being used in the query engine
     
-    logs.log.info(f"Setting up embedding model: {model}")
+    logs.log.info(f"Setting up embedding model: {model} ({backend})")
     
+    # The previous model was evicted from the cache, its worker processes would otherwise run until exit
+    global _worker_pool
+    if _worker_pool is not None:
+        _worker_pool.close()
+        _worker_pool = None
+
     try:
-        Settings.embed_model = HuggingFaceEmbedding(
-            model_name=model,
-            device=device,
+        if workers > 1:
+            embed_model = _worker_pool = EmbeddingWorkerPool(model, workers, backend=backend, batch_tokens=batch_tokens, threads=threads)
+        else:
+            embed_model = create_embedding_model(model, backend=backend, batch_tokens=batch_tokens, threads=threads, device=device)
+        Settings.embed_model = CachedEmbedding(
+            embed_model,
+            EmbeddingCache(EMBEDDING_CACHE_PATH),
+            query_cache_size=QUERY_EMBEDDING_CACHE_SIZE,
         )
         logs.log.info(f"Embedding model created successfully")        
         logs.log.info(f"Embedding model is {Settings.embed_model}")
@@ -72,147 +111,30 @@ def setup_embedding_model(
 
 ###################################
 #
-# Load Documents
+# Embed Queries in Batch
 #
 ###################################
 
 
-def load_documents(data_dir: str):
+def embed_queries(embed_model, queries: list):
     """
-    Loads documents from a directory of files.
+    Embeds a list of queries with one batched call to the embedding model.
 
     Args:
-        data_dir (str): The path to the directory containing the documents to be loaded.
+        embed_model: The llama-index embedding model (usually Settings.embed_model).
+        queries (list[str]): The query strings to embed.
 
     Returns:
-        A list of documents, where each document is a string representing the content of the corresponding file.
-
-    Raises:
-        Exception: If there is an error creating the data index.
+        A list of query embeddings, in the same order as the queries.
 
     Notes:
-        The `data_dir` parameter should be a path to a directory containing files that represent the documents to be loaded. The function will iterate over all files in the directory, and load their contents into a list of strings.
-    """
-    try:
-        # Reads all the files in the data directory and returns a list of documents
-        files = SimpleDirectoryReader(input_dir=data_dir, recursive=True)
-        documents = files.load_data(files)        
-        logs.log.info(f"Loaded {len(documents):,} documents from files")
-        return documents
-    except Exception as err:
-        logs.log.error(f"Error creating data index: {err}")
-        raise Exception(f"Error creating data index: {err}")
-    finally:
-        for file in os.scandir(data_dir):
-            if file.is_file() and not file.name.startswith(
-                ".gitkeep"
-            ):  # TODO: Confirm syntax here
-                os.remove(file.path)
-        logs.log.info(f"Document loading complete; removing local file(s)")
-
-
-###################################
-#
-# Create Document Index
-#
-###################################
-
-
-@st.cache_resource(show_spinner=False)
-def create_index(_documents):
-    
-    logs.log.info(f"Document list is {_documents[0]}")
-    
+        HuggingFaceEmbedding embeds queries with the query instruction of the model, so the batch goes through its
+        `_embed` method with the "query" prompt. Other embedding models fall back to one call per query.
     """
-    
-    Creates an index from the provided documents and service context.
-    Splits documents based on chuck size and overlap set by the user.
-    
-    Args:
-        documents (list[str]): A list of strings representing the content of the documents to be indexed.
-
-    Returns:
-        An instance of `VectorStoreIndex`, containing the indexed data.
-
-    Raises:
-        Exception: If there is an error creating the index.
-
-    Notes:
-        The `documents` parameter should be a list of strings representing the content of the documents to be indexed.
-    """
-
-    # Updated code to include SentenceSplitter based on chunk size and overlap
-    try:
-        index = VectorStoreIndex.from_documents(
-            documents=_documents, show_progress=True,
-            transformations=[SentenceSplitter(chunk_size=st.session_state["chunk_size"],
-                                              chunk_overlap=st.session_state["chunk_overlap"],
-                                              separator=".",
-                                              paragraph_separator='\n\n')],
-        )
-
-        logs.log.info("Index created from loaded documents successfully")
-        return index
-    
-    except Exception as err:
-        logs.log.error(f"Index creation failed with user defined chunk size and chunk overlap: {err}")
-        
-        try : 
-            index = VectorStoreIndex.from_documents(
-            documents=_documents, show_progress=True,
-            )
-            logs.log.info("Index created from loaded documents successfully")
-            return index 
-    
-        except Exception as err:
-            logs.log.error(f"Index creation failed with default chunk size and chunk overlap: {err}")
-            raise Exception(f"Index creation failed with default chunk size and chunk overlap: {err}")
-
-###################################
-#
-# Create Query Engine
-#
-###################################
-
-
-# @st.cache_resource(show_spinner=False)
-def create_query_engine(_documents):
-    """
-    Creates a query engine from the provided documents and service context.
-
-    Args:
-        documents (list[str]): A list of strings representing the content of the documents to be indexed.
-
-    Returns:
-        An instance of `QueryEngine`, containing the indexed data and allowing for querying of the data using a variety of parameters.
-
-    Raises:
-        Exception: If there is an error creating the query engine.
-
-    Notes:
-        The `documents` parameter should be a list of strings representing the content of the documents to be indexed.
-
-        This function uses the `create_index` function to create an index from the provided documents and service context, and then creates a query engine from the resulting index. The `query_engine` parameter is used to specify the parameters of the query engine, including the number of top-ranked items to return (`similarity_top_k`) and the response mode (`response_mode`).
-    """
-        
-    try:
-        # Vector index generated from set of documents : 
-        index = create_index(_documents)
-        # Save the vector index to disk
-        
-        query_engine = index.as_query_engine(
-            similarity_top_k=st.session_state["top_k"],
-            response_mode=st.session_state["chat_mode"],
-            streaming=True,
-        )
-
-        # Assigned query engine object to session state. 
-        st.session_state["query_engine"]=query_engine
-
-        logs.log.info("Query Engine created successfully")
-
-        return query_engine
-    
-    except Exception as e:
-        logs.log.error(f"Error when creating Query Engine: {e}")
-        raise Exception(f"Error when creating Query Engine: {e}")
+    if len(queries) == 0:
+        return []
+    if isinstance(embed_model, CachedEmbedding):
+        return embed_model._get_query_embeddings(list(queries))
+    if hasattr(embed_model, "_embed"):
+        return embed_model._embed(list(queries), prompt_name="query")
+    return [embed_model.get_query_embedding(query) for query in queries]
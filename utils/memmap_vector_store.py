@@ -0,0 +1,842 @@
+import os
+import json
+import uuid
+
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+
+import utils.logs as logs
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterCondition,
+    FilterOperator,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+from utils.ivf_index import IVFIndex
+from utils.metadata_index import POSTINGS_VERSION, MetadataIndex, row_values
+from utils.scalar_quantizer import ScalarQuantizer
+from utils.vector_search import top_k_from_scores
+
+# Written into the header file so the loader can tell it from a SimpleVectorStore JSON file
+STORE_FORMAT = "memmap-float32"
+
+DEFAULT_NAMESPACE = "default"
+
+# Files written per generation next to the header, the ones the header does not point at are removed on persist
+GENERATION_SUFFIXES = (".f32", ".i8", ".ids.json", ".meta.json", ".postings.json", ".ivf.npz")
+
+# A load finding files of another generation than its header (a persist ran meanwhile) is retried this many times
+LOAD_ATTEMPTS = 3
+
+# A quantized store re-scores this many times top k coarse (int8) results in float32
+RERANK_FACTOR = 4
+
+
+###################################
+#
+# Memory-Mapped Vector Store
+#
+###################################
+
+
+class MemmapVectorStore(BasePydanticVectorStore):
+    """
+    Vector store keeping all embeddings in one contiguous float32 matrix file opened with np.memmap.
+
+    A store persisted to `vector_db/default__vector_store.json` is made of:
+        - `default__vector_store.json`: a small header (format, dimension, row count, file names).
+        - `default__vector_store.<generation>.f32`: the row-major matrix of normalized embeddings.
+        - `default__vector_store.<generation>.ids.json`: node id and ref doc id of every row, and the deleted rows.
+        - `default__vector_store.<generation>.meta.json`: the metadata of every row.
+        - `default__vector_store.<generation>.postings.json`: the inverted index of the filterable metadata (`MetadataIndex`).
+
+    Every persist writes its sidecars under a new generation and the header last, so a process loading the
+    store while it is persisted never pairs the ids of one generation with the rows of another: the loader checks
+    that every file holds the header's row count and retries from the new header otherwise.
+
+    Loading only parses the sidecars and maps the matrix, so start-up time does not depend on the number of
+    embeddings and every process mapping the same file shares its pages through the OS cache.
+
+    Rows added after loading are kept in memory until the next persist, which appends them to the matrix
+    file when it is persisted to the same place. Deleted rows are recorded as tombstones.
+
+    A query normalizes the query embedding once and scores every row with one matrix-vector product.
+    Deleted rows, node/document restrictions and metadata filters are applied as boolean masks over the
+    rows, and the top k is selected with np.argpartition. Filters on the keys of the metadata index (file name,
+    file type, page label) are first resolved to the rows they match, and only those rows are scored.
+
+    An optional IVF index (`build_ivf`) is persisted next to the matrix as `default__vector_store.<generation>.ivf.npz`.
+    Queries passing `nprobe` (llama-index `vector_store_kwargs`) then only score the rows of the `nprobe`
+    closest inverted lists, plus the rows added since the IVF index was built.
+
+    With `quantize`, an int8 copy of the matrix (`default__vector_store.<generation>.i8`, per-dimension scales in
+    the header) is written on persist. Queries scan the int8 rows, a quarter of the float32 size, and only re-score
+    a shortlist of `RERANK_FACTOR` x top k rows from the float32 matrix, whose other pages are never read.
+    """
+
+    stores_text: bool = False
+
+    _matrix: Any = PrivateAttr()
+    _pending: list = PrivateAttr()
+    _node_ids: list = PrivateAttr()
+    _ref_doc_ids: list = PrivateAttr()
+    _metadata: list = PrivateAttr()
+    _deleted: set = PrivateAttr()
+    _row_of: dict = PrivateAttr()
+    _columns: dict = PrivateAttr()
+    _doc_rows: Optional[dict] = PrivateAttr()
+    _persisted_path: Optional[str] = PrivateAttr()
+    _vectors_file: Optional[str] = PrivateAttr()
+    _ids_file: Optional[str] = PrivateAttr()
+    _ivf: Optional[IVFIndex] = PrivateAttr()
+    _quantizer: Optional[ScalarQuantizer] = PrivateAttr()
+    _codes: Any = PrivateAttr()
+    _codes_file: Optional[str] = PrivateAttr()
+    _metadata_index: Optional[MetadataIndex] = PrivateAttr()
+
+    def __init__(self, **kwargs):
+        super().__init__(stores_text=False, **kwargs)
+        self._matrix = np.empty((0, 0), dtype=np.float32)  # persisted rows, a read-only memmap once loaded
+        self._pending = []  # blocks of normalized rows added since the last persist
+        self._node_ids = []
+        self._ref_doc_ids = []
+        self._metadata = []
+        self._deleted = set()  # row positions of deleted embeddings
+        self._row_of = {}  # node id -> row position of its live embedding
+        self._columns = {}  # metadata key (or id column) -> per-row value array, built on first filter
+        self._doc_rows = None  # ref doc id -> row positions, built on first delete
+        self._persisted_path = None
+        self._metadata_index = None  # built on first filter or persist when not loaded
+        self._vectors_file = None
+        self._ids_file = None
+        self._ivf = None
+        self._quantizer = None
+        self._codes = np.empty((0, 0), dtype=np.int8)  # int8 codes of the first rows, a read-only memmap once loaded
+        self._codes_file = None
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MemmapVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    @property
+    def dim(self) -> int:
+        if self._matrix.shape[0] > 0:
+            return self._matrix.shape[1]
+        return self._pending[0].shape[1] if self._pending else 0
+
+    @property
+    def ivf(self) -> Optional[IVFIndex]:
+        return self._ivf
+
+    @property
+    def quantizer(self) -> Optional[ScalarQuantizer]:
+        return self._quantizer
+
+    @property
+    def metadata_index(self) -> MetadataIndex:
+        if self._metadata_index is None:
+            self._metadata_index = MetadataIndex.build(self._metadata)
+        return self._metadata_index
+
+    @property
+    def node_ids(self) -> List[str]:
+        """
+        The ids of the live (not deleted) nodes.
+        """
+        return list(self._row_of)
+
+    @property
+    def ivf_lists(self) -> int:
+        """
+        The number of IVF lists, 0 without an IVF index.
+        """
+        return self._ivf.n_lists if self._ivf is not None else 0
+
+    @property
+    def quantized(self) -> bool:
+        return self._quantizer is not None
+
+    @property
+    def snapshot_id(self):
+        """
+        Identifies the persisted state this store was loaded from or last persisted, None with unpersisted changes.
+        """
+        if self._pending or self._persisted_path is None:
+            return None
+        return (self._vectors_file, self._ids_file, len(self._node_ids), len(self._deleted))
+
+    @property
+    def size(self) -> int:
+        """
+        The number of live (not deleted) embeddings.
+        """
+        # Not __len__: StorageContext.from_defaults tests the store for truthiness and would drop an empty one
+        return len(self._node_ids) - len(self._deleted)
+
+    ###################################
+    # Load
+    ###################################
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, namespace: str = DEFAULT_NAMESPACE, **kwargs):
+        """
+        Loads the store persisted in a directory by `StorageContext.persist`.
+        """
+        return cls.from_persist_path(os.path.join(persist_dir, f"{namespace}__vector_store.json"), **kwargs)
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str, **kwargs):
+        """
+        Loads the store from its header file. A SimpleVectorStore JSON file found at that path is converted,
+        so an index persisted before this store existed keeps working and is migrated on its next persist.
+        """
+        store = cls(**kwargs)
+        if not os.path.exists(persist_path):
+            logs.log.info(f"No vector store at {persist_path}, starting empty")
+            return store
+
+        # A persist racing with the load writes a new header and removes the sidecars of the previous one,
+        # the load is then retried from the new header
+        for attempt in range(LOAD_ATTEMPTS):
+            with open(persist_path, "r") as header_file:
+                header = json.load(header_file)
+
+            if header.get("format") != STORE_FORMAT:
+                store._load_simple_vector_store(header)
+                logs.log.info(f"Converted SimpleVectorStore JSON with {store.size:,} embeddings from {persist_path}")
+                return store
+
+            try:
+                store = cls._load_generation(persist_path, header, **kwargs)
+                logs.log.info(f"Memory-mapped {store.size:,} embeddings of dimension {header['dim']} from {persist_path}")
+                return store
+            except (OSError, ValueError) as err:
+                if cls._read_header(persist_path) == header:
+                    logs.log.error(f"Vector store at {persist_path} is inconsistent: {err}")
+                    raise Exception(f"Vector store at {persist_path} is inconsistent: {err}")
+                logs.log.warning(f"Vector store at {persist_path} was persisted again while loading ({err}), retrying")
+        raise Exception(f"Vector store at {persist_path} kept changing while loading, gave up after {LOAD_ATTEMPTS} attempts")
+
+    @classmethod
+    def _load_generation(cls, persist_path: str, header: dict, **kwargs):
+        """
+        Loads the files a header points at, checking that the ids, metadata and matrices all hold `count` rows.
+        """
+        store = cls(**kwargs)
+        directory = os.path.dirname(persist_path)
+        with open(os.path.join(directory, header["ids"]), "r") as ids_file:
+            ids = json.load(ids_file)
+        with open(os.path.join(directory, header["metadata"]), "r") as metadata_file:
+            store._metadata = json.load(metadata_file)
+
+        count, dim = header["count"], header["dim"]
+        if not len(ids["node_ids"]) == len(ids["ref_doc_ids"]) == len(store._metadata) == count:
+            raise ValueError(f"{header['ids']} and {header['metadata']} hold {len(ids['node_ids'])} and {len(store._metadata)} rows, "
+                             f"the header {count}")
+        deleted = set(ids.get("deleted", []))
+        if deleted and max(deleted) >= count:
+            raise ValueError(f"{header['ids']} deletes row {max(deleted)} of {count}")
+        # A matrix file persisted to again may already hold the rows appended after this header
+        _check_rows(directory, header["vectors"], count * dim * 4)
+        if count > 0:
+            store._matrix = np.memmap(os.path.join(directory, header["vectors"]), dtype=np.float32, mode="r", shape=(count, dim))
+        store._node_ids = ids["node_ids"]
+        store._ref_doc_ids = ids["ref_doc_ids"]
+        store._deleted = deleted
+        store._row_of = {node_id: row for row, node_id in enumerate(store._node_ids) if row not in store._deleted}
+        store._persisted_path = persist_path
+        store._vectors_file = header["vectors"]
+        store._ids_file = header["ids"]
+        if header.get("ivf"):
+            store._ivf = IVFIndex.load(os.path.join(directory, header["ivf"]))
+            if store._ivf.indexed_count > count:
+                raise ValueError(f"{header['ivf']} indexes {store._ivf.indexed_count} rows, the header {count}")
+        if header.get("quantization"):
+            store._quantizer = ScalarQuantizer(header["quantization"]["scales"])
+            store._codes_file = header["quantization"]["codes"]
+            _check_rows(directory, store._codes_file, count * dim)
+            store._codes = np.memmap(os.path.join(directory, store._codes_file), dtype=np.int8, mode="r", shape=(count, dim))
+        if header.get("postings"):
+            metadata_index = MetadataIndex.load(os.path.join(directory, header["postings"]))
+            # A store written by an older version (or with other indexed keys) is indexed again on first filter
+            if (metadata_index.count == len(store._node_ids) and metadata_index.keys == MetadataIndex().keys
+                    and metadata_index.version == POSTINGS_VERSION):
+                store._metadata_index = metadata_index
+        return store
+
+    def _load_simple_vector_store(self, data: dict):
+        embedding_dict = data.get("embedding_dict", {})
+        text_id_to_ref_doc_id = data.get("text_id_to_ref_doc_id", {})
+        metadata_dict = data.get("metadata_dict", {})
+        for node_id, embedding in embedding_dict.items():
+            metadata = {key: value for key, value in metadata_dict.get(node_id, {}).items() if not key.startswith("_")}
+            self._append(node_id, text_id_to_ref_doc_id.get(node_id), embedding, metadata)
+
+    ###################################
+    # Write
+    ###################################
+
+    def _append(self, node_id: str, ref_doc_id: Optional[str], embedding, metadata: dict):
+        self.add_embeddings([node_id], [embedding], [ref_doc_id], [metadata])
+
+    def add_embeddings(self, node_ids: List[str], embeddings, ref_doc_ids: Optional[list] = None, metadata: Optional[list] = None):
+        """
+        Adds a block of embeddings at once.
+
+        Args:
+            node_ids (list[str]): The node id of every row.
+            embeddings: A 2D array (or list of lists) of embeddings, normalized before being stored.
+            ref_doc_ids (list, optional): The document id of every row.
+            metadata (list[dict], optional): The metadata of every row.
+        """
+        block = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self._pending.append(block / norms)
+
+        for node_id in node_ids:
+            if node_id in self._row_of:
+                self._deleted.add(self._row_of[node_id])
+            self._row_of[node_id] = len(self._node_ids)
+            self._node_ids.append(node_id)
+        self._ref_doc_ids.extend(ref_doc_ids if ref_doc_ids is not None else [None] * len(node_ids))
+        metadata = metadata if metadata is not None else [{} for _ in node_ids]
+        self._metadata.extend(metadata)
+        if self._metadata_index is not None:
+            self._metadata_index.add(metadata)
+        self._columns = {}
+        self._doc_rows = None
+
+    def _pending_matrix(self):
+        # Blocks are merged on first use so the following queries multiply one matrix
+        if len(self._pending) > 1:
+            self._pending = [np.concatenate(self._pending)]
+        return self._pending[0] if self._pending else None
+
+    def build_ivf(self, n_lists: int = 0, iterations: int = 10):
+        """
+        Builds the IVF index over every row, it is saved with the next persist.
+
+        Args:
+            n_lists (int): The number of inverted lists, 0 for about sqrt(rows).
+            iterations (int): The number of k-means rounds.
+        """
+        pending = self._pending_matrix()
+        if pending is None:
+            matrix = self._matrix
+        elif self._matrix.shape[0] == 0:
+            matrix = pending
+        else:
+            matrix = np.concatenate([self._matrix, pending])
+        self._ivf = IVFIndex.build(matrix, n_lists=n_lists, iterations=iterations)
+
+    def ensure_ivf(self, n_lists: int = 0, max_unindexed: float = 0.2):
+        """
+        Builds the IVF index if there is none, or if the rows added since it was built exceed `max_unindexed`
+        of the indexed rows (they are scanned exactly on every query). Returns True if it was built.
+        """
+        total = len(self._node_ids)
+        if total == 0:
+            return False
+        if self._ivf is not None and total - self._ivf.indexed_count <= max_unindexed * self._ivf.indexed_count:
+            return False
+        self.build_ivf(n_lists=n_lists)
+        return True
+
+    def drop_ivf(self):
+        """
+        Removes the IVF index, queries go back to exact search. The file is removed with the next persist.
+        """
+        self._ivf = None
+
+    def quantize(self):
+        """
+        Fits per-dimension int8 scales on every row. The int8 codes are written with the next persist,
+        until then rows are scored in float32.
+        """
+        pending = self._pending_matrix()
+        parts = [part for part in (self._matrix, pending) if part is not None and part.shape[0] > 0]
+        if not parts:
+            raise Exception("Cannot quantize a vector store without embeddings")
+        scales = [ScalarQuantizer.fit(part).scales for part in parts]
+        self._quantizer = ScalarQuantizer(np.max(scales, axis=0))
+        self._codes = np.empty((0, self.dim), dtype=np.int8)
+        self._codes_file = None
+
+    def ensure_quantized(self):
+        """
+        Quantizes the store unless it already is. Rows added later are encoded with the existing scales.
+        """
+        if self._quantizer is None and len(self._node_ids) > 0:
+            self.quantize()
+
+    def drop_quantization(self):
+        """
+        Goes back to float32 search. The int8 file is removed with the next persist.
+        """
+        self._quantizer = None
+        self._codes = np.empty((0, 0), dtype=np.int8)
+        self._codes_file = None
+
+    def compact(self):
+        """
+        Drops the deleted rows from the matrix, the int8 codes and the id and metadata sidecars. The IVF lists
+        are renumbered rather than rebuilt. Everything is written to a new generation with the next persist,
+        so processes still mapping the current files are not affected.
+
+        Returns:
+            int: The number of rows removed.
+        """
+        if not self._deleted:
+            return 0
+        keep = np.ones(len(self._node_ids), dtype=bool)
+        keep[list(self._deleted)] = False
+        persisted = self._matrix.shape[0]
+        pending = self._pending_matrix()
+        blocks = [np.asarray(self._matrix[keep[:persisted]], dtype=np.float32)] if persisted > 0 else []
+        if pending is not None:
+            blocks.append(pending[keep[persisted:]])
+
+        if self._ivf is not None:
+            self._ivf = self._ivf.compacted(keep)
+        if self._metadata_index is not None:
+            self._metadata_index = self._metadata_index.compacted(keep)
+        self._matrix = np.empty((0, self.dim), dtype=np.float32)
+        self._pending = [block for block in blocks if block.shape[0] > 0]
+        self._vectors_file = None
+        if self._quantizer is not None:
+            # Codes of every row are written again from the float32 rows
+            self._codes = np.empty((0, self.dim), dtype=np.int8)
+            self._codes_file = None
+
+        self._node_ids = [node_id for node_id, kept in zip(self._node_ids, keep) if kept]
+        self._ref_doc_ids = [ref_doc_id for ref_doc_id, kept in zip(self._ref_doc_ids, keep) if kept]
+        self._metadata = [metadata for metadata, kept in zip(self._metadata, keep) if kept]
+        self._row_of = {node_id: row for row, node_id in enumerate(self._node_ids)}
+        self._deleted = set()
+        self._columns = {}
+        self._doc_rows = None
+        removed = len(keep) - len(self._node_ids)
+        logs.log.info(f"Compacted vector store: {removed:,} deleted rows removed, {len(self._node_ids):,} kept")
+        return removed
+
+    def update_metadata(self, metadata: dict):
+        """
+        Replaces the metadata of stored nodes without touching their embeddings, e.g. when another file shares
+        their chunk. The metadata index is updated with it.
+
+        Args:
+            metadata (dict): {node id: metadata}, nodes not in the store are skipped.
+
+        Returns:
+            int: The number of rows whose metadata changed.
+        """
+        changed = 0
+        for node_id, node_metadata in metadata.items():
+            row = self._row_of.get(node_id)
+            if row is None or self._metadata[row] == node_metadata:
+                continue
+            if self._metadata_index is not None:
+                self._metadata_index.update(row, self._metadata[row], node_metadata)
+            self._metadata[row] = node_metadata
+            changed += 1
+        if changed:
+            self._columns = {}
+        return changed
+
+    def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        """
+        Adds the embeddings of nodes. A node already in the store replaces its previous embedding.
+        """
+        for node in nodes:
+            self._append(node.node_id, node.ref_doc_id, node.get_embedding(), dict(node.metadata))
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """
+        Deletes the embeddings of every node of a document.
+        """
+        # llama-index also calls this once per node id when deleting a document, so it must not scan every row
+        if self._doc_rows is None:
+            self._doc_rows = {}
+            for row, row_ref_doc_id in enumerate(self._ref_doc_ids):
+                self._doc_rows.setdefault(row_ref_doc_id, []).append(row)
+        for row in self._doc_rows.get(ref_doc_id, []):
+            if row not in self._deleted:
+                self._deleted.add(row)
+                self._row_of.pop(self._node_ids[row], None)
+
+    def delete_nodes(self, node_ids: Optional[List[str]] = None, filters: Optional[MetadataFilters] = None, **delete_kwargs: Any) -> None:
+        """
+        Deletes the embeddings of the given nodes, or of every node matching the metadata filters.
+        """
+        rows = [self._row_of[node_id] for node_id in (node_ids or []) if node_id in self._row_of]
+        if filters is not None:
+            rows.extend(int(row) for row in np.flatnonzero(self._filter_mask(filters)))
+        for row in rows:
+            if row not in self._deleted:
+                self._deleted.add(row)
+                self._row_of.pop(self._node_ids[row], None)
+
+    def persist(self, persist_path: str, fs: Optional[Any] = None) -> None:
+        """
+        Persists the store next to `persist_path`, which receives the header.
+
+        When the store was loaded from the same path, new rows are appended to the existing matrix file.
+        Otherwise the matrix is written to a new generation file, so a process still mapping the previous
+        file is never affected, and the previous file is removed when possible.
+        """
+        directory = os.path.dirname(persist_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        base = os.path.basename(persist_path)
+        base = base[: -len(".json")] if base.endswith(".json") else base
+        dim = self.dim
+        previous_header = self._read_header(persist_path)
+        previous_file = previous_header.get("vectors")
+
+        appendable = (
+            self._persisted_path == persist_path
+            and previous_file is not None
+            and previous_file == self._vectors_file
+            and os.path.exists(os.path.join(directory, previous_file))
+            and os.path.getsize(os.path.join(directory, previous_file)) == self._matrix.shape[0] * dim * 4
+        )
+
+        pending = self._pending_matrix()
+        if appendable:
+            vectors_file = previous_file
+            if pending is not None:
+                with open(os.path.join(directory, vectors_file), "ab") as vectors:
+                    vectors.write(pending.tobytes())
+        else:
+            vectors_file = f"{base}.{uuid.uuid4().hex[:12]}.f32"
+            with open(os.path.join(directory, vectors_file), "wb") as vectors:
+                if self._matrix.shape[0] > 0:
+                    vectors.write(np.ascontiguousarray(self._matrix, dtype=np.float32).tobytes())
+                if pending is not None:
+                    vectors.write(pending.tobytes())
+
+        # Sidecars are written under a new generation every time, a reader holding the previous header keeps
+        # finding files that match its row count until they are removed below
+        generation = uuid.uuid4().hex[:12]
+        ids_file, metadata_file = f"{base}.{generation}.ids.json", f"{base}.{generation}.meta.json"
+        _write_json(os.path.join(directory, ids_file), {
+            "node_ids": self._node_ids,
+            "ref_doc_ids": self._ref_doc_ids,
+            "deleted": sorted(self._deleted),
+        })
+        _write_json(os.path.join(directory, metadata_file), self._metadata)
+        postings_file = f"{base}.{generation}.postings.json"
+        _write_json(os.path.join(directory, postings_file), self.metadata_index.to_json())
+
+        codes_file = self._persist_codes(directory, base, previous_header, appendable, pending) if self._quantizer is not None else None
+
+        ivf_file = f"{base}.{generation}.ivf.npz" if self._ivf is not None else None
+        if self._ivf is not None:
+            self._ivf.save(os.path.join(directory, ivf_file))
+
+        count = len(self._node_ids)
+        # The header is written last, readers only see the new rows once it points at them
+        _write_json(persist_path, {
+            "format": STORE_FORMAT,
+            "dim": dim,
+            "count": count,
+            "vectors": vectors_file,
+            "ids": ids_file,
+            "metadata": metadata_file,
+            "postings": postings_file,
+            "ivf": ivf_file,
+            "quantization": {"codes": codes_file, "scales": self._quantizer.scales.tolist()} if self._quantizer is not None else None,
+        })
+
+        self._matrix = np.memmap(os.path.join(directory, vectors_file), dtype=np.float32, mode="r", shape=(count, dim)) if count > 0 else np.empty((0, dim), dtype=np.float32)
+        self._pending = []
+        self._persisted_path = persist_path
+        self._vectors_file = vectors_file
+        self._ids_file = ids_file
+        if self._quantizer is not None:
+            self._codes = np.memmap(os.path.join(directory, codes_file), dtype=np.int8, mode="r", shape=(count, dim)) if count > 0 else np.empty((0, dim), dtype=np.int8)
+            self._codes_file = codes_file
+        logs.log.info(f"Persisted {self.size:,} embeddings ({len(self._deleted):,} deleted) to {persist_path}")
+
+        # Previous generations, including ones that could not be removed last time, are cleaned up
+        current = (vectors_file, codes_file, ids_file, metadata_file, postings_file, ivf_file)
+        for file_name in os.listdir(directory or "."):
+            if not file_name.startswith(base + ".") or file_name in current:
+                continue
+            if file_name.endswith(GENERATION_SUFFIXES):
+                _remove_quietly(os.path.join(directory, file_name))
+
+    def _persist_codes(self, directory: str, base: str, previous_header: dict, appendable: bool, pending):
+        """
+        Writes the int8 codes of every row and returns the codes file name. Codes of new rows are appended
+        when the float32 rows were appended and every persisted row already has its codes.
+        """
+        previous_codes = (previous_header.get("quantization") or {}).get("codes")
+        codes_appendable = (
+            appendable
+            and previous_codes is not None
+            and previous_codes == self._codes_file
+            and self._codes.shape[0] == self._matrix.shape[0]
+            and os.path.exists(os.path.join(directory, previous_codes))
+            and os.path.getsize(os.path.join(directory, previous_codes)) == self._codes.size
+        )
+        if codes_appendable:
+            codes_file, mode, blocks = previous_codes, "ab", []
+        else:
+            codes_file, mode = f"{base}.{uuid.uuid4().hex[:12]}.i8", "wb"
+            blocks = [self._matrix[start:start + 65536] for start in range(0, self._matrix.shape[0], 65536)]
+        if pending is not None:
+            blocks.append(pending)
+        with open(os.path.join(directory, codes_file), mode) as codes:
+            for block in blocks:
+                codes.write(self._quantizer.encode(block).tobytes())
+        return codes_file
+
+    @staticmethod
+    def _read_header(persist_path: str):
+        try:
+            with open(persist_path, "r") as header_file:
+                header = json.load(header_file)
+            return header if header.get("format") == STORE_FORMAT else {}
+        except (OSError, ValueError):
+            return {}
+
+    ###################################
+    # Query
+    ###################################
+
+    @staticmethod
+    def _normalize_query(query_embedding):
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        return query / norm if norm > 0 else query
+
+    def _scores(self, query, rows=None, coarse: bool = False):
+        """
+        Returns the similarities of a normalized query with `rows` (sorted row positions, None for every row).
+        With coarse=True, rows having int8 codes are scored on the codes instead of the float32 matrix.
+        """
+        persisted = self._matrix.shape[0]
+        coded = self._codes.shape[0] if coarse and self._quantizer is not None else 0
+        pending = self._pending_matrix()
+        parts = []
+        if rows is None:
+            if coded > 0:
+                parts.append(self._quantizer.scores(self._codes, query))
+            if persisted > coded:
+                parts.append(self._matrix[coded:] @ query)
+            if pending is not None:
+                parts.append(pending @ query)
+        else:
+            coded_split, persisted_split = np.searchsorted(rows, [coded, persisted])
+            if coded_split > 0:
+                parts.append(self._quantizer.scores(self._codes[rows[:coded_split]], query))
+            if persisted_split > coded_split:
+                parts.append(self._matrix[rows[coded_split:persisted_split]] @ query)
+            if persisted_split < len(rows):
+                parts.append(pending[rows[persisted_split:] - persisted] @ query)
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.float32)
+
+    def _column(self, key: str):
+        # Per-row values of a metadata key as an object array, None where the key is missing
+        if key not in self._columns:
+            if key == "__node_id__":
+                values = self._node_ids
+            elif key == "__ref_doc_id__":
+                values = self._ref_doc_ids
+            else:
+                values = [metadata.get(key) for metadata in self._metadata]
+            column = np.empty(len(values), dtype=object)
+            column[:] = values
+            self._columns[key] = column
+        return self._columns[key]
+
+    def _numeric_column(self, key: str):
+        numeric_key = ("__numeric__", key)
+        if numeric_key not in self._columns:
+            self._columns[numeric_key] = np.array([_to_float(value) for value in self._column(key)], dtype=np.float64)
+        return self._columns[numeric_key]
+
+    def _filter_mask(self, filters: MetadataFilters):
+        masks = []
+        for metadata_filter in filters.filters:
+            if isinstance(metadata_filter, MetadataFilters):
+                masks.append(self._filter_mask(metadata_filter))
+            else:
+                masks.append(self._operator_mask(metadata_filter.key, metadata_filter.operator, metadata_filter.value))
+        if not masks:
+            return np.ones(len(self._node_ids), dtype=bool)
+        if filters.condition == FilterCondition.OR:
+            return np.logical_or.reduce(masks)
+        mask = np.logical_and.reduce(masks)
+        if getattr(FilterCondition, "NOT", None) is not None and filters.condition == FilterCondition.NOT:
+            return ~mask
+        return mask
+
+    def _operator_mask(self, key: str, operator: FilterOperator, value):
+        count = len(self._node_ids)
+        if operator in (FilterOperator.GT, FilterOperator.GTE, FilterOperator.LT, FilterOperator.LTE):
+            column, value = self._numeric_column(key), _to_float(value)
+            with np.errstate(invalid="ignore"):
+                if operator == FilterOperator.GT:
+                    return column > value
+                if operator == FilterOperator.GTE:
+                    return column >= value
+                if operator == FilterOperator.LT:
+                    return column < value
+                return column <= value
+
+        if key == "file_name" and operator in (FilterOperator.EQ, FilterOperator.NE, FilterOperator.IN, FilterOperator.NIN):
+            # A deduplicated chunk matches the file name of every file sharing it, like in the metadata index
+            values = {value} if operator in (FilterOperator.EQ, FilterOperator.NE) else set(value)
+            mask = np.fromiter((not values.isdisjoint(row_values(metadata, key)) for metadata in self._metadata), dtype=bool, count=count)
+            return mask if operator in (FilterOperator.EQ, FilterOperator.IN) else ~mask
+
+        column = self._column(key)
+        if operator == FilterOperator.EQ:
+            return np.asarray(column == value, dtype=bool)
+        if operator == FilterOperator.NE:
+            return np.asarray(column != value, dtype=bool)
+        if operator in (FilterOperator.IN, FilterOperator.NIN):
+            values = set(value)
+            mask = np.fromiter((item in values for item in column), dtype=bool, count=count)
+            return mask if operator == FilterOperator.IN else ~mask
+        if operator == FilterOperator.CONTAINS:
+            return np.fromiter((isinstance(item, list) and value in item for item in column), dtype=bool, count=count)
+        if operator == FilterOperator.TEXT_MATCH:
+            return np.fromiter((isinstance(item, str) and value in item for item in column), dtype=bool, count=count)
+        if operator == FilterOperator.IS_EMPTY:
+            return np.fromiter((item is None or item == "" or item == [] for item in column), dtype=bool, count=count)
+        raise ValueError(f"Filter operator {operator} is not supported by MemmapVectorStore")
+
+    def _query_mask(self, query: VectorStoreQuery, filtered: bool = False):
+        """
+        Returns the boolean mask of rows a query may return, or None when every row qualifies.
+        With filtered=True the metadata filters were already resolved by the metadata index and are not applied.
+        """
+        mask = None
+        if self._deleted:
+            mask = np.ones(len(self._node_ids), dtype=bool)
+            mask[list(self._deleted)] = False
+        restrictions = []
+        if query.node_ids is not None:
+            restrictions.append(np.isin(self._column("__node_id__"), np.asarray(query.node_ids, dtype=object)))
+        if query.doc_ids is not None:
+            restrictions.append(np.isin(self._column("__ref_doc_id__"), np.asarray(query.doc_ids, dtype=object)))
+        if query.filters is not None and not filtered:
+            restrictions.append(self._filter_mask(query.filters))
+        for restriction in restrictions:
+            mask = restriction if mask is None else mask & restriction
+        return mask
+
+    def _candidate_rows(self, query, nprobe: int):
+        """
+        Returns the sorted rows of the `nprobe` IVF lists closest to the query and the rows added after
+        the IVF index was built.
+        """
+        rows = self._ivf.candidates(query, nprobe)
+        if len(self._node_ids) > self._ivf.indexed_count:
+            rows = np.concatenate([rows, np.arange(self._ivf.indexed_count, len(self._node_ids))])
+        return rows
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """
+        Returns the ids and cosine similarities of the `similarity_top_k` embeddings most similar to the query.
+
+        Args:
+            query (VectorStoreQuery): The query embedding, top k, and optional node ids, doc ids and filters.
+            **kwargs: `nprobe` (int) searches only the `nprobe` closest IVF lists when an IVF index is built.
+                Exact search is used without it, or when it covers every list.
+                `rerank_factor` (int) sets the shortlist re-scored in float32 by a quantized store, as a multiple
+                of top k (default RERANK_FACTOR). 0 returns the int8 scores without re-ranking.
+                With metadata filters the index can resolve, the IVF lists only narrow down filters matching more
+                rows than the lists hold; the rows of a more selective filter are all scored.
+        """
+        query_vector = self._normalize_query(query.query_embedding)
+        filter_rows = self.metadata_index.rows(query.filters) if query.filters is not None else None
+        mask = self._query_mask(query, filtered=filter_rows is not None)
+        nprobe = kwargs.get("nprobe")
+        rerank_factor = kwargs.get("rerank_factor", RERANK_FACTOR)
+
+        rows = None  # every row
+        if self._ivf is not None and nprobe and nprobe < self._ivf.n_lists:
+            rows = self._candidate_rows(query_vector, nprobe)
+        if filter_rows is not None:
+            rows = filter_rows if rows is None or len(filter_rows) <= len(rows) else np.intersect1d(rows, filter_rows, assume_unique=True)
+        coarse = self._quantizer is not None
+        scores = self._scores(query_vector, rows, coarse=coarse)
+        if mask is not None:
+            scores[~(mask if rows is None else mask[rows])] = -np.inf
+
+        if coarse and rerank_factor:
+            positions, shortlist_scores = top_k_from_scores(scores, query.similarity_top_k * rerank_factor)
+            positions = positions[np.isfinite(shortlist_scores)]
+            rows = np.sort(positions if rows is None else rows[positions])
+            scores = self._scores(query_vector, rows)
+
+        positions, similarities = top_k_from_scores(scores, query.similarity_top_k)
+        rows = positions if rows is None else rows[positions]
+        keep = np.isfinite(similarities)
+        rows, similarities = rows[keep], similarities[keep]
+        return VectorStoreQueryResult(
+            similarities=[float(score) for score in similarities],
+            ids=[self._node_ids[row] for row in rows],
+        )
+
+    def embedding_matrix(self):
+        """
+        Returns (node_ids, matrix) of the live embeddings, rows are normalized.
+        The memory-mapped matrix is returned without copying when there are no pending or deleted rows.
+        """
+        pending = self._pending_matrix()
+        if pending is None and not self._deleted:
+            return list(self._node_ids), self._matrix
+        parts = [self._matrix] if self._matrix.shape[0] > 0 else []
+        if pending is not None:
+            parts.append(pending)
+        matrix = np.concatenate(parts) if parts else np.empty((0, self.dim), dtype=np.float32)
+        live = [row for row in range(len(self._node_ids)) if row not in self._deleted]
+        return [self._node_ids[row] for row in live], matrix[live]
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _check_rows(directory: str, file_name: str, size: int):
+    actual = os.path.getsize(os.path.join(directory, file_name))
+    if actual < size:
+        raise ValueError(f"{file_name} holds {actual:,} bytes, the header {size:,}")
+
+
+def _write_json(path: str, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as json_file:
+        json.dump(data, json_file, default=str)
+    os.replace(tmp_path, path)
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as err:
+        # On Windows a file still mapped by another process cannot be removed, it is left for a later persist
+        logs.log.warning(f"Unable to remove previous vector file {path}: {err}")
@@ -0,0 +1,222 @@
+import os
+import json
+
+import numpy as np
+
+from llama_index.core.vector_stores.types import FilterCondition, FilterOperator, MetadataFilters
+
+# Metadata keys with an inverted index: the file a chunk comes from, its MIME type and its PDF page label
+INDEXED_KEYS = ("file_name", "file_type", "page_label")
+
+# Values of these types are indexed, lists and dicts are left to the filter scan
+INDEXED_TYPES = (str, int, float, bool)
+
+# A chunk stored once for several files lists the other files here (see incremental_index.upsert_documents),
+# a file name filter matches the chunk for every one of them
+DUPLICATE_SOURCES_KEY = "duplicate_sources"
+
+# Bumped when the indexed values of a row change, postings persisted by an older version are built again
+POSTINGS_VERSION = 2
+
+
+def row_values(metadata: dict, key: str):
+    """
+    Returns the values a filter on `key` matches for a row: its value, and for `file_name` also the file names
+    of the other files sharing the chunk.
+    """
+    value = metadata.get(key)
+    values = [value] if isinstance(value, INDEXED_TYPES) else []
+    if key == "file_name":
+        values.extend(os.path.basename(source) for source in metadata.get(DUPLICATE_SOURCES_KEY) or [])
+    return list(dict.fromkeys(values))
+
+
+###################################
+#
+# Metadata Index
+#
+###################################
+
+
+class MetadataIndex:
+    """
+    Inverted index from metadata values to the row positions holding them.
+
+    A filter on indexed keys is resolved to the sorted rows it matches from the postings of the matching values,
+    so a filtered query only scores those rows. Range filters (e.g. pages 10 to 20) are resolved over the distinct
+    values of the key, not over the rows.
+
+    Rows are referenced by position, like the rows of the IVF index, and deleted rows are left in the postings:
+    the caller removes them with its tombstones. A row is indexed under every value of `row_values`, so a
+    deduplicated chunk is found by the file name of each file it belongs to.
+
+    Args:
+        keys (tuple): The indexed metadata keys.
+        postings (dict): {key: {value: np.ndarray of sorted rows}}.
+        count (int): The number of rows indexed.
+    """
+
+    def __init__(self, keys=INDEXED_KEYS, postings: dict = None, count: int = 0):
+        self.keys = tuple(keys)
+        self.postings = postings if postings is not None else {key: {} for key in self.keys}
+        self.count = count
+        self.version = POSTINGS_VERSION
+
+    @classmethod
+    def build(cls, metadata: list, keys=INDEXED_KEYS):
+        """
+        Indexes the metadata of every row.
+        """
+        index = cls(keys)
+        index.add(metadata)
+        return index
+
+    def add(self, metadata: list):
+        """
+        Indexes the metadata of rows appended after the indexed ones.
+        """
+        for key in self.keys:
+            new_rows = {}
+            for row, row_metadata in enumerate(metadata, start=self.count):
+                for value in row_values(row_metadata, key):
+                    new_rows.setdefault(value, []).append(row)
+            postings = self.postings[key]
+            for value, rows in new_rows.items():
+                rows = np.asarray(rows, dtype=np.int64)
+                postings[value] = np.concatenate([postings[value], rows]) if value in postings else rows
+        self.count += len(metadata)
+
+    def update(self, row: int, previous: dict, metadata: dict):
+        """
+        Indexes a row again after its metadata changed, e.g. a file now sharing its chunk.
+        """
+        for key in self.keys:
+            previous_values, values = row_values(previous, key), row_values(metadata, key)
+            postings = self.postings[key]
+            for value in previous_values:
+                if value in values or value not in postings:
+                    continue
+                rows = postings[value][postings[value] != row]
+                if len(rows) > 0:
+                    postings[value] = rows
+                else:
+                    del postings[value]
+            for value in values:
+                if value in previous_values:
+                    continue
+                rows = postings.get(value, np.empty(0, dtype=np.int64))
+                postings[value] = np.insert(rows, np.searchsorted(rows, row), row)
+
+    def compacted(self, keep):
+        """
+        Returns the index after removing rows, the kept rows renumbered in order as in `matrix[keep]`.
+        """
+        positions = np.cumsum(keep) - 1
+        postings = {}
+        for key, values in self.postings.items():
+            postings[key] = {}
+            for value, rows in values.items():
+                rows = rows[keep[rows]]
+                if len(rows) > 0:
+                    postings[key][value] = positions[rows]
+        return MetadataIndex(self.keys, postings, int(keep[:self.count].sum()))
+
+    ###################################
+    # Resolve Filters
+    ###################################
+
+    def rows(self, filters: MetadataFilters):
+        """
+        Returns the sorted rows matching metadata filters, or None if the filters use keys or operators the
+        index cannot resolve (the caller then scans every row).
+        """
+        resolved = []
+        for metadata_filter in filters.filters:
+            if isinstance(metadata_filter, MetadataFilters):
+                rows = self.rows(metadata_filter)
+            else:
+                rows = self._operator_rows(metadata_filter.key, metadata_filter.operator, metadata_filter.value)
+            if rows is None:
+                return None
+            resolved.append(rows)
+        if not resolved:
+            return None
+        if filters.condition == FilterCondition.OR:
+            return _union(resolved)
+        if getattr(FilterCondition, "NOT", None) is not None and filters.condition == FilterCondition.NOT:
+            return None
+        rows = resolved[0]
+        for other in resolved[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
+
+    def _operator_rows(self, key: str, operator: FilterOperator, value):
+        if key not in self.postings:
+            return None
+        postings = self.postings[key]
+        if operator == FilterOperator.EQ:
+            values = [value]
+        elif operator == FilterOperator.IN:
+            values = list(dict.fromkeys(value))
+        elif operator == FilterOperator.TEXT_MATCH:
+            values = [item for item in postings if isinstance(item, str) and value in item]
+        elif operator in (FilterOperator.GT, FilterOperator.GTE, FilterOperator.LT, FilterOperator.LTE):
+            bound = _to_float(value)
+            values = [item for item in postings if _in_range(_to_float(item), operator, bound)]
+        else:
+            return None
+        matched = [postings[item] for item in values if isinstance(item, INDEXED_TYPES) and item in postings]
+        if not matched:
+            return np.empty(0, dtype=np.int64)
+        # A deduplicated chunk is in the postings of several file names
+        return matched[0] if len(matched) == 1 else _union(matched)
+
+    ###################################
+    # Save / Load
+    ###################################
+
+    def to_json(self):
+        # Values are kept as [value, rows] pairs, JSON object keys would turn every value into a string
+        return {
+            "version": POSTINGS_VERSION,
+            "count": self.count,
+            "keys": list(self.keys),
+            "postings": {key: [[value, rows.tolist()] for value, rows in values.items()] for key, values in self.postings.items()},
+        }
+
+    @classmethod
+    def from_json(cls, data: dict):
+        postings = {key: {value: np.asarray(rows, dtype=np.int64) for value, rows in values} for key, values in data["postings"].items()}
+        index = cls(data["keys"], postings, data["count"])
+        index.version = data.get("version", 1)
+        return index
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "r") as postings_file:
+            return cls.from_json(json.load(postings_file))
+
+
+def _union(rows_list: list):
+    rows = np.sort(np.concatenate(rows_list))
+    if len(rows) == 0:
+        return rows
+    return rows[np.concatenate(([True], rows[1:] != rows[:-1]))]
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _in_range(value, operator: FilterOperator, bound):
+    # Comparisons with NaN are False, so values that are not numbers (e.g. roman page labels) never match
+    if operator == FilterOperator.GT:
+        return value > bound
+    if operator == FilterOperator.GTE:
+        return value >= bound
+    if operator == FilterOperator.LT:
+        return value < bound
+    return value <= bound
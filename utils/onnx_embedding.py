@@ -0,0 +1,187 @@
+import os
+import glob
+import json
+import shutil
+import tempfile
+
+from typing import List
+
+import utils.logs as logs
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+# Embedding backends: the PyTorch model, its ONNX Runtime export, and the export with int8 weights
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+
+# Exported models are cached here, one directory per model
+ONNX_CACHE_DIR = os.path.join(os.getcwd(), "cache", "onnx")
+
+# Describes the exported files of a cached model
+EXPORT_FILE = "export.json"
+
+# Instruction sets of the CPU the int8 weights are quantized for, see sentence_transformers.export_dynamic_quantized_onnx_model
+DEFAULT_QUANTIZATION_CONFIG = "avx2"
+
+
+###################################
+#
+# Export the Model to ONNX
+#
+###################################
+
+
+def onnx_model_dir(model_name: str, cache_dir: str = ONNX_CACHE_DIR):
+    """
+    Returns the directory the ONNX export of a model is cached in.
+    """
+    return os.path.join(cache_dir, model_name.replace("/", "__"))
+
+
+def _read_export(model_dir: str):
+    try:
+        with open(os.path.join(model_dir, EXPORT_FILE), "r") as export_file:
+            return json.load(export_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_export(model_dir: str, export: dict):
+    with open(os.path.join(model_dir, EXPORT_FILE), "w") as export_file:
+        json.dump(export, export_file, indent=4)
+
+
+def _onnx_file(model_dir: str, name: str):
+    matches = glob.glob(os.path.join(model_dir, "**", name), recursive=True)
+    if not matches:
+        raise Exception(f"No {name} found in {model_dir} after the ONNX export")
+    return os.path.relpath(matches[0], model_dir)
+
+
+def export_onnx_model(model_name: str, quantize: bool = False, cache_dir: str = ONNX_CACHE_DIR, quantization_config: str = DEFAULT_QUANTIZATION_CONFIG):
+    """
+    Exports a sentence-transformers model to ONNX, optionally with dynamically quantized int8 weights, unless it is cached.
+
+    Args:
+        model_name (str): The Hugging Face model, e.g. BAAI/bge-large-en-v1.5.
+        quantize (bool): Also export a copy with int8 weights.
+        cache_dir (str): The directory exported models are cached in.
+        quantization_config (str): The CPU instruction set the int8 weights target: "arm64", "avx2", "avx512" or "avx512_vnni".
+
+    Returns:
+        tuple: The directory of the exported model and the path of the ONNX file to load, relative to it.
+
+    Raises:
+        Exception: If `optimum[onnxruntime]` is not installed, or the export fails.
+
+    Notes:
+        The export holds the tokenizer, pooling and normalization of the original model, so its embeddings are
+        compatible with an index built by the PyTorch model. Only the weights of the int8 copy differ, by the
+        cosine drift measured with `benchmarks/embedding_backend_eval.py`.
+    """
+    try:
+        from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+    except ImportError as err:
+        raise Exception(f"The ONNX embedding backend requires sentence-transformers>=3.2: {err}")
+
+    model_dir = onnx_model_dir(model_name, cache_dir)
+    export = _read_export(model_dir)
+    key = "int8_file" if quantize else "onnx_file"
+    if export.get(key) and os.path.exists(os.path.join(model_dir, export[key])):
+        return model_dir, export[key]
+
+    try:
+        if not export.get("onnx_file"):
+            logs.log.info(f"Exporting {model_name} to ONNX in {model_dir}")
+            model = SentenceTransformer(model_name, backend="onnx", device="cpu")
+            # Exported to a temporary directory first, so an interrupted export is never loaded
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+            model.save_pretrained(tmp_dir)
+            shutil.rmtree(model_dir, ignore_errors=True)
+            os.replace(tmp_dir, model_dir)
+            export = {"model_name": model_name, "onnx_file": _onnx_file(model_dir, "model.onnx")}
+            _write_export(model_dir, export)
+        if quantize:
+            logs.log.info(f"Quantizing the ONNX export of {model_name} to int8 ({quantization_config})")
+            model = SentenceTransformer(model_dir, backend="onnx", device="cpu", model_kwargs={"file_name": export["onnx_file"]})
+            export_dynamic_quantized_onnx_model(model, quantization_config, model_dir, push_to_hub=False, file_suffix="qint8")
+            export = {**export, "int8_file": _onnx_file(model_dir, "model_qint8.onnx"), "quantization_config": quantization_config}
+            _write_export(model_dir, export)
+    except ImportError as err:
+        raise Exception(f"The ONNX embedding backend requires optimum[onnxruntime], install it with `pip install \"optimum[onnxruntime]\"`: {err}")
+    return model_dir, export[key]
+
+
+###################################
+#
+# ONNX Runtime Embedding Model
+#
+###################################
+
+
+class OnnxEmbedding(BaseEmbedding):
+    """
+    Embedding model running the ONNX export of a sentence-transformers model on ONNX Runtime (CPU).
+
+    It embeds like `HuggingFaceEmbedding`: with the same query and text instructions, and normalized embeddings.
+
+    Args:
+        model_name (str): The Hugging Face model exported.
+        quantize (bool): Use the int8 weights.
+        threads (int): The ONNX Runtime intra-op threads, 0 for one per core.
+        cache_dir (str): The directory exported models are cached in.
+    """
+
+    _model = PrivateAttr()
+    _quantized: bool = PrivateAttr()
+
+    def __init__(self, model_name: str, quantize: bool = False, threads: int = 0, cache_dir: str = ONNX_CACHE_DIR, **kwargs):
+        from sentence_transformers import SentenceTransformer
+        from llama_index.embeddings.huggingface.utils import get_query_instruct_for_model_name, get_text_instruct_for_model_name
+
+        model_dir, file_name = export_onnx_model(model_name, quantize=quantize, cache_dir=cache_dir)
+        model_kwargs = {"file_name": file_name, "provider": "CPUExecutionProvider"}
+        if threads > 0:
+            import onnxruntime
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = int(threads)
+            model_kwargs["session_options"] = session_options
+        model = SentenceTransformer(
+            model_dir,
+            backend="onnx",
+            device="cpu",
+            model_kwargs=model_kwargs,
+            prompts={
+                "query": get_query_instruct_for_model_name(model_name),
+                "text": get_text_instruct_for_model_name(model_name),
+            },
+        )
+        # The embedding cache is keyed by model name, int8 embeddings are cached apart from the exact ones
+        super().__init__(model_name=f"{model_name}@onnx-int8" if quantize else model_name, **kwargs)
+        self._model = model
+        self._quantized = quantize
+        logs.log.info(f"Loaded {model_dir}/{file_name} on ONNX Runtime")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "OnnxEmbedding"
+
+    @property
+    def quantized(self) -> bool:
+        return self._quantized
+
+    def _embed(self, sentences: List[str], prompt_name: str = None) -> List[List[float]]:
+        return self._model.encode(sentences, batch_size=self.embed_batch_size, prompt_name=prompt_name, normalize_embeddings=True).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed([query], prompt_name="query")[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed([text], prompt_name="text")[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, prompt_name="text")
@@ -2,12 +2,20 @@ import os
 import shutil
 import json
 
+from functools import partial
+
 import streamlit as st
 
 import utils.helpers as func
 import utils.llama_index as llama_index
 import utils.logs as logs
 
+import utils.incremental_index as incremental_index
+
+from utils.index_collections import collection_dir
+from utils.document_manifest import find_duplicate_files, hash_directory, plan_changes, read_document_manifest
+from utils.sharded_vector_store import create_vector_store
+
 def save_user_settings():
     '''
     Function to save user settings to a config file.
@@ -30,6 +38,16 @@ def save_user_settings():
         "embedding_model": st.session_state.get("embedding_model"),
         "ollama_model": st.session_state.get("selected_model"),
         "system_prompt": st.session_state.get("system_prompt"),
+        "ivf_nprobe": st.session_state.get("nprobe"),
+        "shard_by": st.session_state.get("shard_by"),
+        "shard_size": st.session_state.get("shard_size"),
+        "parse_workers": st.session_state.get("parse_workers"),
+        "parse_timeout": st.session_state.get("parse_timeout"),
+        "ingest_batch_files": st.session_state.get("ingest_batch_files"),
+        "embed_batch_tokens": st.session_state.get("embed_batch_tokens"),
+        "embed_threads": st.session_state.get("embed_threads"),
+        "embedding_backend": st.session_state.get("embedding_backend"),
+        "embed_workers": st.session_state.get("embed_workers"),
     })
     
     try:
@@ -40,6 +58,98 @@ def save_user_settings():
         st.exception(e)
         st.stop()
 
+def update_search_structures(vector_store):
+    '''
+    Function to bring the optional IVF index and int8 embeddings in line with the settings after an upsert.
+    The IVF index is only rebuilt once the chunks added since it was built are a large part of the index,
+    and only the new chunks are quantized, so the work stays proportional to the change.
+    Returns True if the IVF index or the int8 embeddings were built or dropped.
+    '''
+    updated = False
+    # Optional IVF index for approximate search, persisted together with the embeddings
+    if st.session_state["ivf_enabled"]:
+        with st.spinner("Updating IVF index..."):
+            if vector_store.ensure_ivf(n_lists=int(st.session_state["ivf_lists"] or 0)):
+                st.caption(f"✔️ IVF Index Built ({vector_store.ivf_lists:,} lists)")
+                updated = True
+    elif vector_store.ivf_lists:
+        vector_store.drop_ivf()
+        updated = True
+    # Optional int8 copy of the embeddings, written when the index is persisted
+    if st.session_state["quantize_embeddings"]:
+        if not vector_store.quantized:
+            updated = True
+        vector_store.ensure_quantized()
+        st.caption("✔️ Embeddings Quantized (int8)")
+    elif vector_store.quantized:
+        vector_store.drop_quantization()
+        updated = True
+    return updated
+
+def show_deduplication_report(report: dict, duplicates: dict, duplicate_bytes: int):
+    '''
+    Function to show the files and chunks that were not embedded because their content is already indexed.
+    
+    args:
+        report (dict): Chunk counts returned by incremental_index.upsert_documents.
+        duplicates (dict): The uploaded files identical to another file, and that file.
+        duplicate_bytes (int): The total size of those files.
+    '''
+    if len(duplicates) == 0 and report["duplicate_chunks"] == 0:
+        return
+    logs.log.info(f"Deduplication: {len(duplicates)} files ({duplicate_bytes:,} bytes), {report['duplicate_chunks']:,} chunks ({report['duplicate_bytes']:,} bytes) skipped")
+    with st.expander("Deduplication Report"):
+        st.write(f"**Identical files skipped:** {len(duplicates):,} ({duplicate_bytes / 2**20:,.2f} MB not parsed or embedded)")
+        for source, primary in sorted(duplicates.items()):
+            st.caption(f"{source} is identical to {primary}")
+        st.write(f"**Duplicate chunks skipped:** {report['duplicate_chunks']:,} of {report['chunks']:,} "
+                 f"({report['duplicate_bytes'] / 2**10:,.1f} KB of text not embedded)")
+
+def get_persist_dir(collection: str = None):
+    '''
+    Function to return the directory a collection is persisted to, by default the collection selected in the UI.
+    '''
+    return collection_dir(os.getcwd() + "/vector_db", collection or st.session_state["collection"])
+
+def remove_indexed_file(file_name: str, collection: str = None):
+    '''
+    Function to remove a file and all its chunks from the persisted index.
+    
+    args:
+        file_name (str): The source path of the file, as listed in the document manifest.
+        collection (str, optional): The collection the file is indexed in, by default the selected one.
+    '''
+    persist_dir = get_persist_dir(collection)
+    embedding_model = st.session_state["embedding_model"]
+    llama_index.setup_embedding_model(embedding_model,
+                                      batch_tokens=int(st.session_state["embed_batch_tokens"]),
+                                      threads=int(st.session_state["embed_threads"]),
+                                      backend=st.session_state["embedding_backend"],
+                                      workers=int(st.session_state["embed_workers"]))
+    index, manifest = incremental_index.open_index(
+        persist_dir,
+        embedding_model,
+        partial(create_vector_store, st.session_state["shard_by"], int(st.session_state["shard_size"])),
+    )
+    if file_name not in manifest["files"]:
+        return 0
+    removed = incremental_index.remove_source(index, manifest, file_name)
+    incremental_index.persist_index(index, manifest, persist_dir, embedding_model=embedding_model)
+    return removed
+
+def list_indexed_files(collection: str = None):
+    '''
+    Function to return the document manifest entries of a collection, keyed by source path.
+    '''
+    manifest = read_document_manifest(get_persist_dir(collection))
+    return manifest["files"] if manifest else {}
+
+def interrupted_files():
+    '''
+    Function to return the files left in data/ by an ingestion that did not complete, they are ingested by the next run.
+    '''
+    return list(hash_directory(os.getcwd() + "/data"))
+
 def rag_pipeline(uploaded_files: list = None):
     """
     RAG pipeline for Llama-based chatbots.
@@ -64,6 +174,8 @@ def rag_pipeline(uploaded_files: list = None):
         - Creates a service context using the provided Ollama model and embedding file.
         - Loads documents from the current working directory or the provided list of files.
         - Removes the loaded documents and any temporary files created during processing.
+        - Upserts the files into the selected collection (vector_db, or vector_db/collections/<name>): new files are added, files whose content hash
+          changed replace their previous version, unchanged files are skipped. Other indexed files are kept.
     """
     error = None
 
@@ -127,6 +239,10 @@ def rag_pipeline(uploaded_files: list = None):
     try:
         llama_index.setup_embedding_model(
             embedding_model,
+            batch_tokens=int(st.session_state["embed_batch_tokens"]),
+            threads=int(st.session_state["embed_threads"]),
+            backend=st.session_state["embedding_backend"],
+            workers=int(st.session_state["embed_workers"]),
         )
         st.caption("✔️ Embedding Model Created")
     except Exception as err:
@@ -135,6 +251,32 @@ def rag_pipeline(uploaded_files: list = None):
         st.exception(error)
         st.stop()
 
+    ###################################
+    # Open the index persisted so far #
+    ###################################
+
+    # Files are upserted into the existing index: only new or changed files are chunked and embedded
+    try:
+        persist_dir = get_persist_dir()
+    except Exception as err:
+        logs.log.error(f"Collection Error: {str(err)}")
+        error = err
+        st.exception(error)
+        st.stop()
+    try:
+        index, manifest = incremental_index.open_index(
+            persist_dir,
+            embedding_model,
+            partial(create_vector_store, st.session_state["shard_by"], int(st.session_state["shard_size"])),
+        )
+        if len(manifest["files"]) > 0:
+            st.caption(f"✔️ Opened Index ({len(manifest['files']):,} files)")
+    except Exception as err:
+        logs.log.error(f"Index Load Error: {str(err)}")
+        error = err
+        st.exception(error)
+        st.stop()
+
     #######################################
     # Load files from the data/ directory #
     #######################################
@@ -150,10 +292,15 @@ def rag_pipeline(uploaded_files: list = None):
     try:
         # Read files from the data directory : 
         save_dir = os.getcwd() + "/data"
-        # Sending documents to llama_index to for pre-processing (chunking,embeddings) and for creating index
-        documents = llama_index.load_documents(save_dir)           
-        st.session_state["documents"] = documents
-        st.caption("✔️ Data Processed")
+        # Files are matched to the indexed ones by path and content hash, unchanged files are not loaded again
+        hashes = hash_directory(save_dir)
+        added, replaced, unchanged = plan_changes(manifest, hashes)
+        logs.log.info(f"Files to add: {added}, to replace: {replaced}, unchanged: {unchanged}")
+        # Byte-identical copies of another file are not parsed, they reference the chunks of that file
+        duplicates = find_duplicate_files(manifest, hashes, added + replaced)
+        duplicate_bytes = sum(os.path.getsize(os.path.join(save_dir, source)) for source in duplicates)
+        changed = {source: hashes[source] for source in added + replaced}
+        st.caption(f"✔️ Data Processed ({len(added):,} new, {len(replaced):,} changed, {len(unchanged):,} unchanged files)")
         
     except Exception as err:
         
@@ -163,18 +310,52 @@ def rag_pipeline(uploaded_files: list = None):
         st.stop()
 
     ###########################################
-    # Create an index from ingested documents #
+    # Upsert the documents into the index     #
     ###########################################
 
+    # Files are parsed, chunked, embedded and persisted a batch at a time, only the parsed documents of one batch
+    # are held in memory (each persist rewrites the whole docstore, see ingest_in_batches).
+    # Files are removed from data/ once their batch is committed, so an interrupted ingestion resumes with the
+    # files left there the next time the pipeline runs.
     try:
-        # Create an index from the documents
-        logs.log.info(f"Session state : {st.session_state['documents']}")
-        index = llama_index.create_index(
-            st.session_state["documents"],
+        embed_model = llama_index.Settings.embed_model
+        if hasattr(embed_model, "reset_stats"):
+            embed_model.reset_stats()
+        report = {"chunks": 0, "inserted": 0, "duplicate_chunks": 0, "duplicate_bytes": 0}
+        failures = {}
+        committed = 0
+        progress = st.progress(0.0, text="Indexing files...") if len(changed) > 0 else None
+        batches = incremental_index.ingest_in_batches(
+            index, manifest, save_dir, changed, persist_dir,
+            chunk_size=st.session_state["chunk_size"],
+            chunk_overlap=st.session_state["chunk_overlap"],
+            duplicates=duplicates,
+            batch_files=int(st.session_state["ingest_batch_files"]),
+            workers=int(st.session_state["parse_workers"]),
+            timeout=float(st.session_state["parse_timeout"]),
+            embedding_model=embedding_model,
         )
-         # Save the vector index to disk
+        for batch, batch_report, batch_failures in batches:
+            for key in report:
+                report[key] += batch_report[key]
+            failures.update(batch_failures)
+            committed += len(batch)
+            progress.progress(min(1.0, committed / len(changed)), text=f"Indexed {committed:,} of {len(changed):,} files")
+        # Copies of a failed file are not recorded either, they are parsed again the next time they are uploaded
+        duplicates = {source: primary for source, primary in duplicates.items() if primary not in failures}
+        if failures:
+            st.warning("Skipped files that could not be parsed:\n" + "\n".join(f"- {source}: {reason}" for source, reason in failures.items()))
+        st.caption(f"✔️ Indexed {report['inserted']:,} chunks")
+        show_deduplication_report(report, duplicates, duplicate_bytes)
+        if hasattr(embed_model, "stats"):
+            embedding_stats = embed_model.stats()
+            logs.log.info(f"Embedding cache stats: {embedding_stats}")
+            st.caption(f"✔️ Embeddings: {embedding_stats['reused']:,} reused from cache, {embedding_stats['computed']:,} computed")
+        updated = update_search_structures(index.vector_store)
+         # The batches are already persisted, the index is only saved again for a new IVF index or int8 copy
         try:
-            index.storage_context.persist(persist_dir=os.getcwd() + "/vector_db")
+            if updated:
+                incremental_index.persist_index(index, manifest, persist_dir, embedding_model=embedding_model)
             st.caption("✔️ Created File Index")
         except Exception as err:
             logs.log.error(f"Index Creation Error: {str(err)}")
@@ -192,9 +373,9 @@ def rag_pipeline(uploaded_files: list = None):
     # Remove data files #
     #####################
 
-    if len(st.session_state["file_list"]) > 0:
+    save_dir = os.getcwd() + "/data"
+    if os.path.isdir(save_dir):
         try:
-            save_dir = os.getcwd() + "/data"
             shutil.rmtree(save_dir)
             st.caption("✔️ Removed Temp Files")
         except Exception as err:
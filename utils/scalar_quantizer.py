@@ -0,0 +1,69 @@
+import numpy as np
+
+# Rows converted to float32 at a time while scanning. A block small enough to stay in the CPU cache makes the
+# conversion almost free, larger blocks spill to RAM and double the scan time.
+SCAN_BLOCK = 2048
+
+
+###################################
+#
+# Scalar Quantizer
+#
+###################################
+
+
+class ScalarQuantizer:
+    """
+    Per-dimension symmetric int8 quantization of normalized embeddings.
+
+    Every dimension d gets a scale s_d = max |x_d| / 127 and is stored as round(x_d / s_d). The dot product of
+    a query q with a stored row is then approximated by codes @ (q * s), so the query is scaled once and the
+    int8 rows never need to be de-quantized row by row.
+
+    Args:
+        scales (np.ndarray): The float32 scale of every dimension.
+    """
+
+    def __init__(self, scales):
+        self.scales = np.asarray(scales, dtype=np.float32)
+
+    @classmethod
+    def fit(cls, matrix):
+        """
+        Computes the scales from the largest absolute value of every dimension.
+
+        Args:
+            matrix (np.ndarray): The rows to quantize, shape (rows, dim). May be a memmap, read block by block.
+        """
+        max_abs = np.zeros(matrix.shape[1], dtype=np.float32)
+        for start in range(0, matrix.shape[0], SCAN_BLOCK):
+            max_abs = np.maximum(max_abs, np.abs(np.asarray(matrix[start:start + SCAN_BLOCK])).max(axis=0))
+        max_abs[max_abs == 0] = 1.0
+        return cls(max_abs / 127.0)
+
+    def encode(self, block):
+        """
+        Returns the int8 codes of a block of rows. Values beyond the fitted range are clipped.
+        """
+        return np.clip(np.rint(np.asarray(block, dtype=np.float32) / self.scales), -127, 127).astype(np.int8)
+
+    def decode(self, codes):
+        return codes.astype(np.float32) * self.scales
+
+    def scores(self, codes, query):
+        """
+        Returns the approximate dot products of a normalized query with every row of `codes`.
+
+        Args:
+            codes (np.ndarray): int8 rows, shape (rows, dim). May be a memmap.
+            query (np.ndarray): The normalized float32 query.
+        """
+        scaled_query = (query * self.scales).astype(np.float32)
+        scores = np.empty(codes.shape[0], dtype=np.float32)
+        buffer = np.empty((min(SCAN_BLOCK, codes.shape[0]), codes.shape[1]), dtype=np.float32)
+        for start in range(0, codes.shape[0], SCAN_BLOCK):
+            block = codes[start:start + SCAN_BLOCK]
+            rows = block.shape[0]
+            np.copyto(buffer[:rows], block, casting="unsafe")
+            np.matmul(buffer[:rows], scaled_query, out=scores[start:start + rows])
+        return scores
@@ -0,0 +1,501 @@
+import os
+import re
+import json
+import heapq
+import shutil
+import hashlib
+import threading
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+
+import utils.logs as logs
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+from utils.memmap_vector_store import DEFAULT_NAMESPACE, GENERATION_SUFFIXES, MemmapVectorStore, _remove_quietly, _write_json
+
+# Written into default__vector_store.json in place of a MemmapVectorStore header
+SHARDED_FORMAT = "sharded-memmap"
+
+# Sub-directory of the persist directory holding one directory per shard
+SHARD_DIR = "shards"
+
+# Below this many rows in total, shards are searched in-process: sending the query to the pool costs more
+PARALLEL_MIN_ROWS = 20000
+
+
+###################################
+#
+# Shard Search Process Pool
+#
+###################################
+
+
+_workers = []
+_workers_lock = threading.Lock()
+
+# Shards loaded by a worker process, keyed by shard header path
+_worker_shards = {}
+
+
+def get_shard_workers(max_workers: int = 0):
+    """
+    Returns the worker processes searching shards, started on first use.
+
+    Args:
+        max_workers (int): The number of worker processes, 0 for one per CPU core.
+
+    Notes:
+        Every worker is a single process executor and shard i is always sent to worker i % workers, so a worker
+        only maps and keeps its own shards instead of every worker loading every shard.
+        Workers are spawned rather than forked, forking a process running uvicorn and Streamlit threads is unsafe.
+    """
+    with _workers_lock:
+        if not _workers:
+            count = max_workers or os.cpu_count() or 1
+            context = multiprocessing.get_context("spawn")
+            _workers.extend(ProcessPoolExecutor(max_workers=1, mp_context=context) for _ in range(count))
+            logs.log.info(f"Shard search started {count} worker processes")
+        return list(_workers)
+
+
+def shutdown_shard_pool():
+    with _workers_lock:
+        for worker in _workers:
+            worker.shutdown(wait=False, cancel_futures=True)
+        _workers.clear()
+
+
+def _load_worker_shard(persist_path: str, snapshot_id):
+    # Shards are memory-mapped once per worker and re-read when the persisted shard changed
+    store = _worker_shards.get(persist_path)
+    if store is None or store.snapshot_id != snapshot_id:
+        store = MemmapVectorStore.from_persist_path(persist_path)
+        _worker_shards[persist_path] = store
+    return store
+
+
+def _query_shard(persist_path: str, snapshot_id, query: VectorStoreQuery, query_kwargs: dict):
+    """
+    Searches one persisted shard in a pool worker. Returns None when the shard on disk is not the one the caller
+    loaded (it was persisted again since), the caller then searches its own copy.
+    """
+    snapshot_id = tuple(snapshot_id)
+    store = _load_worker_shard(persist_path, snapshot_id)
+    if store.snapshot_id != snapshot_id:
+        return None
+    result = store.query(query, **query_kwargs)
+    return result.ids, result.similarities
+
+
+def _warm_up_shard(persist_path: str, snapshot_id):
+    return _load_worker_shard(persist_path, tuple(snapshot_id)).size
+
+
+def _release_shard(persist_path: str):
+    _worker_shards.pop(persist_path, None)
+
+
+###################################
+#
+# Sharded Vector Store
+#
+###################################
+
+
+class ShardedVectorStore(BasePydanticVectorStore):
+    """
+    Vector store split into independently persisted MemmapVectorStore shards.
+
+    A store persisted to `vector_db/default__vector_store.json` writes there a manifest listing its shards, each one
+    persisted under `vector_db/shards/<shard name>/`. Nodes are assigned to a shard per source document
+    (`shard_by="document"`, by `file_name` metadata) or in fixed size shards (`shard_by="count"`, `shard_size` nodes).
+    Persisting only writes the shards that changed, so adding one document writes one shard.
+
+    Queries search every shard on `max_workers` worker processes and merge the per-shard top k with a heap.
+    Shards with unpersisted changes, and small stores, are searched in-process.
+    """
+
+    stores_text: bool = False
+    shard_by: str = "document"
+    shard_size: int = 50000
+    max_workers: int = 0
+
+    _shards: dict = PrivateAttr()
+    _dirty: set = PrivateAttr()
+    _shard_of: dict = PrivateAttr()
+    _root: Optional[str] = PrivateAttr()
+
+    def __init__(self, **kwargs):
+        super().__init__(stores_text=False, **kwargs)
+        if self.shard_by not in ("document", "count"):
+            raise ValueError(f"Unknown shard_by {self.shard_by}, expected 'document' or 'count'")
+        self._shards = {}  # shard name -> MemmapVectorStore, in creation order
+        self._dirty = set()  # shards changed since the last persist
+        self._shard_of = {}  # node id -> shard name
+        self._root = None  # persist directory the shards were loaded from or last persisted to
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ShardedVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    @property
+    def shards(self) -> dict:
+        return self._shards
+
+    @property
+    def dim(self) -> int:
+        return next((shard.dim for shard in self._shards.values() if shard.dim), 0)
+
+    @property
+    def node_ids(self) -> List[str]:
+        return [node_id for shard in self._shards.values() for node_id in shard.node_ids]
+
+    @property
+    def size(self) -> int:
+        return sum(shard.size for shard in self._shards.values())
+
+    @property
+    def ivf_lists(self) -> int:
+        return sum(shard.ivf_lists for shard in self._shards.values())
+
+    @property
+    def quantized(self) -> bool:
+        return any(shard.quantized for shard in self._shards.values())
+
+    ###################################
+    # Load
+    ###################################
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, namespace: str = DEFAULT_NAMESPACE, **kwargs):
+        return cls.from_persist_path(os.path.join(persist_dir, f"{namespace}__vector_store.json"), **kwargs)
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str, **kwargs):
+        """
+        Loads the shards listed in the manifest at `persist_path`.
+        """
+        with open(persist_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get("format") != SHARDED_FORMAT:
+            raise Exception(f"{persist_path} is not a sharded vector store manifest")
+
+        store = cls(shard_by=manifest["shard_by"], shard_size=manifest["shard_size"], **kwargs)
+        root = os.path.dirname(persist_path)
+        for shard in manifest["shards"]:
+            shard_store = MemmapVectorStore.from_persist_path(os.path.join(root, shard["path"]))
+            store._shards[shard["name"]] = shard_store
+            for node_id in shard_store.node_ids:
+                store._shard_of[node_id] = shard["name"]
+        store._root = root
+        logs.log.info(f"Loaded {len(store._shards)} shards with {store.size:,} embeddings from {persist_path}")
+        return store
+
+    ###################################
+    # Write
+    ###################################
+
+    def _shard_name(self, node: BaseNode):
+        if self.shard_by == "document":
+            source = node.metadata.get("file_name") or node.ref_doc_id or node.node_id
+            slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", str(source))[:48]
+            return f"{slug}-{hashlib.sha1(str(source).encode('utf-8')).hexdigest()[:8]}"
+        if self._shards:
+            name = next(reversed(self._shards))
+            if self._shards[name].size < self.shard_size:
+                return name
+        # Shards emptied by compaction are dropped, so the count of shards may already be taken as a name
+        position = len(self._shards)
+        while f"shard-{position:05d}" in self._shards:
+            position += 1
+        return f"shard-{position:05d}"
+
+    def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        """
+        Adds nodes to their shard. A node already stored in another shard is removed from it.
+        """
+        for node in nodes:
+            name = self._shard_name(node)
+            previous = self._shard_of.get(node.node_id)
+            if previous is not None and previous != name:
+                self._shards[previous].delete_nodes([node.node_id])
+                self._dirty.add(previous)
+            if name not in self._shards:
+                self._shards[name] = MemmapVectorStore()
+            self._shards[name].add([node])
+            self._shard_of[node.node_id] = name
+            self._dirty.add(name)
+        return [node.node_id for node in nodes]
+
+    def update_metadata(self, metadata: dict):
+        """
+        Replaces the metadata of stored nodes in their shards, see `MemmapVectorStore.update_metadata`.
+        """
+        by_shard = {}
+        for node_id, node_metadata in metadata.items():
+            name = self._shard_of.get(node_id)
+            if name is not None:
+                by_shard.setdefault(name, {})[node_id] = node_metadata
+        changed = 0
+        for name, shard_metadata in by_shard.items():
+            shard_changed = self._shards[name].update_metadata(shard_metadata)
+            if shard_changed:
+                self._dirty.add(name)
+            changed += shard_changed
+        return changed
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """
+        Deletes the embeddings of every node of a document, in whichever shards they are.
+        """
+        # llama-index also calls this once per node id when deleting a document, those go to their shard only
+        if ref_doc_id in self._shard_of:
+            name = self._shard_of.pop(ref_doc_id)
+            self._shards[name].delete_nodes([ref_doc_id])
+            self._dirty.add(name)
+            return
+        for name, shard in self._shards.items():
+            size = shard.size
+            shard.delete(ref_doc_id)
+            if shard.size != size:
+                self._dirty.add(name)
+
+    def delete_nodes(self, node_ids: Optional[List[str]] = None, filters: Optional[MetadataFilters] = None, **delete_kwargs: Any) -> None:
+        for name, shard in self._shards.items():
+            size = shard.size
+            shard.delete_nodes(node_ids, filters)
+            if shard.size != size:
+                self._dirty.add(name)
+        for node_id in node_ids or []:
+            self._shard_of.pop(node_id, None)
+
+    def build_ivf(self, n_lists: int = 0, iterations: int = 10):
+        """
+        Builds an IVF index in every shard. n_lists applies per shard, 0 for about sqrt(shard rows).
+        """
+        for name, shard in self._shards.items():
+            if shard.size > 0:
+                shard.build_ivf(n_lists=n_lists, iterations=iterations)
+                self._dirty.add(name)
+
+    def compact(self):
+        """
+        Drops the deleted rows of every shard, and the shards left empty. Returns the number of rows removed.
+        """
+        removed = 0
+        for name, shard in list(self._shards.items()):
+            rows = shard.compact()
+            if rows > 0:
+                removed += rows
+                self._dirty.add(name)
+            if shard.size == 0:
+                del self._shards[name]
+                self._dirty.discard(name)
+        return removed
+
+    def ensure_ivf(self, n_lists: int = 0, max_unindexed: float = 0.2):
+        """
+        Builds the IVF index of the shards without one or with too many rows added since it was built.
+        """
+        built = False
+        for name, shard in self._shards.items():
+            if shard.ensure_ivf(n_lists=n_lists, max_unindexed=max_unindexed):
+                self._dirty.add(name)
+                built = True
+        return built
+
+    def drop_ivf(self):
+        for name, shard in self._shards.items():
+            if shard.ivf_lists:
+                shard.drop_ivf()
+                self._dirty.add(name)
+
+    def quantize(self):
+        for name, shard in self._shards.items():
+            if shard.size > 0:
+                shard.quantize()
+                self._dirty.add(name)
+
+    def ensure_quantized(self):
+        """
+        Quantizes the shards that are not quantized yet, e.g. shards created since the last ingestion.
+        """
+        for name, shard in self._shards.items():
+            if not shard.quantized and shard.size > 0:
+                shard.ensure_quantized()
+                self._dirty.add(name)
+
+    def drop_quantization(self):
+        for name, shard in self._shards.items():
+            if shard.quantized:
+                shard.drop_quantization()
+                self._dirty.add(name)
+
+    def persist(self, persist_path: str, fs: Optional[Any] = None) -> None:
+        """
+        Persists the shards changed since the last persist, then writes the manifest to `persist_path`.
+        Persisting to another directory writes every shard.
+        """
+        root = os.path.dirname(persist_path)
+        dirty = set(self._shards) if root != self._root else self._dirty
+        for name in dirty:
+            if name in self._shards:
+                self._shards[name].persist(os.path.join(root, SHARD_DIR, name, f"{DEFAULT_NAMESPACE}__vector_store.json"))
+
+        # The manifest is written last, readers only see the new shards once it lists them
+        _write_json(persist_path, {
+            "format": SHARDED_FORMAT,
+            "shard_by": self.shard_by,
+            "shard_size": self.shard_size,
+            "shards": [
+                {"name": name, "path": os.path.join(SHARD_DIR, name, f"{DEFAULT_NAMESPACE}__vector_store.json"), "count": shard.size}
+                for name, shard in self._shards.items()
+            ],
+        })
+        logs.log.info(f"Persisted {len(dirty)} of {len(self._shards)} shards to {root}")
+        self._dirty = set()
+        self._root = root
+
+        # Files of an unsharded store persisted before, and shards no longer listed, are cleaned up
+        base = os.path.basename(persist_path)[: -len(".json")]
+        for file_name in os.listdir(root or "."):
+            if file_name.startswith(base + ".") and file_name.endswith(GENERATION_SUFFIXES):
+                _remove_quietly(os.path.join(root, file_name))
+        shard_dir = os.path.join(root, SHARD_DIR)
+        for name in os.listdir(shard_dir) if os.path.isdir(shard_dir) else []:
+            if name not in self._shards:
+                shutil.rmtree(os.path.join(shard_dir, name), ignore_errors=True)
+
+    ###################################
+    # Query
+    ###################################
+
+    def _shard_path(self, name: str):
+        return os.path.join(self._root, SHARD_DIR, name, f"{DEFAULT_NAMESPACE}__vector_store.json")
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """
+        Searches every shard and merges their top k. Accepts the query arguments of MemmapVectorStore
+        (`nprobe`, `rerank_factor`).
+        """
+        shards = [(name, shard) for name, shard in self._shards.items() if shard.size > 0]
+        results = []
+        local = shards
+        if len(shards) > 1 and self.size >= PARALLEL_MIN_ROWS and self.max_workers != 1:
+            workers = get_shard_workers(self.max_workers)
+            futures, local = [], []
+            for position, (name, shard) in enumerate(self._shards.items()):
+                if shard.size == 0:
+                    continue
+                if shard.snapshot_id is None or self._root is None or name in self._dirty:
+                    local.append((name, shard))
+                else:
+                    worker = workers[position % len(workers)]
+                    futures.append(((name, shard), worker.submit(_query_shard, self._shard_path(name), shard.snapshot_id, query, kwargs)))
+            for (name, shard), future in futures:
+                result = future.result()
+                if result is None:
+                    local.append((name, shard))
+                else:
+                    results.append(result)
+        for name, shard in local:
+            result = shard.query(query, **kwargs)
+            results.append((result.ids, result.similarities))
+
+        best = heapq.nlargest(
+            query.similarity_top_k,
+            ((score, node_id) for ids, similarities in results for node_id, score in zip(ids, similarities)),
+        )
+        return VectorStoreQueryResult(
+            similarities=[score for score, _ in best],
+            ids=[node_id for _, node_id in best],
+        )
+
+    def warm_up(self):
+        """
+        Makes every worker process map its persisted shards, so the first queries do not pay the loading time.
+        """
+        if len(self._shards) < 2 or self._root is None or self.max_workers == 1:
+            return
+        workers = get_shard_workers(self.max_workers)
+        futures = [workers[position % len(workers)].submit(_warm_up_shard, self._shard_path(name), shard.snapshot_id)
+                   for position, (name, shard) in enumerate(self._shards.items()) if shard.snapshot_id is not None]
+        for future in futures:
+            future.result()
+
+    def release(self):
+        """
+        Makes the worker processes drop their copy of the shards, e.g. when the index is unloaded.
+        """
+        with _workers_lock:
+            workers = list(_workers)
+        if not workers or self._root is None:
+            return
+        for position, name in enumerate(self._shards):
+            workers[position % len(workers)].submit(_release_shard, self._shard_path(name))
+
+    def embedding_matrix(self):
+        """
+        Returns (node_ids, matrix) of the live embeddings of every shard.
+        """
+        node_ids, matrices = [], []
+        for shard in self._shards.values():
+            shard_node_ids, matrix = shard.embedding_matrix()
+            if len(shard_node_ids) > 0:
+                node_ids.extend(shard_node_ids)
+                matrices.append(np.asarray(matrix))
+        if not matrices:
+            return node_ids, np.empty((0, self.dim), dtype=np.float32)
+        return node_ids, np.concatenate(matrices)
+
+
+###################################
+#
+# Create / Load Vector Store
+#
+###################################
+
+
+def create_vector_store(shard_by: str = "none", shard_size: int = 50000, max_workers: int = 0):
+    """
+    Returns an empty vector store for a new index.
+
+    Args:
+        shard_by (str): "none" for a single MemmapVectorStore, "document" or "count" for a ShardedVectorStore.
+        shard_size (int): The number of nodes per shard with shard_by="count".
+        max_workers (int): The number of processes searching shards, 0 for one per CPU core.
+    """
+    if shard_by in (None, "", "none"):
+        return MemmapVectorStore()
+    return ShardedVectorStore(shard_by=shard_by, shard_size=shard_size, max_workers=max_workers)
+
+
+def load_vector_store(persist_dir: str, namespace: str = DEFAULT_NAMESPACE, max_workers: int = 0):
+    """
+    Loads the vector store persisted in a directory, sharded or not.
+    """
+    persist_path = os.path.join(persist_dir, f"{namespace}__vector_store.json")
+    try:
+        with open(persist_path, "r") as header_file:
+            sharded = json.load(header_file).get("format") == SHARDED_FORMAT
+    except (OSError, ValueError):
+        sharded = False
+    if sharded:
+        return ShardedVectorStore.from_persist_path(persist_path, max_workers=max_workers)
+    return MemmapVectorStore.from_persist_path(persist_path)
@@ -0,0 +1,122 @@
+import numpy as np
+
+import utils.logs as logs
+
+
+###################################
+#
+# Normalize Embeddings
+#
+###################################
+
+
+def normalize_rows(matrix):
+    """
+    Scales every row of a matrix to unit length so a dot product equals cosine similarity.
+
+    Args:
+        matrix (np.ndarray): A 2D array of embeddings, one per row.
+
+    Returns:
+        np.ndarray: A float32 array of unit length rows. All-zero rows are left as zeros.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+###################################
+#
+# Top K Similarity Search
+#
+###################################
+
+
+def top_k_from_scores(scores, top_k: int):
+    """
+    Selects the top k entries of every row of a score matrix.
+
+    Args:
+        scores (np.ndarray): Similarity scores, shape (queries, chunks) or (chunks,).
+        top_k (int): The number of best scores to return per row.
+
+    Returns:
+        tuple: (indices, scores) of shape (queries, k) sorted by descending score, where k is top_k capped by
+        the number of chunks. 1D input returns 1D arrays.
+
+    Notes:
+        np.argpartition selects the top k in linear time, only those k are then sorted.
+    """
+    squeeze = scores.ndim == 1
+    scores = np.atleast_2d(scores)
+    top_k = min(top_k, scores.shape[1])
+    if top_k <= 0:
+        indices, selected = np.empty((scores.shape[0], 0), dtype=np.int64), np.empty((scores.shape[0], 0), dtype=scores.dtype)
+    else:
+        if top_k < scores.shape[1]:
+            candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        else:
+            candidates = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1)
+        indices, selected = np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+    if squeeze:
+        return indices[0], selected[0]
+    return indices, selected
+
+
+def top_k_similarities(query_matrix, embedding_matrix, top_k: int):
+    """
+    Scores every query against every embedding with one matrix product and selects the top k per query.
+
+    Args:
+        query_matrix (np.ndarray): Normalized query embeddings, shape (queries, dim).
+        embedding_matrix (np.ndarray): Normalized document embeddings, shape (chunks, dim).
+        top_k (int): The number of most similar embeddings to return per query.
+
+    Returns:
+        tuple: (indices, scores), both of shape (queries, k) and sorted by descending similarity,
+        where k is top_k capped by the number of embeddings.
+    """
+    query_matrix = np.atleast_2d(query_matrix)
+    if embedding_matrix.shape[0] == 0:
+        return top_k_from_scores(np.empty((query_matrix.shape[0], 0), dtype=np.float32), top_k)
+    return top_k_from_scores(query_matrix @ embedding_matrix.T, top_k)
+
+
+###################################
+#
+# Build Embedding Matrix
+#
+###################################
+
+
+def build_embedding_matrix(vector_store):
+    """
+    Collects the embeddings of a llama-index vector store into one normalized matrix.
+
+    Args:
+        vector_store: The vector store of a loaded VectorStoreIndex.
+
+    Returns:
+        tuple: (node_ids, matrix) where row i of the float32 matrix is the normalized embedding of node_ids[i].
+
+    Raises:
+        Exception: If the vector store does not keep its embeddings in memory.
+    """
+    if hasattr(vector_store, "embedding_matrix"):
+        # MemmapVectorStore already keeps normalized embeddings in one matrix
+        return vector_store.embedding_matrix()
+
+    embedding_dict = getattr(getattr(vector_store, "data", None), "embedding_dict", None)
+    if embedding_dict is None:
+        raise Exception(f"Vector store {type(vector_store).__name__} does not expose its embeddings")
+
+    node_ids = list(embedding_dict.keys())
+    if len(node_ids) == 0:
+        return node_ids, np.empty((0, 0), dtype=np.float32)
+
+    matrix = normalize_rows([embedding_dict[node_id] for node_id in node_ids])
+    logs.log.info(f"Embedding matrix built with {matrix.shape[0]:,} chunks of dimension {matrix.shape[1]}")
+    return node_ids, matrix
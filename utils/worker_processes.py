@@ -0,0 +1,31 @@
+###################################
+#
+# Stop a Worker Process
+#
+###################################
+
+
+def stop_worker(process, connection, graceful: bool):
+    """
+    Stops a worker process and closes the parent end of its pipe.
+
+    Args:
+        process (multiprocessing.Process): The worker process.
+        connection (multiprocessing.connection.Connection): The parent end of the pipe to the worker.
+        graceful (bool): Send the worker None and give it 5 seconds to exit before it is killed, otherwise it is
+            killed right away (e.g. a worker stuck on a file or that failed to start).
+
+    Notes:
+        Used by the document parsing workers (`document_parsing`) and the embedding workers (`embedding_workers`),
+        both exit their loop when they receive None.
+    """
+    try:
+        if graceful:
+            connection.send(None)
+            process.join(timeout=5)
+    except (OSError, EOFError):
+        pass
+    if process.is_alive():
+        process.kill()
+        process.join()
+    connection.close()